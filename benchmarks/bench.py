@@ -0,0 +1,171 @@
+"""
+Offline end-to-end benchmark of `mytts` against the mock service of `benchmarks.mock_server`.
+
+For every method and concurrency level, `--requests` syntheses are run through `AsyncSpeechSynthesizer`
+streams, only with that method (a failed request doesn't fall back to the other one), and requests/s, the latency and the time to first byte (p50/p95/p99, in seconds) are reported
+as JSON, to be compared between releases:
+
+    python -m benchmarks.bench --methods 1 2 --concurrency 1 8 32 --requests 200 --output bench.json
+
+The mock service runs in a subprocess, so it doesn't share the event loop (nor the GIL) with the client.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+from typing import Optional
+
+import mytts
+from mytts import AsyncSpeechSynthesizer, RateLimiter, RetryPolicy, SpeechConfig, policy, tts
+from mytts.policy import BackendManager
+
+
+class _PinnedBackends(BackendManager):
+    '''
+        Send every request to the method it prefers, without falling back, so a row only measures its method.
+    '''
+
+    def candidates(self, method: int) -> list[int]:
+        super().candidates(method)
+        return [method]
+
+
+def percentiles(values: list[float]) -> dict[str, Optional[float]]:
+    '''
+        p50/p95/p99 of `values` (nearest rank), `None` if there is none.
+    '''
+    ordered = sorted(values)
+    def rank(p):
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+    return {"p50": rank(50), "p95": rank(95), "p99": rank(99)}
+
+
+async def _request(synthesizer: AsyncSpeechSynthesizer, text: str) -> dict:
+    begin = time.perf_counter()
+    first = None
+    stream = synthesizer.speak_text_stream(text)
+    async for _ in stream:
+        if first is None:
+            first = time.perf_counter() - begin
+    result = stream.result
+    return {
+        "ok": result.reason == mytts.ResultReason.SynthesizingAudioCompleted,  # type: ignore
+        "latency": time.perf_counter() - begin,
+        "ttfb": first,
+        "retries": result.retries,  # type: ignore
+    }
+
+
+async def run_level(method: int, concurrency: int, requests: int, warmup: int, retry: bool) -> dict:
+    '''
+        Run `requests` syntheses with `method` only, `concurrency` at a time.
+    '''
+    config = SpeechConfig()
+    config.method = method
+    config.retry_policy = RetryPolicy() if retry else None
+    synthesizer = AsyncSpeechSynthesizer(config)
+    tts.backends = _PinnedBackends()
+    for i in range(warmup):
+        await _request(synthesizer, f"warm up {i}")
+
+    samples: list[dict] = []
+    counter = iter(range(requests))
+    async def worker():
+        for i in counter:
+            samples.append(await _request(synthesizer, f"request {i}"))
+    begin = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - begin
+
+    ok = [s for s in samples if s["ok"]]
+    return {
+        "method": method,
+        "concurrency": concurrency,
+        "requests": requests,
+        "ok": len(ok),
+        "errors": len(samples) - len(ok),
+        "retries": sum(s["retries"] for s in samples),
+        "seconds": wall,
+        "rps": len(ok) / wall if wall else None,
+        "latency": percentiles([s["latency"] for s in ok]),
+        "ttfb": percentiles([s["ttfb"] for s in ok if s["ttfb"] is not None]),
+    }
+
+
+async def _start_mock(args) -> asyncio.subprocess.Process:
+    '''
+        Start the mock service and point `mytts` to it.
+    '''
+    command = [sys.executable, "-m", "benchmarks.mock_server", "--port", "0",
+               "--latency", str(args.latency), "--chunk-interval", str(args.chunk_interval),
+               "--chunk-size", str(args.chunk_size), "--audio-bytes", str(args.audio_bytes),
+               "--error-rate", str(args.error_rate), "--rate-429", str(args.rate_429)]
+    for option in ("retry_after", "seed"):
+        if getattr(args, option) is not None:
+            command += ["--" + option.replace("_", "-"), str(getattr(args, option))]
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE)
+    tts.HTTP_URL = (await process.stdout.readline()).decode().split(": ", 1)[1].strip()  # type: ignore
+    tts.WS_URL = (await process.stdout.readline()).decode().split(": ", 1)[1].strip()  # type: ignore
+    return process
+
+
+async def main(argv=None) -> dict:
+    parser = argparse.ArgumentParser(description="Benchmark mytts against a local mock service.")
+    parser.add_argument("--methods", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="requests per method and concurrency level")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--rps", type=float, default=None, help="client rate limit, none by default")
+    parser.add_argument("--no-retry", action="store_true", help="don't retry failed requests")
+    parser.add_argument("--output", help="write the JSON report there instead of stdout")
+    mock = parser.add_argument_group("mock service")
+    mock.add_argument("--latency", type=float, default=0.05)
+    mock.add_argument("--chunk-interval", type=float, default=0.005)
+    mock.add_argument("--chunk-size", type=int, default=4096)
+    mock.add_argument("--audio-bytes", type=int, default=48000)
+    mock.add_argument("--error-rate", type=float, default=0.0)
+    mock.add_argument("--rate-429", type=float, default=0.0)
+    mock.add_argument("--retry-after", type=float, default=None)
+    mock.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    for method in policy.METHODS:
+        policy.rate_limiters[method] = RateLimiter(requests_per_second=args.rps, max_concurrent=None)
+    process = await _start_mock(args)
+    try:
+        results = []
+        for method in args.methods:
+            for concurrency in args.concurrency:
+                result = await run_level(method, concurrency, args.requests, args.warmup, not args.no_retry)
+                print(f"method {method}, concurrency {concurrency}: {result['rps']:.1f} req/s, "
+                      f"p50 {result['latency']['p50']}, errors {result['errors']}", file=sys.stderr)
+                results.append(result)
+        await tts._close_connections()
+    finally:
+        process.terminate()
+        await process.wait()
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "mock": {key: getattr(args, key) for key in
+                 ("latency", "chunk_interval", "chunk_size", "audio_bytes", "error_rate", "rate_429",
+                  "retry_after", "seed")},
+        "client": {"rps": args.rps, "retry": not args.no_retry},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return report
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,179 @@
+"""
+A local stand-in for the TTS service, speaking both protocols of `mytts.tts`:
+
+- method 1: `POST /vcg/speak` with a JSON body `{"ssml": ..., "ttsAudioFormat": ...}`,
+  answered with the audio as a chunked body.
+- method 2: a WebSocket on `/ws` receiving `speech.config` then `ssml` messages, and answering
+  `turn.start`, binary `audio` frames and `turn.end`.
+
+The audio is filler bytes, `audio_bytes` per request. Latency, chunking, errors and 429s are configurable:
+
+    python -m benchmarks.mock_server --port 8765 --latency 0.05 --chunk-size 4096 --rate-429 0.05
+
+Point `mytts.tts.HTTP_URL` and `mytts.tts.WS_URL` to the printed URLs to use it.
+"""
+import argparse
+import asyncio
+import json
+import random
+from typing import NamedTuple, Optional
+
+from aiohttp import WSMsgType, web
+
+
+class MockConfig(NamedTuple):
+    latency: float = 0.05
+    """
+    Seconds before the first audio chunk of a request.
+    """
+    chunk_interval: float = 0.005
+    """
+    Seconds between two audio chunks.
+    """
+    chunk_size: int = 4096
+    audio_bytes: int = 48000
+    error_rate: float = 0.0
+    """
+    Fraction of the requests failing with a 500 (method 1) or a rejected handshake (method 2).
+    """
+    rate_429: float = 0.0
+    """
+    Fraction of the requests rejected with a 429.
+    """
+    retry_after: Optional[float] = None
+    """
+    `Retry-After` of the 429s, in seconds.
+    """
+    seed: Optional[int] = None
+
+
+class MockServer():
+    """
+    The mock service, run it with `start` in a running event loop.
+    """
+
+    def __init__(self, config: MockConfig = MockConfig()):
+        self.config = config
+        self.requests = 0
+        self._random = random.Random(config.seed)
+        self._runner: Optional[web.AppRunner] = None
+        self.port = 0
+        app = web.Application()
+        app.router.add_post("/vcg/speak", self._speak)
+        app.router.add_get("/ws", self._websocket)
+        self._app = app
+
+    @property
+    def http_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/vcg/speak"
+
+    @property
+    def ws_url(self) -> str:
+        return f"ws://127.0.0.1:{self.port}/ws"
+
+    async def start(self, port: int = 0):
+        self._runner = web.AppRunner(self._app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]  # type: ignore
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _failure(self) -> Optional[web.Response]:
+        '''
+            The injected failure of a new request, if any.
+        '''
+        self.requests += 1
+        draw = self._random.random()
+        if draw < self.config.rate_429:
+            headers = {}
+            if self.config.retry_after is not None:
+                headers["Retry-After"] = str(self.config.retry_after)
+            return web.Response(status=429, text="Too many requests", headers=headers)
+        if draw < self.config.rate_429 + self.config.error_rate:
+            return web.Response(status=500, text="Injected error")
+        return None
+
+    def _chunks(self):
+        size = self.config.chunk_size
+        for offset in range(0, self.config.audio_bytes, size):
+            yield bytes(min(size, self.config.audio_bytes - offset))
+
+    async def _speak(self, request: web.Request) -> web.StreamResponse:
+        failure = self._failure()
+        if failure is not None:
+            return failure
+        data = json.loads(await request.text())
+        if "ssml" not in data or "ttsAudioFormat" not in data:
+            return web.json_response({"message": "Bad request", "innerError": None}, status=400)
+        await asyncio.sleep(self.config.latency)
+        response = web.StreamResponse()
+        response.content_type = "audio/mpeg"
+        await response.prepare(request)
+        for chunk in self._chunks():
+            await response.write(chunk)
+            await asyncio.sleep(self.config.chunk_interval)
+        await response.write_eof()
+        return response
+
+    async def _websocket(self, request: web.Request) -> web.StreamResponse:
+        failure = self._failure()
+        if failure is not None:
+            return failure
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            head, _, _ = message.data.partition("\r\n\r\n")
+            headers = dict(line.split(":", 1) for line in head.split("\r\n") if ":" in line)
+            if headers.get("Path") != "ssml":
+                continue
+            req_id = headers["X-RequestId"]
+            await asyncio.sleep(self.config.latency)
+            await ws.send_str(f"X-RequestId:{req_id}\r\nPath:turn.start\r\n\r\n{{}}")
+            audio_head = f"X-RequestId:{req_id}\r\nContent-Type:audio/mpeg\r\nPath:audio\r\n".encode()
+            prefix = len(audio_head).to_bytes(2, "big") + audio_head
+            for chunk in self._chunks():
+                await ws.send_bytes(prefix + chunk)
+                await asyncio.sleep(self.config.chunk_interval)
+            await ws.send_str(f"X-RequestId:{req_id}\r\nPath:turn.end\r\n\r\n{{}}")
+        return ws
+
+
+def _parse_args(argv=None) -> tuple[MockConfig, int]:
+    defaults = MockConfig._field_defaults
+    parser = argparse.ArgumentParser(description="Run the mock TTS service.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=defaults["latency"])
+    parser.add_argument("--chunk-interval", type=float, default=defaults["chunk_interval"])
+    parser.add_argument("--chunk-size", type=int, default=defaults["chunk_size"])
+    parser.add_argument("--audio-bytes", type=int, default=defaults["audio_bytes"])
+    parser.add_argument("--error-rate", type=float, default=defaults["error_rate"])
+    parser.add_argument("--rate-429", type=float, default=defaults["rate_429"])
+    parser.add_argument("--retry-after", type=float, default=defaults["retry_after"])
+    parser.add_argument("--seed", type=int, default=defaults["seed"])
+    args = parser.parse_args(argv)
+    config = MockConfig(args.latency, args.chunk_interval, args.chunk_size, args.audio_bytes,
+                        args.error_rate, args.rate_429, args.retry_after, args.seed)
+    return config, args.port
+
+
+async def _serve(config: MockConfig, port: int):
+    server = MockServer(config)
+    await server.start(port)
+    print(f"method 1: {server.http_url}\nmethod 2: {server.ws_url}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_serve(*_parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -3,29 +3,91 @@ from .speech import *
 from .enums import (
     CancellationErrorCode,
     CancellationReason,
+    CircuitState,
     ResultReason,
 )
+from .policy import (
+    BackendManager,
+    BackendStatus,
+    BackendUnavailable,
+    RateLimiter,
+    RetryPolicy,
+    ServiceStatusError,
+    backends,
+    rate_limiters,
+)
+from .cache import CacheStats, SynthesisCache
+from .metrics import MetricsRegistry
+from .ssml import SSMLValidationError
+from .runtime import (
+    SynthesisRuntime,
+    blocking_executor,
+    decode_executor,
+    default_runtime,
+    set_blocking_executor,
+    set_decode_executor,
+)
+from .playback import SpeakerSink
+from .sinks import (
+    AudioSink,
+    FileSink,
+    AudioOutputStream,
+    PullAudioOutputStream,
+    PushAudioOutputStream,
+    PushAudioOutputStreamCallback,
+)
 from .speech import (
     ResultFuture,
     SpeechSynthesisCancellationDetails,
     SpeechSynthesisResult,
+    SynthesisTimings,
+    SpeechSynthesisStream,
+    SpeechSynthesisBatch,
     SpeechConfig,
     AudioOutputConfig,
-    SpeechSynthesizer
+    SpeechSynthesizer,
+    AsyncSpeechSynthesizer,
+    wait_all,
+    as_completed
 )
 audio = speech
 
 root_namespace_classes = (
     CancellationErrorCode,
     CancellationReason,
+    CircuitState,
     ResultFuture,
     ResultReason,
     SpeechConfig,
     SpeechSynthesisCancellationDetails,
     SpeechSynthesisOutputFormat,
     SpeechSynthesisResult,
+    SynthesisTimings,
+    SpeechSynthesisStream,
+    SpeechSynthesisBatch,
     SpeechSynthesizer,
+    AsyncSpeechSynthesizer,
+    SynthesisCache,
+    SynthesisRuntime,
+    CacheStats,
+    MetricsRegistry,
+    AudioSink,
+    FileSink,
+    SpeakerSink,
+    AudioOutputStream,
+    PullAudioOutputStream,
+    PushAudioOutputStream,
+    PushAudioOutputStreamCallback,
+    BackendManager,
+    BackendStatus,
+    BackendUnavailable,
+    RateLimiter,
+    RetryPolicy,
+    ServiceStatusError,
+    SSMLValidationError,
 )
 for cls in root_namespace_classes:
     cls.__module__ = __name__
 __all__ = [cls.__name__ for cls in root_namespace_classes]
+__all__ += ["wait_all", "as_completed", "backends", "rate_limiters", "default_runtime",
+            "blocking_executor", "set_blocking_executor", "decode_executor", "set_decode_executor"]
@@ -0,0 +1,231 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha256
+from typing import NamedTuple, Optional
+
+from .runtime import _offload
+from .ssml import normalize_ssml
+
+
+class CacheStats(NamedTuple):
+    """
+    Statistics of a `SynthesisCache`.
+    """
+    memory_hits: int
+    disk_hits: int
+    misses: int
+    evictions: int
+    memory_bytes: int
+    disk_bytes: int
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class SynthesisCache():
+    """
+    Content-addressed cache of synthesized audio, shared by the synthesizers it is given to.
+
+    Entries are kept in a memory tier with LRU eviction, and optionally in a disk tier.
+    In an event loop, use `aget` and `aput`, which read and write the disk tier in the blocking executor
+    (see `runtime.blocking_executor`).
+
+    :param max_memory_bytes: Size limit of the memory tier.
+    :param directory: Directory of the disk tier. If `None`, only the memory tier is used.
+        The directory is created if it doesn't exist.
+    :param max_disk_bytes: Size limit of the disk tier. The least recently used files are removed first.
+    :param ttl: Seconds an entry of the disk tier stays valid. If `None`, entries never expire.
+    """
+
+    def __init__(self, max_memory_bytes: int = 64 * 1024 * 1024, directory: Optional[str] = None,
+                 max_disk_bytes: int = 1024 * 1024 * 1024, ttl: Optional[float] = None):
+        self._max_memory_bytes = max_memory_bytes
+        self._directory = directory
+        self._max_disk_bytes = max_disk_bytes
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._memory: OrderedDict = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: OrderedDict = OrderedDict()
+        self._disk_bytes = 0
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            entries = []
+            for entry in os.scandir(directory):
+                if entry.is_file() and entry.name.endswith(".audio"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.name[:-6], st.st_size))
+            for _, key, size in sorted(entries):
+                self._disk[key] = size
+                self._disk_bytes += size
+            self._evict_disk()
+
+    @staticmethod
+    def key(ssml: str, voice: str, opt_fmt: str) -> str:
+        """
+        The cache key of a synthesis.
+
+        :param ssml: The SSML to be synthesized, whitespace is normalized.
+        :param voice: The voice name of the `SpeechConfig`.
+        :param opt_fmt: The output format string of the `SpeechConfig`.
+        """
+        content = "\0".join((normalize_ssml(ssml), voice or "", opt_fmt))
+        return sha256(content.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, key + ".audio")  # type: ignore
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Get the audio of `key`, or `None` if it isn't cached.
+        """
+        data, on_disk = self._get_memory(key)
+        if not on_disk:
+            return data
+        return self._get_disk(key)
+
+    async def aget(self, key: str) -> Optional[bytes]:
+        """
+        Like `get`, reading the disk tier in the blocking executor.
+        """
+        data, on_disk = self._get_memory(key)
+        if not on_disk:
+            return data
+        return await _offload(self._get_disk, key)
+
+    def put(self, key: str, data: bytes):
+        """
+        Cache the audio of `key`. Empty audio is not cached.
+        """
+        if self._put_memory_tier(key, data):
+            self._put_disk(key, data)
+
+    async def aput(self, key: str, data: bytes):
+        """
+        Like `put`, writing the disk tier in the blocking executor.
+        """
+        if self._put_memory_tier(key, data):
+            await _offload(self._put_disk, key, data)
+
+    def _get_memory(self, key: str) -> tuple[Optional[bytes], bool]:
+        '''
+            The audio of `key` if it is in the memory tier, and whether it has to be read from the disk tier.
+        '''
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self._memory_hits += 1
+                return data, False
+            if key not in self._disk:
+                self._misses += 1
+                return None, False
+            return None, True
+
+    def _get_disk(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            if self._ttl is not None and time.time() - os.path.getmtime(path) > self._ttl:
+                raise FileNotFoundError(path)
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._remove_disk(key)
+                self._misses += 1
+            return None
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            self._disk_hits += 1
+            self._put_memory(key, data)
+        return data
+
+    def _put_memory_tier(self, key: str, data: bytes) -> bool:
+        '''
+            Put the audio of `key` into the memory tier, and tell whether it goes into the disk tier too.
+        '''
+        if not data:
+            return False
+        with self._lock:
+            self._put_memory(key, data)
+        return self._directory is not None and len(data) <= self._max_disk_bytes
+
+    def _put_disk(self, key: str, data: bytes):
+        path = self._path(key)
+        # The file is written out of the lock, don't mix up two writers of the same key.
+        tmp = "%s.%d.tmp" % (path, threading.get_ident())
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        with self._lock:
+            self._remove_disk(key, unlink=False)
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data)
+            self._evict_disk()
+
+    def clear(self):
+        """
+        Remove every entry from both tiers.
+        """
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            for key in list(self._disk):
+                self._remove_disk(key)
+
+    def stats(self) -> CacheStats:
+        """
+        Get the hit/miss statistics and the current size of the tiers.
+        """
+        with self._lock:
+            return CacheStats(self._memory_hits, self._disk_hits, self._misses,
+                              self._evictions, self._memory_bytes, self._disk_bytes)
+
+    def _put_memory(self, key: str, data: bytes):
+        if len(data) > self._max_memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self._max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self._evictions += 1
+
+    def _remove_disk(self, key: str, unlink: bool = True):
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+        if unlink:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _evict_disk(self):
+        while self._disk_bytes > self._max_disk_bytes:
+            key = next(iter(self._disk))
+            self._remove_disk(key)
+            self._evictions += 1
+
+    def __str__(self) -> str:
+        return f"<{self.__class__.__name__} {self.stats()}>"
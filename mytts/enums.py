@@ -306,6 +306,12 @@ class CancellationErrorCode(Enum):
     is set to NoError.
     """
 
+    BadRequest = 2
+    """
+    Indicates that one or more synthesis parameters are invalid, e.g. a malformed SSML document
+    or an output format the method doesn't support.
+    """
+
     TooManyRequests = 3
     """
     Indicates that the number of parallel requests exceeded the number of allowed concurrent transcriptions for the subscription.
@@ -340,3 +346,24 @@ class CancellationErrorCode(Enum):
     """
     Indicates an unexpected runtime error.
     """
+
+
+class CircuitState(Enum):
+    """
+    Defines the states of the circuit breaker of a synthesis method.
+    """
+
+    Closed = 1
+    """
+    The method is healthy, requests are sent to it.
+    """
+
+    Open = 2
+    """
+    The method kept failing, requests skip it until its cooldown is over.
+    """
+
+    HalfOpen = 3
+    """
+    The cooldown is over, a single probe request is sent to find out whether the method recovered.
+    """
@@ -0,0 +1,393 @@
+import re
+import struct
+from io import BytesIO
+from typing import NamedTuple, Optional
+
+
+class AudioFormat(NamedTuple):
+    """
+    The properties of an output format string, e.g. `audio-24khz-48kbitrate-mono-mp3`.
+    """
+    container: str
+    """
+    `raw`, `riff`, `audio` (a bare codec stream), `ogg`, `webm` or `amr`.
+    """
+    codec: str
+    """
+    `pcm`, `mulaw`, `alaw`, `mp3`, `opus`, `siren`, `truesilk` or `amr-wb`.
+    """
+    sample_rate: int
+    bits: Optional[int]
+    bitrate: Optional[int]
+    """
+    Bits per second, if the format string tells it.
+    """
+
+
+def parse_format(opt_fmt: str) -> AudioFormat:
+    """
+    Parse an output format string.
+    """
+    if opt_fmt.startswith("amr-wb-"):
+        return AudioFormat("amr", "amr-wb", int(opt_fmt[7:].rstrip("hz")), None, None)
+    parts = opt_fmt.split("-")
+    sample_rate = 0
+    bits = bitrate = None
+    for part in parts[1:-1]:
+        if (m := re.fullmatch(r"(\d+)khz", part)):
+            sample_rate = int(m[1]) * 1000
+        elif (m := re.fullmatch(r"(\d+)hz", part)):
+            sample_rate = int(m[1])
+        elif (m := re.fullmatch(r"(\d+)bit", part)):
+            bits = int(m[1])
+        elif (m := re.fullmatch(r"(\d+)(?:kbps|kbitrate)", part)):
+            bitrate = int(m[1]) * 1000
+    return AudioFormat(parts[0], parts[-1], sample_rate, bits, bitrate)
+
+
+_AMR_WB_MAGIC = b"#!AMR-WB\n"
+
+
+def _riff_chunks(data: bytes):
+    '''
+        Iterate over `(chunk_id, offset, size)` of a RIFF/WAVE file.
+        The size of the `data` chunk may be unknown (0 or 0xFFFFFFFF) when the file was streamed,
+        it is then assumed to reach the end of the file.
+    '''
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError("not a RIFF/WAVE file")
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id, size = struct.unpack_from("<4sI", data, offset)
+        if chunk_id == b"data" and (size == 0 or offset + 8 + size > len(data)):
+            size = len(data) - offset - 8
+        yield chunk_id, offset + 8, size
+        offset += 8 + size + (size & 1)
+
+
+def _riff_split(data: bytes) -> tuple[bytes, memoryview]:
+    '''
+        Get the `fmt ` chunk and the samples of a RIFF/WAVE file.
+    '''
+    fmt = None
+    view = memoryview(data)
+    for chunk_id, offset, size in _riff_chunks(data):
+        if chunk_id == b"fmt ":
+            fmt = bytes(view[offset:offset+size])
+        elif chunk_id == b"data":
+            if fmt is None:
+                break
+            return fmt, view[offset:offset+size]
+    raise ValueError("RIFF/WAVE file without `fmt ` or `data` chunk")
+
+
+def _concat_decodes(opt_fmt: str) -> bool:
+    '''
+        Whether `concat_audio` decodes and re-encodes clips of `opt_fmt`, rather than joining their bytes.
+    '''
+    return parse_format(opt_fmt).container == "webm"
+
+
+def _decoded_duration(data: bytes) -> float:
+    '''
+        The duration of a clip in seconds, found out by decoding it with `pydub`.
+    '''
+    from pydub import AudioSegment
+    return AudioSegment.from_file(BytesIO(data)).duration_seconds
+
+
+def concat_audio(chunks: list[bytes], opt_fmt: str) -> bytes:
+    """
+    Join audio clips of the same output format into one clip.
+
+    Raw streams, MP3 and bare Opus are joined byte by byte, RIFF files are merged into a
+    single RIFF file, and the AMR-WB header is kept only once. Ogg streams are chained,
+    which is valid Ogg. WebM can't be joined that way and is re-encoded with `pydub`.
+    """
+    if len(chunks) == 1:
+        return chunks[0]
+    fmt = parse_format(opt_fmt)
+    if fmt.container == "riff":
+        parts = [_riff_split(chunk) for chunk in chunks if chunk]
+        if not parts:
+            return b""
+        fmt_chunk = parts[0][0]
+        size = sum(len(samples) for _, samples in parts)
+        out = bytearray()
+        out += b"RIFF" + struct.pack("<I", 4 + 8 + len(fmt_chunk) + 8 + size) + b"WAVE"
+        out += b"fmt " + struct.pack("<I", len(fmt_chunk)) + fmt_chunk
+        out += b"data" + struct.pack("<I", size)
+        for _, samples in parts:
+            out += samples
+        return bytes(out)
+    if fmt.container == "amr":
+        out = bytearray(_AMR_WB_MAGIC)
+        for chunk in chunks:
+            out += memoryview(chunk)[len(_AMR_WB_MAGIC):] if chunk.startswith(_AMR_WB_MAGIC) else chunk
+        return bytes(out)
+    if fmt.codec == "mp3":
+        return b"".join(_mp3_strip_info(chunk) for chunk in chunks)
+    if fmt.container == "webm":
+        from pydub import AudioSegment
+        sound = sum((AudioSegment.from_file(BytesIO(chunk), format="webm") for chunk in chunks if chunk),
+                    AudioSegment.empty())
+        out = BytesIO()
+        sound.export(out, format="webm", codec="libopus")
+        return out.getvalue()
+    return b"".join(chunks)
+
+
+_MP3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG 1
+    2: (22050, 24000, 16000),  # MPEG 2
+    0: (11025, 12000, 8000),   # MPEG 2.5
+}
+
+
+class _Mp3Frame(NamedTuple):
+    size: int
+    samples: int
+    sample_rate: int
+    side_info: int
+
+
+def _mp3_frame(data: bytes, offset: int) -> Optional[_Mp3Frame]:
+    '''
+        Parse the header of the MPEG layer III frame at `offset`.
+    '''
+    if offset + 4 > len(data):
+        return None
+    b1, b2, b3, b4 = data[offset:offset+4]
+    version = (b2 >> 3) & 3
+    if b1 != 0xFF or (b2 & 0xE0) != 0xE0 or version == 1 or (b2 >> 1) & 3 != 1:
+        return None
+    bitrate_index = b3 >> 4
+    rate_index = (b3 >> 2) & 3
+    if bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = _MP3_BITRATES[1 if mpeg1 else 2][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+    mono = b4 >> 6 == 3
+    size = (144 if mpeg1 else 72) * bitrate // sample_rate + ((b3 >> 1) & 1)
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    return _Mp3Frame(size, 1152 if mpeg1 else 576, sample_rate, side_info)
+
+
+def _id3_size(data: bytes) -> int:
+    '''
+        Size of the ID3v2 tag at the start of `data`, 0 if there is none.
+    '''
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    return 10 + size + (10 if data[5] & 0x10 else 0)
+
+
+def _mp3_info_frames(data: bytes, offset: int, frame: _Mp3Frame) -> Optional[int]:
+    '''
+        Number of frames told by a Xing/Info or VBRI header in the frame at `offset`.
+        `None` if the frame isn't such a header, -1 if it is one without a frame count.
+    '''
+    xing = offset + 4 + frame.side_info
+    if data[xing:xing+4] in (b"Xing", b"Info"):
+        flags = int.from_bytes(data[xing+4:xing+8], "big")
+        if flags & 1:
+            return int.from_bytes(data[xing+8:xing+12], "big")
+        return -1
+    vbri = offset + 36
+    if data[vbri:vbri+4] == b"VBRI":
+        return int.from_bytes(data[vbri+14:vbri+18], "big")
+    return None
+
+
+def _mp3_duration(data: bytes) -> Optional[float]:
+    offset = _id3_size(data)
+    frame = _mp3_frame(data, offset)
+    if frame is None:
+        return None
+    frames = _mp3_info_frames(data, offset, frame)
+    if frames is not None and frames >= 0:
+        return frames * frame.samples / frame.sample_rate
+    if frames is not None:
+        offset += frame.size
+    sample_rate = frame.sample_rate
+    samples = 0
+    while (frame := _mp3_frame(data, offset)) is not None:
+        samples += frame.samples
+        offset += frame.size
+    return samples / sample_rate
+
+
+def _mp3_strip_info(data: bytes) -> bytes:
+    '''
+        Remove the ID3v2 tag and a leading Xing/Info/VBRI frame, which describe the
+        clip as a whole and would be wrong once clips are joined.
+    '''
+    offset = _id3_size(data)
+    frame = _mp3_frame(data, offset)
+    if frame is not None and _mp3_info_frames(data, offset, frame) is not None:
+        offset += frame.size
+    return data[offset:] if offset else data
+
+
+def _riff_duration(data: bytes) -> Optional[float]:
+    byte_rate = None
+    for chunk_id, offset, size in _riff_chunks(data):
+        if chunk_id == b"fmt ":
+            byte_rate = struct.unpack_from("<I", data, offset + 8)[0]
+        elif chunk_id == b"data" and byte_rate:
+            return min(size, len(data) - offset) / byte_rate
+    return None
+
+
+def _ogg_duration(data: bytes) -> Optional[float]:
+    '''
+        Duration of an Ogg Opus file, from the granule position of the last page of
+        every logical stream (chained streams are added up).
+    '''
+    streams: dict = {}
+    offset = 0
+    while data[offset:offset+4] == b"OggS" and offset + 27 <= len(data):
+        granule, serial = struct.unpack_from("<qI", data, offset + 6)
+        segments = data[offset+26]
+        table = data[offset+27:offset+27+segments]
+        body = offset + 27 + segments
+        if serial not in streams:
+            # The first packet of a stream is OpusHead, telling the pre-skip.
+            pre_skip = struct.unpack_from("<H", data, body + 10)[0] if data[body:body+8] == b"OpusHead" else 0
+            streams[serial] = [pre_skip, 0]
+        if granule >= 0:
+            streams[serial][1] = granule
+        offset = body + sum(table)
+    if not streams:
+        return None
+    return sum(max(granule - pre_skip, 0) for pre_skip, granule in streams.values()) / 48000
+
+
+_EBML_MASTERS = {
+    0x18538067,  # Segment
+    0x1549A966,  # Info
+    0x1F43B675,  # Cluster
+    0xA0,        # BlockGroup
+}
+
+
+def _ebml_vint(data: bytes, offset: int, mask: bool) -> tuple[int, int]:
+    first = data[offset]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise ValueError("invalid EBML variable size integer")
+    value = first & (0xFF >> length) if mask else first
+    for b in data[offset+1:offset+length]:
+        value = (value << 8) | b
+    return value, offset + length
+
+
+def _webm_duration(data: bytes) -> Optional[float]:
+    '''
+        Duration of a WebM file, from the `Duration` of the segment info if present,
+        otherwise from the timecode of the last block.
+    '''
+    scale = 1000000
+    duration = None
+    cluster = 0
+    last = None
+    gap = 0
+    offset = 0
+    end = len(data)
+    try:
+        while offset < end:
+            element, offset = _ebml_vint(data, offset, False)
+            size, body = _ebml_vint(data, offset, True)
+            unknown = size == (1 << (7 * (body - offset))) - 1
+            offset = body
+            if element in _EBML_MASTERS:
+                continue  # descend into the children
+            if unknown:
+                return None
+            if element == 0x2AD7B1:    # TimecodeScale
+                scale = int.from_bytes(data[offset:offset+size], "big")
+            elif element == 0x4489:    # Duration
+                duration = struct.unpack(">f" if size == 4 else ">d", data[offset:offset+size])[0]
+            elif element == 0xE7:      # Cluster Timecode
+                cluster = int.from_bytes(data[offset:offset+size], "big")
+            elif element in (0xA3, 0xA1):  # SimpleBlock, Block
+                _, timecode = _ebml_vint(data, offset, True)
+                timecode = cluster + struct.unpack_from(">h", data, timecode)[0]
+                if last is not None and timecode > last:
+                    gap = timecode - last
+                last = timecode
+            offset += size
+    except (IndexError, ValueError, struct.error):
+        pass
+    if duration is not None:
+        return duration * scale / 1e9
+    if last is None:
+        return None
+    return (last + gap) * scale / 1e9
+
+
+# Bytes of speech data of an AMR-WB frame, by frame type (RFC 4867).
+_AMR_WB_SIZES = (17, 23, 32, 36, 40, 46, 50, 58, 60, 5, 0, 0, 0, 0, 0, 0)
+
+
+def _amr_wb_duration(data: bytes) -> Optional[float]:
+    if not data.startswith(_AMR_WB_MAGIC):
+        return None
+    offset = len(_AMR_WB_MAGIC)
+    frames = 0
+    while offset < len(data):
+        offset += 1 + _AMR_WB_SIZES[(data[offset] >> 3) & 0xF]
+        frames += 1
+    return frames * 0.02
+
+
+def _silk_duration(data: bytes) -> Optional[float]:
+    '''
+        Duration of raw TrueSilk, a sequence of 20ms packets each prefixed by its
+        length as a 2-byte little-endian integer.
+    '''
+    offset = 0
+    frames = 0
+    while offset + 2 <= len(data):
+        offset += 2 + int.from_bytes(data[offset:offset+2], "little")
+        frames += 1
+    return frames * 0.02 if offset == len(data) else None
+
+
+def probe_duration(data: bytes, opt_fmt: str) -> Optional[float]:
+    """
+    Get the duration in seconds of audio in the output format `opt_fmt`, from its headers
+    alone, without decoding it.
+
+    :returns: The duration, or `None` if it can't be told from the headers.
+    """
+    fmt = parse_format(opt_fmt)
+    try:
+        if fmt.container == "riff":
+            return _riff_duration(data)
+        if fmt.container == "ogg":
+            return _ogg_duration(data)
+        if fmt.container == "webm":
+            return _webm_duration(data)
+        if fmt.container == "amr":
+            return _amr_wb_duration(data)
+        if fmt.codec == "mp3":
+            return _mp3_duration(data)
+        if fmt.codec == "truesilk":
+            return _silk_duration(data)
+        if fmt.codec in ("pcm", "mulaw", "alaw") and fmt.bits and fmt.sample_rate:
+            return len(data) / (fmt.sample_rate * fmt.bits // 8)
+        if fmt.bitrate:
+            # Bare constant bitrate streams, e.g. Siren or Opus without container.
+            return len(data) * 8 / fmt.bitrate
+    except (IndexError, ValueError, struct.error):
+        pass
+    return None
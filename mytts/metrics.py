@@ -0,0 +1,278 @@
+"""
+Process-wide metrics of the syntheses: counters, gauges and latency histograms.
+
+They are off by default, turn them on with `registry.enable()`. Then read them with `registry.snapshot()`,
+or scrape `registry.exposition()`, which is in the Prometheus text format. `registry.write(path)` writes it
+into a file, e.g. for the textfile collector of the node exporter.
+
+Writers don't take any lock: every thread updates its own shard of a metric, and the shards are
+summed when the metric is read.
+"""
+import os
+import threading
+from bisect import bisect_left
+from typing import Iterable, Optional, Union
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+"""
+Upper bounds of the buckets of the latency histograms, in seconds.
+"""
+
+
+class _Metric():
+    '''
+        A metric whose values are kept per label values, and per thread.
+    '''
+    kind = ""
+
+    def __init__(self, registry:"MetricsRegistry", name:str, help:str, labelnames:Iterable[str]=()):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: list[dict] = []
+        # Only taken when a thread updates the metric for the first time, to add its shard.
+        self._lock = threading.Lock()
+
+    def _shard(self, labels:tuple) -> Optional[dict]:
+        '''
+            The shard of the calling thread, or `None` if the registry is disabled.
+        '''
+        if not self._registry.enabled:
+            return None
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}, got {labels}")
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def _merge(self, values:list):
+        return sum(values)
+
+    def _collect(self) -> dict:
+        '''
+            The values of every label values, merged across the shards.
+        '''
+        values: dict = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for labels, value in shard.copy().items():
+                values.setdefault(labels, []).append(value)
+        return {labels: self._merge(value) for labels, value in values.items()}
+
+    def _reset(self):
+        with self._lock:
+            for shard in self._shards:
+                shard.clear()
+
+    def samples(self) -> list[dict]:
+        """
+        The current values, as `{"labels": {name: value}, "value": ...}`.
+        """
+        return [{"labels": dict(zip(self.labelnames, labels)), "value": value}
+                for labels, value in sorted(self._collect().items())]
+
+
+class Counter(_Metric):
+    """
+    A value which only goes up, e.g. a number of requests.
+    """
+    kind = "counter"
+
+    def inc(self, *labels, amount:Union[int,float]=1):
+        """
+        Add `amount` to the value of the given label values.
+        """
+        shard = self._shard(labels)
+        if shard is not None:
+            shard[labels] = shard.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    """
+    A value which goes up and down, e.g. the number of requests in flight.
+    """
+    kind = "gauge"
+
+    def dec(self, *labels, amount:Union[int,float]=1):
+        """
+        Subtract `amount` from the value of the given label values.
+        """
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    """
+    The distribution of observed values, e.g. latencies, counted into fixed buckets.
+
+    :param buckets: The upper bounds of the buckets, in increasing order. A `+Inf` bucket is added.
+    """
+    kind = "histogram"
+
+    def __init__(self, registry:"MetricsRegistry", name:str, help:str, labelnames:Iterable[str]=(),
+                 buckets:Iterable[float]=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value:float, *labels):
+        """
+        Count `value` for the given label values.
+        """
+        shard = self._shard(labels)
+        if shard is None:
+            return
+        # The counts of every bucket (not cumulative) and of `+Inf`, then the sum of the values.
+        counts = shard.get(labels)
+        if counts is None:
+            counts = shard[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _merge(self, values:list) -> dict:
+        counts = [sum(column) for column in zip(*values)]
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return {"buckets": buckets, "sum": counts[-1], "count": cumulative}
+
+
+def _format_value(value:float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def _format_labels(labels:dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class MetricsRegistry():
+    """
+    A set of metrics, disabled until `enable` is called.
+    The metrics of `mytts` are in the process-wide `registry`.
+    """
+
+    def __init__(self, enabled:bool=False):
+        self.enabled = enabled
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name:str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(self, name, *args, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError(f"{name} is already a {metric.kind}")
+            return metric
+
+    def counter(self, name:str, help:str, labelnames:Iterable[str]=()) -> Counter:
+        """
+        Get the counter `name`, creating it if needed.
+        """
+        return self._register(Counter, name, help, labelnames)
+
+    def gauge(self, name:str, help:str, labelnames:Iterable[str]=()) -> Gauge:
+        """
+        Get the gauge `name`, creating it if needed.
+        """
+        return self._register(Gauge, name, help, labelnames)
+
+    def histogram(self, name:str, help:str, labelnames:Iterable[str]=(),
+                  buckets:Iterable[float]=DEFAULT_BUCKETS) -> Histogram:
+        """
+        Get the histogram `name`, creating it if needed.
+        """
+        return self._register(Histogram, name, help, labelnames, buckets)
+
+    def enable(self):
+        """
+        Start recording.
+        """
+        self.enabled = True
+
+    def disable(self):
+        """
+        Stop recording, the values recorded so far are kept.
+        """
+        self.enabled = False
+
+    def reset(self):
+        """
+        Forget every recorded value.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric._reset()
+
+    def snapshot(self) -> dict[str, dict]:
+        """
+        The current values of every metric, as
+        `{name: {"type": ..., "help": ..., "samples": [{"labels": {...}, "value": ...}]}}`.
+        The value of a histogram is `{"buckets": {upper bound: cumulative count}, "sum": ..., "count": ...}`.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: {"type": metric.kind, "help": metric.help, "samples": metric.samples()}
+                for metric in metrics}
+
+    def exposition(self) -> str:
+        """
+        The current values of every metric in the Prometheus text format.
+        """
+        lines = []
+        for name, metric in self.snapshot().items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for sample in metric["samples"]:
+                labels, value = sample["labels"], sample["value"]
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                for bound, count in value["buckets"].items():
+                    lines.append(f"{name}_bucket{_format_labels({**labels, 'le': _format_value(bound)})} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value['sum'])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path:str):
+        """
+        Write `exposition` into `path`, replacing it at once so that a reader never sees half of it.
+        """
+        temp = f"{path}.{os.getpid()}.tmp"
+        with open(temp, "w") as f:
+            f.write(self.exposition())
+        os.replace(temp, path)
+
+
+registry = MetricsRegistry()
+
+requests = registry.counter(
+    "mytts_requests_total", "Requests sent to the service, by method and outcome (success, cancelled or error code).",
+    ("method", "outcome"))
+syntheses = registry.counter(
+    "mytts_syntheses_total", "Synthesis results, by outcome (success, cancelled or error code).", ("outcome",))
+coalesced = registry.counter(
+    "mytts_coalesced_requests_total", "Requests which waited for an identical request in flight instead of being sent.")
+retries = registry.counter("mytts_retries_total", "Requests retried, by method.", ("method",))
+fallbacks = registry.counter(
+    "mytts_fallbacks_total", "Syntheses served by a backup method, by the method which served them.", ("method",))
+received_bytes = registry.counter("mytts_received_bytes_total", "Bytes of audio received, by method.", ("method",))
+in_flight = registry.gauge("mytts_requests_in_flight", "Requests currently sent to the service, by method.", ("method",))
+request_duration = registry.histogram(
+    "mytts_request_duration_seconds", "Duration of the successful requests once let through by the rate limiter, by method.", ("method",))
+time_to_first_byte = registry.histogram(
+    "mytts_time_to_first_byte_seconds", "Time to the first byte of audio once let through by the rate limiter, by method.", ("method",))
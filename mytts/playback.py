@@ -0,0 +1,208 @@
+import asyncio
+import shutil
+import weakref
+from io import BytesIO
+from typing import Optional
+
+from .formats import AudioFormat, parse_format
+from .runtime import _offload
+from .sinks import AudioSink
+
+_FFPLAY_RAW = {("pcm", 8): "u8", ("pcm", 16): "s16le", ("pcm", 24): "s24le", ("pcm", 32): "s32le",
+               ("mulaw", 8): "mulaw", ("alaw", 8): "alaw"}
+
+# Clips are played one after another: a sink waits for the speaker before it starts playing.
+_speakers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
+
+
+def _speaker() -> asyncio.Lock:
+    loop = asyncio.get_running_loop()
+    lock = _speakers.get(loop)
+    if lock is None:
+        lock = _speakers[loop] = asyncio.Lock()
+    return lock
+
+
+def _bytes_per_second(fmt: AudioFormat) -> int:
+    if fmt.bitrate:
+        return fmt.bitrate // 8
+    if fmt.bits and fmt.sample_rate:
+        return fmt.sample_rate * fmt.bits // 8
+    return 8000
+
+
+class _FFplayPlayer():
+    '''
+        Plays the audio by piping it into `ffplay`, which decodes it as it comes.
+    '''
+    def __init__(self, ffplay: str, fmt: AudioFormat):
+        self._args = [ffplay, "-nodisp", "-autoexit", "-loglevel", "quiet",
+                      "-probesize", "32", "-analyzeduration", "0", "-fflags", "nobuffer"]
+        raw = _FFPLAY_RAW.get((fmt.codec, fmt.bits or 8))
+        if fmt.container == "raw" and raw is not None:
+            self._args += ["-f", raw, "-ar", str(fmt.sample_rate), "-ac", "1"]
+        self._args += ["-i", "-"]
+        self._proc: Optional[asyncio.subprocess.Process] = None
+
+    async def start(self):
+        self._proc = await asyncio.create_subprocess_exec(
+            *self._args, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+
+    async def feed(self, data: bytes):
+        self._proc.stdin.write(data)  # type: ignore
+        await self._proc.stdin.drain()  # type: ignore
+
+    async def finish(self):
+        self._proc.stdin.close()  # type: ignore
+        await self._proc.wait()  # type: ignore
+
+    async def stop(self):
+        if self._proc.returncode is None:  # type: ignore
+            self._proc.kill()  # type: ignore
+        await self._proc.wait()  # type: ignore
+
+
+class _PyAudioPlayer():
+    '''
+        Plays PCM audio straight to the sound card with `pyaudio`, without decoding.
+    '''
+    def __init__(self, fmt: AudioFormat):
+        self._fmt = fmt
+        # A RIFF header is skipped, up to the start of the `data` chunk.
+        self._header: Optional[bytearray] = bytearray() if fmt.container == "riff" else None
+        self._pa = None
+        self._stream = None
+
+    def _open(self):
+        import pyaudio
+        self._pa = pyaudio.PyAudio()
+        self._stream = self._pa.open(format=self._pa.get_format_from_width(self._fmt.bits // 8),  # type: ignore
+                                     channels=1, rate=self._fmt.sample_rate, output=True)
+
+    async def start(self):
+        await _offload(self._open)
+
+    async def feed(self, data: bytes):
+        if self._header is not None:
+            self._header += data
+            index = self._header.find(b"data")
+            if index < 0 or len(self._header) < index + 8:
+                return
+            data = bytes(self._header[index + 8:])
+            self._header = None
+        # `write` blocks until the sound card has room, keep it out of the event loop.
+        await _offload(self._stream.write, bytes(data))  # type: ignore
+
+    def _close(self):
+        self._stream.stop_stream()  # type: ignore
+        self._stream.close()  # type: ignore
+        self._pa.terminate()  # type: ignore
+
+    async def finish(self):
+        await _offload(self._close)
+
+    async def stop(self):
+        # Stopping waits for the sound card to drain, keep it out of the event loop too.
+        await _offload(self._close)
+
+
+class _PydubPlayer():
+    '''
+        Plays the whole clip with `pydub` once it is downloaded, when nothing can play it progressively.
+    '''
+    def __init__(self):
+        self._data = bytearray()
+
+    async def start(self):
+        pass
+
+    async def feed(self, data: bytes):
+        self._data += data
+
+    def _play(self):
+        from pydub import AudioSegment as audio
+        from pydub.playback import play
+        play(audio.from_file(BytesIO(bytes(self._data))))
+
+    async def finish(self):
+        await _offload(self._play)
+
+    async def stop(self):
+        pass
+
+
+def _player(fmt: AudioFormat):
+    '''
+        The best way to play `fmt` here: `pyaudio` for PCM, else `ffplay`, else `pydub` at the end.
+    '''
+    if fmt.codec == "pcm" and fmt.container in ("raw", "riff") and fmt.bits:
+        try:
+            import pyaudio  # noqa: F401
+            return _PyAudioPlayer(fmt)
+        except ImportError:
+            pass
+    ffplay = shutil.which("ffplay")
+    if ffplay is not None:
+        return _FFplayPlayer(ffplay, fmt)
+    return _PydubPlayer()
+
+
+class SpeakerSink(AudioSink):
+    """
+    Plays the audio on the default speaker while it is downloaded.
+
+    Playback starts once `prebuffer` seconds of audio have arrived, which absorbs the jitter of the
+    network. PCM formats (`raw-*-pcm`, `riff-*-pcm`) go straight to the sound card if `pyaudio` is
+    installed; anything else is decoded on the fly by `ffplay`. Without either, the clip is played
+    with `pydub` once downloaded. Clips are played one after another, and closing the sink waits
+    for the end of the playback.
+
+    :param opt_fmt: The output format string of the audio.
+    :param prebuffer: Seconds of audio buffered before playback starts.
+    """
+
+    def __init__(self, opt_fmt: str, prebuffer: float = 0.1):
+        self._fmt = parse_format(opt_fmt)
+        self.prebuffer = prebuffer
+        self._threshold = max(1, int(prebuffer * _bytes_per_second(self._fmt)))
+        self._buffer = bytearray()
+        self._player = None
+        self._speaker: Optional[asyncio.Lock] = None
+
+    async def _start(self):
+        self._speaker = _speaker()
+        await self._speaker.acquire()
+        try:
+            player = _player(self._fmt)
+            await player.start()
+        except BaseException:
+            self._speaker.release()
+            raise
+        self._player = player
+        data, self._buffer = self._buffer, bytearray()
+        await player.feed(bytes(data))
+
+    async def write(self, chunk: bytes):
+        if self._player is not None:
+            await self._player.feed(bytes(chunk))
+            return
+        self._buffer += chunk
+        if len(self._buffer) >= self._threshold and not _speaker().locked():
+            await self._start()
+
+    async def close(self):
+        if self._player is None:
+            await self._start()
+        try:
+            await self._player.finish()  # type: ignore
+        finally:
+            self._speaker.release()  # type: ignore
+
+    async def abort(self):
+        if self._player is None:
+            return
+        try:
+            await self._player.stop()
+        finally:
+            self._speaker.release()  # type: ignore
@@ -0,0 +1,469 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from typing import Iterable, NamedTuple, Optional
+
+from .enums import CancellationErrorCode, CircuitState
+from .ssml import SSMLValidationError
+
+METHODS = (1, 2)
+"""
+The synthesis methods, in the order they are fallen back to.
+"""
+
+
+class BackendUnavailable(RuntimeError):
+    """
+    Raised when the circuits of every method a request may use are open.
+    """
+
+
+class ServiceStatusError(RuntimeError):
+    """
+    Raised when the service answers a request with an unexpected HTTP status.
+
+    :param status: The HTTP status code.
+    :param retry_after: Seconds the service asked us to wait before trying again, from `Retry-After`.
+    """
+
+    def __init__(self, status: int, message: str = "", retry_after: Optional[float] = None):
+        super().__init__(f"HTTP {status}: {message}" if message else f"HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    '''
+        Parse a `Retry-After` header, given either in seconds or as an HTTP date.
+    '''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+_STATUS_CODES = {
+    400: CancellationErrorCode.BadRequest,
+    429: CancellationErrorCode.TooManyRequests,
+    403: CancellationErrorCode.Forbidden,
+    500: CancellationErrorCode.ServiceError,
+    503: CancellationErrorCode.ServiceUnavailable,
+}
+
+
+def _status(exc: BaseException) -> tuple[Optional[int], Optional[float]]:
+    '''
+        The HTTP status and `Retry-After` of `exc`, if it is a rejected request or handshake.
+    '''
+    if isinstance(exc, ServiceStatusError):
+        return exc.status, exc.retry_after
+    from websockets.exceptions import InvalidHandshake, InvalidStatus
+    if isinstance(exc, InvalidStatus):
+        return exc.response.status_code, parse_retry_after(exc.response.headers.get("Retry-After"))
+    if isinstance(exc, InvalidHandshake) and hasattr(exc, "status_code"):
+        # `InvalidStatusCode` of the legacy client, which method 2 uses.
+        return exc.status_code, parse_retry_after(exc.headers.get("Retry-After"))
+    return None, None
+
+
+def error_code(exc: BaseException) -> CancellationErrorCode:
+    """
+    The `CancellationErrorCode` a synthesis failing with `exc` is reported with.
+    """
+    if isinstance(exc, (KeyboardInterrupt, asyncio.CancelledError)):
+        return CancellationErrorCode.NoError
+    from .tts import InvalidRequest
+    if isinstance(exc, (SSMLValidationError, InvalidRequest)):
+        return CancellationErrorCode.BadRequest
+    status, _ = _status(exc)
+    if status is not None:
+        return _STATUS_CODES.get(status, CancellationErrorCode.RuntimeError)
+    # `asyncio.TimeoutError` is only the builtin `TimeoutError` from Python 3.11 on.
+    if isinstance(exc, (TimeoutError, asyncio.TimeoutError)):
+        return CancellationErrorCode.ServiceTimeout
+    from websockets.exceptions import InvalidHandshake
+    import aiohttp
+    if isinstance(exc, (InvalidHandshake, aiohttp.ClientError, ConnectionError)):
+        return CancellationErrorCode.ConnectionFailure
+    # Other failures of the network, e.g. `socket.gaierror`. Those of a local file, e.g. of a `FileSink`, name it.
+    if isinstance(exc, OSError) and exc.filename is None:
+        return CancellationErrorCode.ConnectionFailure
+    if isinstance(exc, BackendUnavailable):
+        return CancellationErrorCode.ServiceUnavailable
+    return CancellationErrorCode.RuntimeError
+
+
+class RetryPolicy():
+    """
+    Decides whether and when a failed synthesis is tried again, see `SpeechConfig.retry_policy`.
+
+    A method is retried before falling back to the next one, but only while no audio has been
+    received. The delay before the `n`-th retry is `backoff * multiplier ** (n - 1)`, at most
+    `max_backoff`, of which a random part up to `jitter` is taken off so that many clients
+    failing together don't retry together. A `Retry-After` of the service is used instead when
+    there is one.
+
+    :param max_attempts: Attempts per method, including the first one. 1 disables retrying.
+    :param backoff: Seconds before the first retry.
+    :param multiplier: Growth of the delay from one retry to the next.
+    :param max_backoff: Maximum seconds between two attempts, `Retry-After` isn't capped.
+    :param jitter: Fraction of the delay which is randomized, between 0 (none) and 1 (full jitter).
+    :param budget: Maximum seconds spent waiting between attempts of a request in total.
+        No retry is made if its delay would exceed it.
+    :param retry_on: The `CancellationErrorCode`s of the errors worth retrying.
+    :param respect_retry_after: Wait as long as `Retry-After` tells.
+    """
+
+    def __init__(self, max_attempts: int = 3, backoff: float = 0.5, multiplier: float = 2.0,
+                 max_backoff: float = 8.0, jitter: float = 0.5, budget: float = 20.0,
+                 retry_on: Iterable[CancellationErrorCode] = (
+                     CancellationErrorCode.TooManyRequests,
+                     CancellationErrorCode.ServiceError,
+                     CancellationErrorCode.ServiceUnavailable,
+                     CancellationErrorCode.ServiceTimeout),
+                 respect_retry_after: bool = True):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        if not 0 <= jitter <= 1:
+            raise ValueError("jitter must be between 0 and 1")
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.budget = budget
+        self.retry_on = frozenset(retry_on)
+        self.respect_retry_after = respect_retry_after
+
+    def next_delay(self, attempt: int, exc: BaseException, waited: float = 0.0) -> Optional[float]:
+        """
+        Seconds to wait before trying again after the `attempt`-th attempt failed with `exc`,
+        or `None` if it shouldn't be tried again.
+
+        :param attempt: Attempts made so far, starting at 1.
+        :param waited: Seconds already waited for the request.
+        """
+        if attempt >= self.max_attempts or error_code(exc) not in self.retry_on:
+            return None
+        _, retry_after = _status(exc)
+        if retry_after is None or not self.respect_retry_after:
+            delay = min(self.max_backoff, self.backoff * self.multiplier ** (attempt - 1))
+            delay *= 1 - self.jitter * random.random()
+        else:
+            delay = retry_after
+        if waited + delay > self.budget:
+            return None
+        return delay
+
+    def __str__(self) -> str:
+        return f"<{self.__class__.__name__} max_attempts={self.max_attempts} budget={self.budget}>"
+
+
+class BackendStatus(NamedTuple):
+    """
+    A snapshot of the health of a synthesis method.
+    """
+    method: int
+    state: CircuitState
+    success_rate: float
+    """
+    Exponentially weighted success rate of the recent requests, between 0 and 1.
+    """
+    latency: Optional[float]
+    """
+    Exponentially weighted duration of the recent successful requests, in seconds.
+    """
+    successes: int
+    failures: int
+    consecutive_failures: int
+    retry_at: Optional[float]
+    """
+    When an open circuit becomes half-open, as a `time.monotonic()` value.
+    """
+
+
+class _Backend():
+    def __init__(self, method: int):
+        self.method = method
+        self.state = CircuitState.Closed
+        self.success_rate = 1.0
+        self.latency: Optional[float] = None
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.retry_at: Optional[float] = None
+        self.probing = False
+
+
+class BackendManager():
+    """
+    Tracks the health of the synthesis methods and decides which ones a request is sent to.
+
+    A method whose requests fail `failure_threshold` times in a row has its circuit opened:
+    requests go straight to the next method for `cooldown` seconds. Then a single probe
+    request is let through (half-open), which closes the circuit if it succeeds and opens
+    it again if it fails.
+
+    :param failure_threshold: Consecutive failures opening the circuit.
+    :param cooldown: Seconds a circuit stays open.
+    :param smoothing: Weight of the latest request in `success_rate` and `latency`.
+    """
+
+    def __init__(self, failure_threshold: int = 3, cooldown: float = 30.0, smoothing: float = 0.2):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self._lock = Lock()
+        self._backends = {method: _Backend(method) for method in METHODS}
+
+    def candidates(self, method: int) -> list[int]:
+        """
+        The methods a request preferring `method` may use, in order.
+        """
+        if method not in self._backends:
+            raise ValueError(f"Method must between 1 to {len(METHODS)}, but '{method}' got.")
+        return [m for m in METHODS if m >= method]
+
+    def acquire(self, method: int) -> bool:
+        """
+        Whether a request may be sent to `method` now.
+        If `True`, the outcome must be reported with `record_success`, `record_failure`, `record_error` or `release`.
+        """
+        with self._lock:
+            backend = self._backends[method]
+            if backend.state == CircuitState.Closed:
+                return True
+            if backend.state == CircuitState.Open:
+                if time.monotonic() < backend.retry_at:  # type: ignore
+                    return False
+                backend.state = CircuitState.HalfOpen
+            if backend.probing:
+                return False
+            backend.probing = True
+            return True
+
+    def release(self, method: int):
+        """
+        Report that a request ended without telling anything about the health of `method`,
+        e.g. it was cancelled or the request itself was invalid.
+        """
+        with self._lock:
+            self._backends[method].probing = False
+
+    def record_success(self, method: int, latency: float):
+        """
+        Report a successful request to `method` which took `latency` seconds.
+        """
+        with self._lock:
+            backend = self._backends[method]
+            backend.probing = False
+            backend.successes += 1
+            backend.consecutive_failures = 0
+            backend.success_rate += self.smoothing * (1 - backend.success_rate)
+            if backend.latency is None:
+                backend.latency = latency
+            else:
+                backend.latency += self.smoothing * (latency - backend.latency)
+            backend.state = CircuitState.Closed
+            backend.retry_at = None
+
+    def record_failure(self, method: int):
+        """
+        Report a failed request to `method`.
+        """
+        with self._lock:
+            backend = self._backends[method]
+            backend.probing = False
+            backend.failures += 1
+            backend.consecutive_failures += 1
+            backend.success_rate -= self.smoothing * backend.success_rate
+            if backend.state == CircuitState.HalfOpen or backend.consecutive_failures >= self.failure_threshold:
+                backend.state = CircuitState.Open
+                backend.retry_at = time.monotonic() + self.cooldown
+
+    def record_error(self, method: int, exc: BaseException):
+        """
+        Report a request to `method` which failed with `exc`. Being throttled (`TooManyRequests`) means
+        the method is up: it is left to the rate limiter, and doesn't count as a failure.
+        """
+        if error_code(exc) == CancellationErrorCode.TooManyRequests:
+            self.release(method)
+        else:
+            self.record_failure(method)
+
+    def status(self) -> dict[int, BackendStatus]:
+        """
+        The current health of every method.
+        """
+        with self._lock:
+            return {
+                method: BackendStatus(method, b.state, b.success_rate, b.latency,
+                                      b.successes, b.failures, b.consecutive_failures, b.retry_at)
+                for method, b in self._backends.items()
+            }
+
+    def reset(self):
+        """
+        Forget everything, closing every circuit.
+        """
+        with self._lock:
+            self._backends = {method: _Backend(method) for method in METHODS}
+
+
+backends = BackendManager()
+"""
+The `BackendManager` used by every synthesizer of the process.
+"""
+
+
+class RateLimiter():
+    """
+    Token bucket smoothing the requests sent to a synthesis method, shared by every event loop of the process.
+
+    A request takes a token, tokens come back at `requests_per_second` up to `burst`, and at most
+    `max_concurrent` requests are running at once. Use it as `async with limiter:` around a request.
+    By default there is no limit at all.
+
+    The rate adapts to the service: each `TooManyRequests` halves it (at most once a second, so a
+    burst of them counts once), and each success gives back `recovery` of the configured rate,
+    so it comes back slowly.
+
+    :param requests_per_second: Rate of the requests, `None` for no limit.
+    :param burst: Requests which may be sent at once after a quiet period, by default one second worth.
+    :param max_concurrent: Maximum number of running requests, `None` for no limit.
+    :param min_rate: The rate is never lowered below this.
+    :param recovery: Fraction of `requests_per_second` regained by each successful request.
+    """
+
+    def __init__(self, requests_per_second: Optional[float] = None, burst: Optional[int] = None,
+                 max_concurrent: Optional[int] = None, min_rate: float = 0.5, recovery: float = 0.05):
+        self.requests_per_second = requests_per_second
+        self.burst = burst if burst is not None else max(1, int(requests_per_second or 1))
+        self.max_concurrent = max_concurrent
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self._lock = Lock()
+        self._rate = requests_per_second
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._throttled_at = float("-inf")
+        self._active = 0
+        self._waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    @property
+    def rate(self) -> Optional[float]:
+        """
+        The current rate, lowered from `requests_per_second` while the service throttles us.
+        """
+        return self._rate
+
+    @property
+    def active(self) -> int:
+        """
+        Number of running requests.
+        """
+        return self._active
+
+    def _refill(self, now: float):
+        if self._rate is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    async def acquire(self):
+        """
+        Wait until a request may be sent. Must be followed by `release`.
+        """
+        while True:
+            future = None
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.max_concurrent is not None and self._active >= self.max_concurrent:
+                    loop = asyncio.get_running_loop()
+                    future = loop.create_future()
+                    self._waiters.append((loop, future))
+                elif self._rate is None or self._tokens >= 1:
+                    if self._rate is not None:
+                        self._tokens -= 1
+                    self._active += 1
+                    return
+                else:
+                    delay = (1 - self._tokens) / self._rate
+            if future is None:
+                await asyncio.sleep(delay)
+                continue
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self._lock:
+                    if (loop, future) in self._waiters:
+                        self._waiters.remove((loop, future))
+                    else:
+                        # We were woken up already, pass it on.
+                        self._wake()
+                raise
+
+    def release(self):
+        """
+        Report that a request is over.
+        """
+        with self._lock:
+            self._active -= 1
+            self._wake()
+
+    def _wake(self):
+        if self._waiters:
+            loop, future = self._waiters.pop(0)
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+    def throttle(self):
+        """
+        Report that the service answered `TooManyRequests`, lowering the rate.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._rate is None or now - self._throttled_at < 1:
+                return
+            self._throttled_at = now
+            self._refill(now)
+            self._rate = max(self.min_rate, self._rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+
+    def recover(self):
+        """
+        Report a successful request, raising the rate back towards `requests_per_second`.
+        """
+        with self._lock:
+            if self._rate is None or self.requests_per_second is None:
+                return
+            self._refill(time.monotonic())
+            self._rate = min(self.requests_per_second, self._rate + self.requests_per_second * self.recovery)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+        if exc is None:
+            self.recover()
+        elif error_code(exc) == CancellationErrorCode.TooManyRequests:
+            self.throttle()
+
+    def __str__(self) -> str:
+        return f"<{self.__class__.__name__} rate={self._rate} active={self._active}>"
+
+
+rate_limiters = {method: RateLimiter() for method in METHODS}
+"""
+The `RateLimiter` of each method, used by every synthesizer of the process. They don't limit anything
+until one is replaced, e.g. `rate_limiters[1] = RateLimiter(requests_per_second=10, max_concurrent=16)`.
+"""
@@ -0,0 +1,223 @@
+import asyncio
+import atexit
+import concurrent.futures
+from functools import partial
+from threading import Lock, Thread, current_thread
+from typing import Any, Callable, Coroutine, Optional
+
+
+class SynthesisRuntime():
+    """
+    An event loop running in an I/O thread of its own, which `SpeechSynthesizer` submits its syntheses to.
+
+    It is safe to submit from any number of threads, and a runtime can be shared by several
+    synthesizers, which then share its connection pools too. The thread is started by the first
+    submission and keeps running until `shutdown`. It is a daemon thread, the default runtime is
+    shut down (waiting for the running syntheses) when the interpreter exits.
+
+    :param name: Name of the I/O thread.
+    """
+
+    def __init__(self, name: str = "mytts-runtime"):
+        self._name = name
+        self._lock = Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[Thread] = None
+        self._closed = False
+        self._pending: set = set()
+        self._statuses = 0
+        self._status: Any = None
+
+    @property
+    def loop(self) -> Optional[asyncio.AbstractEventLoop]:
+        """
+        The event loop, `None` if the runtime hasn't started.
+        """
+        return self._loop
+
+    def _start(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._thread = Thread(target=self._run, args=(self._loop,), name=self._name, daemon=True)
+            self._thread.start()
+        return self._loop
+
+    @staticmethod
+    def _run(loop: asyncio.AbstractEventLoop):
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
+
+    def submit(self, coro: Coroutine, status: bool = False) -> concurrent.futures.Future:
+        """
+        Run `coro` in the event loop.
+
+        :param status: Show a status while the synthesis is running.
+            Powered by `rich.status`, if you use any of `rich.status` or `rich.progress`, you should set
+            this to `False`
+        :raises RuntimeError: If the runtime has been shut down.
+        :returns: A future of the result of `coro`.
+        """
+        with self._lock:
+            if self._closed:
+                coro.close()
+                raise RuntimeError("The runtime has been shut down.")
+            future = asyncio.run_coroutine_threadsafe(coro, self._start())
+            self._pending.add(future)
+            if status:
+                self._statuses += 1
+                if self._statuses == 1:
+                    self._show_status()
+        future.add_done_callback(lambda f: self._done(f, status))
+        return future
+
+    def _done(self, future: concurrent.futures.Future, status: bool):
+        with self._lock:
+            self._pending.discard(future)
+            if status:
+                self._statuses -= 1
+                if self._statuses == 0 and self._status is not None:
+                    self._status.stop()
+                    self._status = None
+
+    def _show_status(self):
+        try:
+            from rich.status import Status
+            self._status = Status("TTS downloading...")
+            self._status.start()
+        except Exception:
+            self._status = None
+
+    async def _close(self, cancel: bool):
+        from .tts import _close_connections
+        pending = list(self._pending)
+        if cancel:
+            for future in pending:
+                future.cancel()
+        await asyncio.gather(*(asyncio.wrap_future(future) for future in pending), return_exceptions=True)
+        await _close_connections()
+        asyncio.get_running_loop().stop()
+
+    def shutdown(self, wait: bool = True, cancel: bool = False):
+        """
+        Stop the runtime once the running syntheses are done, and close its connections.
+        Submitting afterwards raises `RuntimeError`.
+
+        :param wait: Block until the I/O thread has finished.
+        :param cancel: Cancel the running syntheses instead of waiting for them.
+        """
+        with self._lock:
+            first = not self._closed
+            self._closed = True
+            loop, thread = self._loop, self._thread
+        if loop is None:
+            return
+        if first:
+            asyncio.run_coroutine_threadsafe(self._close(cancel), loop)
+        if wait and thread is not current_thread():
+            thread.join()  # type: ignore
+
+    def __str__(self) -> str:
+        return f"<{self.__class__.__name__} started={self._loop is not None} closed={self._closed} pending={len(self._pending)}>"
+
+
+_default: Optional[SynthesisRuntime] = None
+_default_lock = Lock()
+
+
+def default_runtime() -> SynthesisRuntime:
+    """
+    The runtime shared by the synthesizers which aren't given one.
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = SynthesisRuntime()
+            atexit.register(_default.shutdown)
+        return _default
+
+
+BLOCKING_WORKERS: Optional[int] = None
+"""
+Threads of the default blocking executor, `None` for the default of `ThreadPoolExecutor`.
+"""
+
+_blocking: Optional[concurrent.futures.Executor] = None
+_decode: Optional[concurrent.futures.Executor] = None
+_executors_lock = Lock()
+
+
+def blocking_executor() -> concurrent.futures.Executor:
+    """
+    The executor running the blocking work, so that the event loops only do network I/O:
+    output handles, file writes, stream callbacks and playback.
+    Unless another one is set with `set_blocking_executor`, it is a thread pool of `BLOCKING_WORKERS` threads.
+    """
+    global _blocking
+    with _executors_lock:
+        if _blocking is None:
+            _blocking = concurrent.futures.ThreadPoolExecutor(BLOCKING_WORKERS, thread_name_prefix="mytts-blocking")
+        return _blocking
+
+
+def set_blocking_executor(executor: Optional[concurrent.futures.Executor]):
+    """
+    Run the blocking work in `executor`, which must be a thread pool as the work isn't picklable.
+    `None` goes back to the default one. The previous executor isn't shut down.
+    """
+    global _blocking
+    with _executors_lock:
+        _blocking = executor
+
+
+def decode_executor() -> concurrent.futures.Executor:
+    """
+    The executor decoding and re-encoding audio, the blocking executor unless another one is set
+    with `set_decode_executor`.
+    """
+    return _decode if _decode is not None else blocking_executor()
+
+
+def set_decode_executor(executor: Optional[concurrent.futures.Executor]):
+    """
+    Decode and re-encode audio in `executor`, e.g. a `ProcessPoolExecutor` so that decoding doesn't hold
+    the GIL of the event loops. `None` goes back to the blocking executor. The previous executor isn't shut down.
+    """
+    global _decode
+    with _executors_lock:
+        _decode = executor
+
+
+def _submit_blocking(fn: Callable, *args) -> concurrent.futures.Future:
+    '''
+        Run `fn(*args)` in the blocking executor.
+
+        When the interpreter exits, the thread pools are shut down before the default runtime finishes
+        its syntheses, whose blocking work then runs in the calling thread instead.
+    '''
+    try:
+        return blocking_executor().submit(fn, *args)
+    except RuntimeError:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+async def _offload(fn: Callable, *args) -> Any:
+    '''
+        Run `fn(*args)` in the blocking executor, out of the running event loop.
+    '''
+    return await asyncio.wrap_future(_submit_blocking(fn, *args))
+
+
+async def _offload_decode(fn: Callable, *args) -> Any:
+    '''
+        Run `fn(*args)` in the decode executor, `fn` and `args` must be picklable.
+    '''
+    return await asyncio.get_running_loop().run_in_executor(decode_executor(), partial(fn, *args))
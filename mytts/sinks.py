@@ -0,0 +1,489 @@
+import asyncio
+import os
+import uuid
+from collections import deque
+from threading import Condition
+from typing import Optional, Union
+
+from .runtime import _offload
+
+
+class AudioSink():
+    """
+    Receives the audio of a synthesis chunk by chunk, as it arrives from the service.
+
+    `write` is called for every chunk, then `close` once the synthesis is complete,
+    or `abort` if it failed or was cancelled. A sink is used for a single synthesis.
+    """
+
+    retain = True
+    """
+    Whether the result keeps a copy of the audio. If `False`, `SpeechSynthesisResult.audio_data`
+    is taken from `getvalue` when asked, so a long clip isn't held in memory.
+    """
+
+    async def write(self, chunk: bytes):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    async def abort(self):
+        pass
+
+    def getvalue(self) -> Optional[bytes]:
+        """
+        The whole audio once the sink is closed, or `None` if the sink can't give it back.
+        """
+        return None
+
+
+def _identity(stat: os.stat_result) -> tuple:
+    '''
+        What tells a file apart from another one written at the same place.
+    '''
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class FileSink(AudioSink):
+    """
+    Writes the audio into a file as it arrives.
+
+    The audio goes into a temporary file next to `filename`, which is renamed to `filename` once the
+    synthesis is complete, so `filename` is never left half written. The temporary file is removed
+    if the synthesis fails or is cancelled.
+
+    :param filename: The audio file. Its parent directory must already exist.
+    :param buffer_size: Bytes buffered before they are written to the file.
+    :param fsync: When the file is synced to the disk: `"never"` (leave it to the OS),
+        `"close"` (once, before the rename) or `"always"` (after every chunk, then before the rename).
+
+    The file is written in the blocking executor (see `runtime.blocking_executor`), a buffer at a time.
+    The audio isn't kept in memory: `getvalue` reads it back from `filename`, as long as the file is still
+    the one written by this sink.
+    """
+
+    retain = False
+
+    def __init__(self, filename: str, buffer_size: int = 64 * 1024, fsync: str = "never"):
+        if fsync not in ("never", "close", "always"):
+            raise ValueError('fsync must be "never", "close" or "always"')
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self._tmp = "%s.%s.part" % (filename, uuid.uuid4().hex[:8])
+        self._file = None
+        self._buffer = bytearray()
+        self._written: Optional[tuple] = None
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self._tmp, "wb", buffering=self.buffer_size)
+        return self._file
+
+    def _write(self, chunk: bytes):
+        f = self._open()
+        f.write(chunk)
+        if self.fsync == "always":
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _close(self):
+        f = self._open()
+        try:
+            f.flush()
+            if self.fsync != "never":
+                os.fsync(f.fileno())
+            f.close()
+            os.replace(self._tmp, self.filename)
+            self._written = _identity(os.stat(self.filename))
+        except BaseException:
+            self._abort()
+            raise
+
+    def _abort(self):
+        if self._file is not None:
+            self._file.close()
+        try:
+            os.remove(self._tmp)
+        except OSError:
+            pass
+
+    def _take(self) -> bytes:
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+    def _write_and_close(self, data: bytes):
+        try:
+            self._write(data)
+        except BaseException:
+            self._abort()
+            raise
+        self._close()
+
+    async def write(self, chunk: bytes):
+        self._buffer += chunk
+        if len(self._buffer) >= self.buffer_size or self.fsync == "always":
+            await _offload(self._write, self._take())
+
+    async def close(self):
+        await _offload(self._write_and_close, self._take())
+
+    async def abort(self):
+        self._buffer.clear()
+        await _offload(self._abort)
+
+    def getvalue(self) -> Optional[bytes]:
+        """
+        The audio read back from `filename`, or `None` if the synthesis didn't complete, or if the file has
+        been moved, removed or overwritten since (e.g. by a later synthesis into the same file).
+        """
+        if self._written is None:
+            return None
+        try:
+            with open(self.filename, "rb") as f:
+                if _identity(os.fstat(f.fileno())) != self._written:
+                    return None
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def __str__(self) -> str:
+        return f"<{self.__class__.__name__} {self.filename}>"
+
+
+def write_file(filename: str, data: bytes, buffer_size: int = 64 * 1024, fsync: str = "never"):
+    '''
+        Write the whole `data` into `filename` at once, through a temporary file like `FileSink`.
+    '''
+    FileSink(filename, buffer_size, fsync)._write_and_close(data)
+
+
+class AudioOutputStream(AudioSink):
+    """
+    Base class for Output Streams
+    """
+
+    retain = False
+
+    def _sink(self) -> AudioSink:
+        '''
+            The sink of one synthesis into the stream.
+        '''
+        return self
+
+    def _write_all(self, data: bytes):
+        '''
+            Hand the whole audio of a synthesis at once. This is the handle of the `AudioOutputConfig`,
+            so it is called in the blocking executor, like `write`.
+        '''
+        raise NotImplementedError
+
+
+class _PullSynthesis(AudioSink):
+    '''
+        The audio of one synthesis into a `PullAudioOutputStream`, buffered until it is read.
+    '''
+
+    retain = False
+
+    def __init__(self, stream: "PullAudioOutputStream"):
+        self._stream = stream
+        self.buffer = bytearray()
+        self.ended = False
+        # The writers waiting for room in the buffer, as (loop, future).
+        self.waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    async def write(self, chunk: bytes):
+        await self._stream._put(self, chunk)
+
+    async def close(self):
+        self._stream._end(self)
+
+    async def abort(self):
+        self._stream._end(self)
+
+
+class PullAudioOutputStream(AudioOutputStream):
+    """
+    An output stream the audio is read from, e.g. `AudioOutputConfig(stream=PullAudioOutputStream())`.
+
+    The audio of a synthesis goes through a buffer of at most `buffer_size` bytes: `read` blocks
+    until audio is available, and the synthesis waits for `read` while the buffer is full, so a
+    slow reader slows down the download instead of piling the clip up in memory.
+    The audio isn't kept in `SpeechSynthesisResult.audio_data`.
+
+    The stream can be used for several syntheses, one after the other or at the same time. Their audio
+    is read in the order they were started, each one followed by an empty read; a synthesis started
+    while another one is being read waits until its own `buffer_size` bytes are filled.
+
+    :param buffer_size: Maximum bytes buffered between a synthesis and the reader.
+    """
+
+    def __init__(self, buffer_size: int = 256 * 1024):
+        if buffer_size < 1:
+            raise ValueError("buffer_size must be at least 1")
+        self.buffer_size = buffer_size
+        self._cond = Condition()
+        self._syntheses: deque[_PullSynthesis] = deque()
+        self._closed = False
+
+    def _sink(self) -> _PullSynthesis:
+        synthesis = _PullSynthesis(self)
+        with self._cond:
+            if not self._closed:
+                self._syntheses.append(synthesis)
+        return synthesis
+
+    async def _put(self, synthesis: _PullSynthesis, chunk: bytes):
+        view = memoryview(chunk)
+        while len(view):
+            with self._cond:
+                if self._closed:
+                    return
+                room = self.buffer_size - len(synthesis.buffer)
+                if room > 0:
+                    synthesis.buffer += view[:room]
+                    view = view[room:]
+                    self._cond.notify_all()
+                    continue
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                synthesis.waiters.append((loop, future))
+            await future
+
+    @staticmethod
+    def _wake_writers(synthesis: _PullSynthesis):
+        for loop, future in synthesis.waiters:
+            loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+        synthesis.waiters.clear()
+
+    def _end(self, synthesis: _PullSynthesis):
+        with self._cond:
+            synthesis.ended = True
+            self._cond.notify_all()
+
+    async def write(self, chunk: bytes):
+        await self._put(self._current(), chunk)
+
+    async def close(self):
+        self._end(self._current())
+
+    async def abort(self):
+        self._end(self._current())
+
+    def _current(self) -> _PullSynthesis:
+        '''
+            The synthesis written when the stream itself is used as a sink: the last one not ended.
+        '''
+        with self._cond:
+            if self._syntheses and not self._syntheses[-1].ended:
+                return self._syntheses[-1]
+        return self._sink()
+
+    def _write_all(self, data: bytes):
+        synthesis = self._sink()
+        with self._cond:
+            synthesis.buffer += data
+        self._end(synthesis)
+
+    def read(self, audio_buffer: Union[int, bytearray, memoryview] = -1) -> Union[bytes, int]:
+        """
+        Read the audio, blocking until some is available.
+
+        Like the Speech SDK, `audio_buffer` may be a writable buffer, which is filled with at most its
+        size and the number of bytes read is returned. Otherwise it is the maximum number of bytes to read
+        (all that is buffered if negative) and the audio itself is returned.
+
+        :returns: The audio or its size, which are empty once a synthesis has ended and all its audio has been
+            read. Then the next read goes on with the next synthesis.
+        """
+        into = None if isinstance(audio_buffer, int) else memoryview(audio_buffer).cast("B")
+        size = audio_buffer if into is None else len(into)
+        with self._cond:
+            while True:
+                if self._closed:
+                    data = b""
+                    break
+                synthesis = self._syntheses[0] if self._syntheses else None
+                if synthesis is not None and synthesis.buffer:
+                    if size < 0:  # type: ignore
+                        size = len(synthesis.buffer)
+                    data = bytes(synthesis.buffer[:size])
+                    del synthesis.buffer[:size]
+                    self._wake_writers(synthesis)
+                    break
+                if synthesis is not None and synthesis.ended:
+                    self._syntheses.popleft()
+                    data = b""
+                    break
+                self._cond.wait()
+        if into is None:
+            return data
+        into[:len(data)] = data
+        return len(data)
+
+    def close_reader(self):
+        """
+        Stop reading: the rest of the audio is dropped and the syntheses don't wait anymore.
+        """
+        with self._cond:
+            self._closed = True
+            for synthesis in self._syntheses:
+                synthesis.buffer.clear()
+                self._wake_writers(synthesis)
+            self._syntheses.clear()
+            self._cond.notify_all()
+
+
+class PushAudioOutputStreamCallback():
+    """
+    Receives the audio of a `PushAudioOutputStream`, override `write` and `close`.
+    """
+
+    def write(self, audio_buffer: memoryview) -> int:
+        """
+        Called with every chunk of audio as it arrives, in the blocking executor (see
+        `runtime.blocking_executor`), one chunk after another. It may block: the synthesis waits for it.
+        The buffer is only valid during the call.
+
+        :returns: The number of bytes taken.
+        """
+        return len(audio_buffer)
+
+    def close(self):
+        """
+        Called once the stream is closed with `PushAudioOutputStream.close` and the synthesis being pushed
+        has ended, whether it was complete or not.
+        """
+
+
+class _PushSynthesis(AudioSink):
+    '''
+        The audio of one synthesis into a `PushAudioOutputStream`.
+    '''
+
+    retain = False
+
+    def __init__(self, stream: "PushAudioOutputStream"):
+        self._stream = stream
+
+    async def write(self, chunk: bytes):
+        await self._stream._write(self, chunk)
+
+    async def close(self):
+        await self._stream._end(self)
+
+    async def abort(self):
+        await self._stream._end(self)
+
+
+class PushAudioOutputStream(AudioOutputStream):
+    """
+    An output stream pushing the audio to `stream_callback` as it arrives,
+    e.g. `AudioOutputConfig(stream=PushAudioOutputStream(callback))`.
+    The audio isn't kept in `SpeechSynthesisResult.audio_data`.
+
+    The stream can be used for several syntheses, one after the other or at the same time. The audio of a synthesis
+    is pushed in one piece: a synthesis whose audio arrives while another one is being pushed waits until that one
+    has ended. `stream_callback.close` is only called once, after `close`.
+
+    :param stream_callback: A `PushAudioOutputStreamCallback`.
+    """
+
+    def __init__(self, stream_callback: PushAudioOutputStreamCallback):
+        self._callback = stream_callback
+        self._cond = Condition()
+        # The synthesis being pushed, and the syntheses waiting for it as (loop, future).
+        self._pushing: Optional[_PushSynthesis] = None
+        self._waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self._closed = False
+        self._callback_closed = False
+
+    def _sink(self) -> _PushSynthesis:
+        return _PushSynthesis(self)
+
+    def _take_turn(self, synthesis: _PushSynthesis) -> Optional[bool]:
+        '''
+            Make `synthesis` the one being pushed, if no other one is. Must be called with `_cond` held.
+
+            :returns: Whether `synthesis` is pushed, `None` if it must wait.
+        '''
+        if self._pushing is None and not self._closed:
+            self._pushing = synthesis
+        if self._pushing is synthesis:
+            return True
+        return False if self._closed else None
+
+    def _close_callback(self) -> bool:
+        '''
+            Whether `stream_callback.close` must be called now. Must be called with `_cond` held.
+        '''
+        if self._closed and self._pushing is None and not self._callback_closed:
+            self._callback_closed = True
+            return True
+        return False
+
+    def _wake(self):
+        for loop, future in self._waiters:
+            loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+        self._waiters.clear()
+        self._cond.notify_all()
+
+    async def _write(self, synthesis: _PushSynthesis, chunk: bytes):
+        while True:
+            with self._cond:
+                turn = self._take_turn(synthesis)
+                if turn is None:
+                    loop = asyncio.get_running_loop()
+                    future = loop.create_future()
+                    self._waiters.append((loop, future))
+            if turn is not None:
+                break
+            await future
+        if turn:
+            # The callback may block, keep it out of the event loop.
+            await _offload(self._callback.write, memoryview(chunk))
+
+    def _release(self, synthesis: _PushSynthesis) -> bool:
+        '''
+            `synthesis` has ended, let the next one be pushed.
+
+            :returns: Whether `stream_callback.close` must be called now.
+        '''
+        with self._cond:
+            if self._pushing is not synthesis:
+                return False
+            self._pushing = None
+            self._wake()
+            return self._close_callback()
+
+    async def _end(self, synthesis: _PushSynthesis):
+        if self._release(synthesis):
+            await _offload(self._callback.close)
+
+    def _write_all(self, data: bytes):
+        synthesis = self._sink()
+        with self._cond:
+            while (turn := self._take_turn(synthesis)) is None:
+                self._cond.wait()
+        if not turn:
+            return
+        try:
+            self._callback.write(memoryview(data))
+        finally:
+            if self._release(synthesis):
+                self._callback.close()
+
+    def close(self):  # type: ignore
+        """
+        Close the stream: `stream_callback.close` is called once the synthesis being pushed has ended, or at once if
+        there is none. The audio of the syntheses which haven't been pushed yet is dropped.
+        """
+        with self._cond:
+            self._closed = True
+            self._wake()
+            close = self._close_callback()
+        if close:
+            self._callback.close()
@@ -1,67 +1,81 @@
-from typing import Any, Callable, NoReturn, Optional, Union
+from typing import Any, Callable, Iterable, Iterator, NamedTuple, NoReturn, Optional, Union
 from .enums import (SpeechSynthesisOutputFormat, ResultReason,
                    CancellationReason, CancellationErrorCode,
                    _SpeechSynthesisOutputFormat)
-from xml.sax.saxutils import escape
-from .tts import implete
+from html import escape
+from .tts import implete, implete_stream, _close_connections, _concat, _RequestInfo
+from . import metrics
+from .policy import RetryPolicy, error_code, _status
+from .cache import SynthesisCache
+from .formats import _decoded_duration, probe_duration
+from .ssml import SSMLValidationError, is_ssml, split_text, validate_ssml
+from .runtime import SynthesisRuntime, _offload, _offload_decode, _submit_blocking, decode_executor, default_runtime
+from .playback import SpeakerSink
+from .sinks import AudioSink, FileSink, write_file, AudioOutputStream
 import asyncio
-from threading import Thread
-from pydub import AudioSegment as audio
-from pydub.playback import play
+import concurrent.futures
+import uuid
+from queue import Queue
+from threading import Semaphore
 from io import BytesIO
 from datetime import timedelta
-from websockets.exceptions import InvalidStatus,InvalidHandshake
-try:
-    from rich.status import Status
-    from rich import print
-    RICH = True
-except ImportError:
-    from traceback import format_exception
-    RICH = False
-
-event_loop = asyncio.new_event_loop()
-waiting = False
-def _waiter(status=True,debug=False):
+
+def _print(*objects):
     '''
         Inside method.
 
-        Start synthesising if `SpeechSynthesizer.speak_ssml_async` or `SpeechSynthesizer.speak_text_async`
-        is called.
+        Print with `rich` if it is available.
+    '''
+    try:
+        from rich import print as rich_print
+    except ImportError:
+        rich_print = print
+    rich_print(*objects)
 
-        :param status: Show a status when any synthesis is running.
-            Powered by `rich.status`, if you use any of `rich.status` or `rich.progress`, you should set
-            this to `False`
-        
-        If you find your synthesis doesn't work after you call `SpeechSynthesizer.speak_ssml_async`
-        or `SpeechSynthesizer.speak_text_async`, you can try to run this in your own code.
-        But if you do so, call `asyncio.get_event_loop().close()` when your program is finished,
-        otherwise your program will be blocked from exiting.
+def _iterate_in_background(aiterable, status:bool, runtime:Optional[SynthesisRuntime], maxsize:int=8) -> Iterator:
     '''
-    global waiting,event_loop
-    waiting = True
-    def __wait(loop):
-        global waiting,event_loop
-        if debug:
-            print("[cyan]start waiting[/]")
-        if status and RICH:
-            try:
-                with Status("TTS downloading..."):
-                    loop.run_forever()
-            except Exception:
-                loop.run_forever()
-        else:
-            loop.run_forever()
-        waiting = False
-        event_loop = asyncio.new_event_loop()
-        if debug:
-            print("done")
-    Thread(target=__wait, args=(event_loop,)).start()
-    
+        Inside method.
 
-class AudioOutputStream():
-    """
-    Base class for Output Streams
-    """
+        Iterate over an async iterable in the event loop of `runtime` (the default one if `None`),
+        handing the items to the calling thread as soon as they are produced. At most `maxsize` items
+        wait for the calling thread, and the iteration is cancelled if the calling thread stops early.
+    '''
+    items:Queue = Queue()
+    credits = Semaphore(maxsize)
+    end = object()
+    wake:Optional[Callable[[],Any]] = None
+    async def pump():
+        nonlocal wake
+        space = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        wake = lambda: loop.call_soon_threadsafe(space.set)
+        iterator = aiterable.__aiter__()
+        try:
+            async for item in iterator:
+                while not credits.acquire(blocking=False):
+                    space.clear()
+                    if credits.acquire(blocking=False):
+                        break
+                    await space.wait()
+                items.put(item)
+        except BaseException as e:
+            items.put(e)
+            raise
+        finally:
+            items.put(end)
+            # Cancelled while waiting for space, the iterator is suspended: stop it now rather than when it is collected.
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+    future = (runtime or default_runtime()).submit(pump(),status)
+    try:
+        while (item := items.get()) is not end:
+            if isinstance(item, BaseException):
+                raise item
+            credits.release()
+            wake()  # type: ignore
+            yield item
+    finally:
+        future.cancel()
 
 
 class AutoDetectSourceLanguageConfig:
@@ -73,45 +87,259 @@ class ResultFuture():
     The result of an asynchronous operation.
     """
 
-    def __init__(self, task:asyncio.Task,handle:Callable[[bytes],Any],status:bool,debug:bool):
+    def __init__(self, coro,handle:Callable[[bytes],Any],status:bool,debug:bool,opt_fmt:Optional[str]=None,
+                 info:Optional[_RequestInfo]=None,runtime:Optional[SynthesisRuntime]=None):
         """
         private constructor
         """
-        self._task = task
         self._handle = handle
-        self._task.add_done_callback(self._callback)
-        if not waiting:
-            _waiter(status,debug)
-
-    def _callback(self,future:asyncio.Future):
-        if len(asyncio.all_tasks())==0:
-            event_loop.stop()
+        self._opt_fmt = opt_fmt
+        self._info = info
+        self._future:concurrent.futures.Future = concurrent.futures.Future()
+        self._task:Optional[concurrent.futures.Future] = None
+        if coro is not None:
+            self._task = (runtime or default_runtime()).submit(coro,status)
+            self._task.add_done_callback(self._callback)
+
+    @classmethod
+    def _completed(cls, ret:Optional[tuple[str,bytes]], handle:Callable[[bytes],Any], opt_fmt:Optional[str]=None,
+                   exc:Optional[BaseException]=None) -> "ResultFuture":
+        """
+        Create a future which is already done, e.g. for a request failing before it is sent.
+        """
+        future = cls(None,handle,False,False,opt_fmt)
+        future._resolve(ret,exc)
+        return future
+
+    def _callback(self,future:concurrent.futures.Future):
+        if future.cancelled():
+            ret, exc = None, asyncio.CancelledError()
+        else:
+            exc = future.exception()
+            ret = future.result() if exc is None else None
+        if ret is None:
+            self._resolve(ret,exc)
+        else:
+            # This runs in the event loop of the runtime, which the handle (e.g. playing) must not block.
+            _submit_blocking(self._resolve,ret,exc)
 
-        exc = future.exception()
-        if exc is None:
-            _,b = future.result()
-            self._handle(b)
+    def _resolve(self, ret:Optional[tuple[str,bytes]], exc:Optional[BaseException]):
+        try:
+            result = SpeechSynthesisResult(ret,exc,self._opt_fmt,self._info)
+            if ret is not None:
+                self._handle(ret[1])
+                if self._info is not None and self._info.handle_done is None:
+                    self._info.mark("handle_done")
+        except Exception as e:
+            self._future.set_exception(e)
+        else:
+            self._future.set_result(result)
 
-    async def _get(self):
-        while not self._task.done():
-            await asyncio.sleep(1)
-    def get(self):
+    def get(self, timeout:Optional[float]=None) -> "SpeechSynthesisResult":
         """
         Waits until the result is available, and returns it.
+
+        :param timeout: Seconds to wait at most. Wait forever if `None`.
+        :raises concurrent.futures.TimeoutError: If the result isn't available within `timeout`.
+        """
+        return self._future.result(timeout)
+
+    def done(self) -> bool:
+        """
+        Whether the synthesis has finished and its audio has been handled.
+        """
+        return self._future.done()
+
+    def add_done_callback(self, fn:Callable[["ResultFuture"],Any]):
+        """
+        Call `fn` with this future once it is done.
+        If it is already done, `fn` is called immediately.
+        """
+        self._future.add_done_callback(lambda _: fn(self))
+
+    def __str__(self) -> str:
+        return f"<{self.__class__.__name__} done={self.done()}>"
+
+
+def wait_all(futures:Iterable[ResultFuture], timeout:Optional[float]=None) -> list["SpeechSynthesisResult"]:
+    """
+    Waits until all the futures are done.
+
+    :param timeout: Seconds to wait at most. Wait forever if `None`.
+    :raises concurrent.futures.TimeoutError: If not all of the results are available within `timeout`.
+    :returns: The results, in the same order as `futures`.
+    """
+    futures = list(futures)
+    _, not_done = concurrent.futures.wait([f._future for f in futures], timeout)
+    if not_done:
+        raise concurrent.futures.TimeoutError(f"{len(not_done)} of {len(futures)} syntheses are not done")
+    return [f.get() for f in futures]
+
+
+def as_completed(futures:Iterable[ResultFuture], timeout:Optional[float]=None) -> Iterator[ResultFuture]:
+    """
+    Iterates over the futures, yielding each one as soon as it is done.
+
+    :param timeout: Seconds to wait at most for all of them. Wait forever if `None`.
+    :raises concurrent.futures.TimeoutError: If not all of the futures are done within `timeout`.
+    """
+    mapping = {f._future: f for f in futures}
+    for future in concurrent.futures.as_completed(mapping, timeout):
+        yield mapping[future]
+
+
+class SpeechSynthesisStream():
+    """
+    The audio of a speech synthesis, delivered chunk by chunk as soon as it arrives.
+
+    Use `async for` inside a running event loop, or `for` in synchronous code (the synthesis
+    then runs in the `SynthesisRuntime`). When the iteration is finished, `result`
+    holds the `SpeechSynthesisResult`; a failed synthesis ends the iteration early and
+    `result` tells why.
+    The `AudioOutputConfig` of the synthesizer is not used, the chunks are handed to you instead.
+    """
+
+    def __init__(self, ssml:str, opt_fmt:str, method:int, status:bool, debug:bool,
+                 cache:Optional[SynthesisCache]=None, cache_key:Optional[str]=None,
+                 retry:Optional[RetryPolicy]=None, runtime:Optional[SynthesisRuntime]=None,
+                 exc:Optional[BaseException]=None):
         """
+        private constructor
+        """
+        self._runtime = runtime
+        self._exc = exc
+        self._ssml = ssml
+        self._opt_fmt = opt_fmt
+        self._method = method
+        self._retry = retry
+        self._status = status
+        self._debug = debug
+        self._cache = cache
+        self._cache_key = cache_key
+        self._result:Optional[SpeechSynthesisResult] = None
+
+    async def __aiter__(self):
+        req_id = uuid.uuid4().hex.upper()
+        if self._exc is not None:
+            # Rejected before anything was sent.
+            self._result = SpeechSynthesisResult(None,self._exc,self._opt_fmt)
+            return
+        if self._cache is not None:
+            cached = await self._cache.aget(self._cache_key)  # type: ignore
+            if cached is not None:
+                yield cached
+                self._result = SpeechSynthesisResult((req_id,cached),None,self._opt_fmt)
+                return
+        data = bytearray()
+        info = _RequestInfo()
         try:
-            asyncio.run(self._get())
-        except Exception:
-            ret = None
-        exc = self._task.exception()
-        if exc is None:
-            ret = self._task.result()
+            async for chunk in implete_stream(self._ssml,self._opt_fmt,self._debug,self._method,req_id,self._retry,info):
+                data += chunk
+                yield bytes(chunk)
+        except Exception as e:
+            self._result = SpeechSynthesisResult(None,e,self._opt_fmt,info)
         else:
-            ret = None
-        return SpeechSynthesisResult(ret,exc)  # type: ignore
-     
+            if self._cache is not None:
+                await self._cache.aput(self._cache_key,bytes(data))  # type: ignore
+            self._result = SpeechSynthesisResult((req_id,bytes(data)),None,self._opt_fmt,info)
+
+    def __iter__(self):
+        return _iterate_in_background(self,self._status,self._runtime)
+
+    @property
+    def result(self) -> Optional["SpeechSynthesisResult"]:
+        """
+        The result of the synthesis.
+        Return `None` if the iteration hasn't finished.
+        """
+        return self._result
+
     def __str__(self) -> str:
-        return f"<{self.__class__.__name__} done={self._task.done()}>"
+        return f"<{self.__class__.__name__} done={self._result is not None}>"
+
+
+class SpeechSynthesisBatch():
+    """
+    The results of a batch synthesis, see `SpeechSynthesizer.speak_batch`.
+
+    Iterating it yields `(index, SpeechSynthesisResult)` pairs, where `index` is the position
+    of the item in the batch. Use `async for` inside a running event loop, or `for` in
+    synchronous code (the batch then runs in the `SynthesisRuntime`).
+    A failed item yields a cancelled result, it doesn't stop the batch.
+    Items are only read from the iterable when there is room for them, so it may be a
+    generator of any length.
+    """
+
+    def __init__(self, synthesizer:"_SynthesizerBase", items:Iterable[str], concurrency:int, ordered:bool,
+                 ssml:Optional[bool]=None):
+        """
+        private constructor
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self._synthesizer = synthesizer
+        self._items = items
+        self._concurrency = concurrency
+        self._ordered = ordered
+        self._ssml = ssml
+
+    async def _run(self, index:int, item:str) -> tuple[int,"SpeechSynthesisResult"]:
+        synthesizer = self._synthesizer
+        opt_fmt = synthesizer._speech_config.speech_synthesis_output_format_string
+        ssml = item if (is_ssml(item) if self._ssml is None else self._ssml) else synthesizer._build_ssml(item)
+        info = _RequestInfo()
+        try:
+            ssml = synthesizer._preflight(ssml)
+            sink = synthesizer._sink()
+            ret = await synthesizer._synthesize(ssml,info=info,sink=sink)
+        except Exception as e:
+            return index, SpeechSynthesisResult(None,e,opt_fmt,info)
+        result = SpeechSynthesisResult(ret,None,opt_fmt,info)
+        if sink is None:
+            if synthesizer._audio_config is not None:
+                await _offload(synthesizer._handle,ret[1])
+            info.mark("handle_done")
+        return index, result
+
+    async def __aiter__(self):
+        items = enumerate(self._items)
+        concurrency = self._concurrency
+        # Results finished early wait here for their turn, bound how far ahead we may run.
+        window = concurrency * 4 if self._ordered else concurrency
+        running:set = set()
+        finished_results:dict = {}
+        started = 0
+        next_index = 0
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(running) < concurrency and started - next_index < window:
+                    try:
+                        index, item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    running.add(asyncio.ensure_future(self._run(index,item)))
+                    started += 1
+                if not running:
+                    break
+                done, running = await asyncio.wait(running,return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index, result = task.result()
+                    if self._ordered:
+                        finished_results[index] = result
+                    else:
+                        next_index += 1
+                        yield index, result
+                while next_index in finished_results:
+                    yield next_index, finished_results.pop(next_index)
+                    next_index += 1
+        finally:
+            for task in running:
+                task.cancel()
+
+    def __iter__(self):
+        return _iterate_in_background(self,self._synthesizer._status,self._synthesizer._runtime)
 
 
 class SpeechSynthesisCancellationDetails():
@@ -120,33 +348,18 @@ class SpeechSynthesisCancellationDetails():
     """
 
     def __init__(self, exc: BaseException):
-        if isinstance(exc, KeyboardInterrupt):
+        self._exc = None
+        self.__error_code = error_code(exc)
+        if self.__error_code == CancellationErrorCode.NoError:
             self.__reason = CancellationReason.CancelledByUser
-            self.__error_code = CancellationErrorCode.NoError
-        elif isinstance(exc, InvalidStatus):
-            self.__reason = CancellationReason.Error
-            code = exc.response.status_code
-            if code == 429:
-                self.__error_code = CancellationErrorCode.TooManyRequests
-            elif code == 403:
-                self.__error_code = CancellationErrorCode.Forbidden
-            elif code == 500:
-                self.__error_code = CancellationErrorCode.ServiceError
-            elif code == 503:
-                self.__error_code = CancellationErrorCode.ServiceUnavailable
-            else:
-                self.__error_code = CancellationErrorCode.RuntimeError
-                self._exc = exc.response.status_code
-        elif isinstance(exc, InvalidHandshake):
-            self.__reason = CancellationReason.Error
-            self.__error_code = CancellationErrorCode.ConnectionFailure
-        elif isinstance(exc,TimeoutError):
-            self.__reason = CancellationReason.Error
-            self.__error_code = CancellationErrorCode.ServiceTimeout
         else:
-            self._exc = exc
             self.__reason = CancellationReason.Error
-            self.__error_code = CancellationErrorCode.RuntimeError
+        if self.__error_code == CancellationErrorCode.RuntimeError:
+            # An unexpected status only keeps its code, anything else the exception itself.
+            status, _ = _status(exc)
+            self._exc = status if status is not None else exc
+        elif self.__error_code == CancellationErrorCode.BadRequest:
+            self._exc = exc
         self.__error_details = NotImplemented
 
     @property
@@ -171,7 +384,7 @@ class SpeechSynthesisCancellationDetails():
         
         Possible Values:
         - server return code: `int`
-        - traceback information: an instance of BaseException
+        - traceback information: an instance of BaseException, e.g. an `SSMLValidationError` for a bad request
         """
         return self._exc
 
@@ -192,30 +405,124 @@ class SpeechSynthesisCancellationDetails():
         yield self.error_code
         yield self.exception
 
+class SynthesisTimings(NamedTuple):
+    """
+    When each phase of a synthesis happened, as `time.monotonic()` timestamps.
+    A phase which wasn't reached (e.g. the connection of a cache hit) is `None`.
+
+    If the synthesis was retried, or was made of several requests (several voices, long text),
+    the connection phases are those of the last attempt started, `first_byte` is the earliest
+    and `last_byte` the latest.
+    """
+    queued: float
+    """
+    When the synthesis was requested.
+    """
+    connect_start: Optional[float]
+    """
+    When the connection was requested, once the rate limiter let the request through.
+    """
+    connect_done: Optional[float]
+    """
+    When a connection was ready, opened or taken from the pool.
+    """
+    request_sent: Optional[float]
+    first_byte: Optional[float]
+    last_byte: Optional[float]
+    decode: float
+    """
+    Seconds spent joining (and if needed, decoding) the audio of several requests.
+    """
+    handle_done: Optional[float]
+    """
+    When the audio was handed to the output, i.e. the file or the stream was closed, or the speaker stopped.
+    `None` if there is no output, e.g. for a `SpeechSynthesisStream`.
+    """
+    method: Optional[int]
+    """
+    The method which served the synthesis, `None` if it came from the cache.
+    """
+    fallbacks: int
+    """
+    How many methods failed before `method` was used.
+    """
+
+    def durations(self) -> dict[str, Optional[float]]:
+        """
+        The seconds spent in each phase: `queue` (waiting for the rate limiter and the retries), `connect`,
+        `send`, `wait` (for the first byte), `download`, `decode` and `handle`.
+        A phase whose bounds weren't reached is `None`.
+        """
+        def between(start, end):
+            return end - start if start is not None and end is not None else None
+        return {
+            "queue": between(self.queued, self.connect_start),
+            "connect": between(self.connect_start, self.connect_done),
+            "send": between(self.connect_done, self.request_sent),
+            "wait": between(self.request_sent, self.first_byte),
+            "download": between(self.first_byte, self.last_byte),
+            "decode": self.decode,
+            "handle": between(self.last_byte, self.handle_done),
+        }
+
+    @property
+    def time_to_first_byte(self) -> Optional[float]:
+        """
+        Seconds from `queued` to `first_byte`.
+        """
+        return self.first_byte - self.queued if self.first_byte is not None else None
+
+    @property
+    def total(self) -> Optional[float]:
+        """
+        Seconds from `queued` to `handle_done`, or to `last_byte` if the audio wasn't handled.
+        """
+        end = self.handle_done if self.handle_done is not None else self.last_byte
+        return end - self.queued if end is not None else None
+
+
 class SpeechSynthesisResult():
     """
     Result of a speech synthesis operation.
     """
 
-    def __init__(self,ret:Union[tuple[str,bytes],None], exc:Union[BaseException,None]):
+    def __init__(self,ret:Union[tuple[str,bytes],None], exc:Union[BaseException,None], opt_fmt:Optional[str]=None,
+                 info:Optional[_RequestInfo]=None):
         """
         Constructor for internal use.
         """
+        self._opt_fmt = opt_fmt
+        self._info = info
+        self._retries = info.retries if info is not None else 0
+        self._retry_delay = info.retry_delay if info is not None else 0.0
+        self._audio_duration_milliseconds = None
+        self._duration_probed = False
         if exc is not None:
             self._reason = ResultReason.Canceled
             self._result_id = None
-            self._audio_duration_milliseconds = None
             self._audio_data = None
             self._cancellation_details = SpeechSynthesisCancellationDetails(exc)
+            code = self._cancellation_details.error_code
+            metrics.syntheses.inc("cancelled" if code == CancellationErrorCode.NoError else code.name)
         else:
             assert ret is not None
             req_id, data = ret
             self._reason = ResultReason.SynthesizingAudioCompleted
-            sound:audio = audio.from_file(BytesIO(data))
             self._result_id = req_id
-            self._audio_duration_milliseconds = timedelta(seconds=sound.duration_seconds)
             self._audio_data = data
             self._cancellation_details = None
+            metrics.syntheses.inc("success")
+
+    def _header_duration(self) -> Optional[float]:
+        '''
+            The duration in seconds told by the headers of the audio, `None` if they don't tell.
+        '''
+        return probe_duration(self.audio_data,self._opt_fmt) if self._opt_fmt is not None else None  # type: ignore
+
+    def _probed(self, seconds: Optional[float]) -> Optional[timedelta]:
+        self._audio_duration_milliseconds = timedelta(seconds=seconds) if seconds is not None else None
+        self._duration_probed = True
+        return self._audio_duration_milliseconds
 
     @property
     def cancellation_details(self) -> Optional[SpeechSynthesisCancellationDetails]:
@@ -226,6 +533,34 @@ class SpeechSynthesisResult():
         """
         return self._cancellation_details
 
+    @property
+    def retries(self) -> int:
+        """
+        How many times the synthesis was retried, see `SpeechConfig.retry_policy`.
+        """
+        return self._retries
+
+    @property
+    def retry_delay(self) -> float:
+        """
+        Seconds spent waiting between the retries.
+        """
+        return self._retry_delay
+
+    @property
+    def timings(self) -> Optional["SynthesisTimings"]:
+        """
+        When each phase of the synthesis happened, see `SynthesisTimings`. A cache hit has timings
+        without connection phases, whose `method` is `None`.
+        Return `None` for a `SpeechSynthesisStream` which didn't send a request, i.e. it was rejected or its audio was cached.
+        """
+        info = self._info
+        if info is None:
+            return None
+        return SynthesisTimings(info.queued, info.connect_start, info.connect_done, info.request_sent,
+                                info.first_byte, info.last_byte, info.decode, info.handle_done,
+                                info.method, info.fallbacks)
+
     @property
     def result_id(self) -> Optional[str]:
         """
@@ -247,18 +582,52 @@ class SpeechSynthesisResult():
         The output audio data from the TTS.
         Return `None` if cancelled.
         """
+        if callable(self._audio_data):
+            # Written to a sink which didn't retain it, see `AudioSink.getvalue`.
+            self._audio_data = self._audio_data()
         return self._audio_data
 
     @property
     def audio_duration(self) -> Optional[timedelta]:
         """
         The time duration of the synthesized audio.
-        Return `None` if cancelled.
+        Return `None` if cancelled, or if the duration can't be found out.
+
+        It is read from the headers of the audio when first accessed, the audio is only decoded
+        if the headers don't tell it. Decoding would block an event loop, so inside one, this is `None`
+        if the headers don't tell: use `probe_audio_duration` instead.
 
         .. note::
           Added in version 1.21.0.
         """
-        return self._audio_duration_milliseconds
+        if self._duration_probed or self.audio_data is None:
+            return self._audio_duration_milliseconds
+        seconds = self._header_duration()
+        if seconds is None:
+            try:
+                asyncio.get_running_loop()
+                return None
+            except RuntimeError:
+                pass
+            try:
+                seconds = decode_executor().submit(_decoded_duration,self.audio_data).result()
+            except Exception:
+                pass
+        return self._probed(seconds)
+
+    async def probe_audio_duration(self) -> Optional[timedelta]:
+        """
+        `audio_duration`, decoding the audio in the decode executor if needed without blocking the event loop.
+        """
+        if self._duration_probed or self.audio_data is None:
+            return self._audio_duration_milliseconds
+        seconds = self._header_duration()
+        if seconds is None:
+            try:
+                seconds = await _offload_decode(_decoded_duration,self.audio_data)
+            except Exception:
+                pass
+        return self._probed(seconds)
 
     @property
     def properties(self) -> NoReturn:
@@ -268,11 +637,11 @@ class SpeechSynthesisResult():
         raise NotImplementedError("`properties` unsupported")
 
     def __str__(self):
-        if self._audio_data is None:
+        if self.audio_data is None:
             return u'{}(result_id={}, reason={})'.format(
             type(self).__name__, self._result_id, self._reason)
         return u'{}(result_id={}, reason={}, audio_length={})'.format(
-            type(self).__name__, self._result_id, self._reason, len(self._audio_data))
+            type(self).__name__, self._result_id, self._reason, len(self.audio_data))
 
 
 class SpeechConfig():
@@ -286,6 +655,7 @@ class SpeechConfig():
         self._speech_synthesis_voice_name = "zh-CN-XiaoxiaoNeural"
         self._speech_synthesis_output_format_string = "audio-24khz-48kbitrate-mono-mp3"
         self._method = 1
+        self._retry_policy: Optional[RetryPolicy] = RetryPolicy()
 
     @property
     def speech_synthesis_language(self) -> str:
@@ -363,6 +733,25 @@ class SpeechConfig():
             raise ValueError("method must be between 1 to 4")
         self._method = method
 
+    @property
+    def retry_policy(self) -> Optional[RetryPolicy]:
+        """
+        How failed syntheses are retried, by default `RetryPolicy()`, i.e. up to 3 attempts per
+        method on `TooManyRequests`, `ServiceError`, `ServiceUnavailable` and `ServiceTimeout`.
+        """
+        return self._retry_policy
+
+    @retry_policy.setter
+    def retry_policy(self, policy: Optional[RetryPolicy]):
+        """
+        Set the retry policy.
+
+        :param policy: A `RetryPolicy`, or `None` to never retry.
+        """
+        if policy is not None and not isinstance(policy, RetryPolicy):
+            raise TypeError("wrong type, must be a RetryPolicy")
+        self._retry_policy = policy
+
 class AudioOutputConfig():
     """
     Copied from azure.cognitiveservices.speech.audio
@@ -374,22 +763,38 @@ class AudioOutputConfig():
     :param use_default_speaker: Specifies to use the system default speaker for audio
         output.
     :param filename: Specifies an audio output file. The parent directory must already exist.
-    [UNSUPPORT]:param stream: Creates an AudioOutputConfig object representing the specified stream.
+    :param stream: Specifies an output stream, a `PullAudioOutputStream` or a `PushAudioOutputStream`.
+        It is fed as the audio arrives.
     :param device_name: Specifies the id of the audio device to use.
          This functionality was added in version 1.17.0.
+    :param buffer_size: Bytes buffered before they are written to `filename`.
+    :param fsync: When `filename` is synced to the disk, `"never"`, `"close"` or `"always"`, see `FileSink`.
+    :param prebuffer: Seconds of audio buffered before the default speaker starts playing, see `SpeakerSink`.
+
+    The audio is written into `filename` as it arrives, through a temporary file renamed once the
+    synthesis is complete. The default speaker plays it as it arrives.
     """
 
     def __init__(self, use_default_speaker: Optional[bool] = False, filename: Optional[str] = None,
-                 stream: Optional[AudioOutputStream] = None, device_name: Optional[str] = None):
+                 stream: Optional[AudioOutputStream] = None, device_name: Optional[str] = None,
+                 buffer_size: int = 64 * 1024, fsync: str = "never", prebuffer: float = 0.1):
+        self.sink: Optional[Callable[[str],AudioSink]] = None
+        """
+        Creates the sink a synthesis in the given output format is written into, if the output can take the audio
+        as it arrives. `handle` is used for the audio which is already complete, e.g. cache hits.
+        """
         if not isinstance(use_default_speaker, bool):
             raise ValueError('use_default_speaker must be a bool, is "{}"'.format(
                 use_default_speaker))
-        if stream is not None:
-            raise NotImplementedError("`stream` has not been implemented")
         if filename is None and stream is None and device_name is None:
             if use_default_speaker:
                 # Default speaker
-                self.handle = lambda b:play(audio.from_file(BytesIO(b)))
+                def _handle(b):
+                    from pydub import AudioSegment as audio
+                    from pydub.playback import play
+                    play(audio.from_file(BytesIO(b)))
+                self.handle = _handle
+                self.sink = lambda opt_fmt: SpeakerSink(opt_fmt,prebuffer)
             else:
                 raise ValueError(
                     'default speaker needs to be explicitly activated')
@@ -400,15 +805,17 @@ class AudioOutputConfig():
 
             if filename is not None:
                 # filename
+                if fsync not in ("never", "close", "always"):
+                    raise ValueError('fsync must be "never", "close" or "always"')
                 def _handle(byte):
-                    with open(filename,"wb") as f:
-                        f.write(byte)
+                    write_file(filename,byte,buffer_size,fsync)
                 self.handle = _handle
+                self.sink = lambda opt_fmt: FileSink(filename,buffer_size,fsync)
             elif stream is not None:
-                pass
-                # self._stream = stream
-                # _call_hr_fn(fn=_sdk_lib.audio_config_create_audio_output_from_stream,
-                #             *[ctypes.byref(handle), stream._handle])
+                if not isinstance(stream, AudioOutputStream):
+                    raise TypeError("wrong type, must be an AudioOutputStream")
+                self.handle = stream._write_all
+                self.sink = lambda opt_fmt: stream._sink()
             elif device_name is not None:
                 # detected device name
                 raise NotImplementedError("Due to pydub.playback doesn't support choosing device, `device_name` may not be supported.")
@@ -417,7 +824,216 @@ class AudioOutputConfig():
                     'cannot construct AudioOutputConfig with the given arguments')
 
 
-class SpeechSynthesizer:
+class _SynthesizerBase:
+    '''
+        What `SpeechSynthesizer` and `AsyncSpeechSynthesizer` have in common.
+    '''
+
+    def __init__(self, speech_config: SpeechConfig, audio_config: Optional[AudioOutputConfig],
+                 status: bool, debug: bool, cache: Optional[SynthesisCache],
+                 runtime: Optional[SynthesisRuntime] = None):
+        self._runtime = runtime
+        self._speech_config = speech_config
+        self._audio_config:AudioOutputConfig = audio_config  # type: ignore
+        self._debug = debug
+        self._status = status
+        self._cache = cache
+
+    @property
+    def _handle(self) -> Callable[[bytes],Any]:
+        if self._audio_config is None:
+            return lambda b: None
+        return self._audio_config.handle
+
+    def _sink(self) -> Optional[AudioSink]:
+        '''
+            A new sink of the `AudioOutputConfig`, or `None` if it only takes the whole audio through `handle`.
+        '''
+        if self._audio_config is None or self._audio_config.sink is None:
+            return None
+        return self._audio_config.sink(self._speech_config.speech_synthesis_output_format_string)
+
+    def _preflight(self, ssml: str) -> str:
+        '''
+            Validate and normalize `ssml` before anything is sent, see `ssml.validate_ssml`.
+        '''
+        return validate_ssml(ssml,self._speech_config.speech_synthesis_output_format_string,self._speech_config.method)
+
+    def _cache_key(self, ssml: str) -> str:
+        return SynthesisCache.key(
+            ssml,
+            self._speech_config.speech_synthesis_voice_name,
+            self._speech_config.speech_synthesis_output_format_string
+        )
+
+    async def _synthesize(self, ssml: str, info: Optional[_RequestInfo] = None,
+                          sink: Optional[AudioSink] = None) -> tuple[str,bytes]:
+        """
+        Synthesize `ssml`, storing the audio in the cache if there is one.
+
+        :param info: Where the retries and the timings are recorded.
+        :param sink: Where the audio is written as it arrives. Unless the sink `retain`s the audio or
+            there is a cache, the audio isn't kept in memory, the result reads it back from the sink.
+        """
+        if self._cache is not None:
+            cached = await self._cache.aget(self._cache_key(ssml))
+            if cached is not None:
+                if self._debug:
+                    _print("[dark_slate_gray2]Cache hit[/dark_slate_gray2]")
+                if sink is not None:
+                    await self._drain([cached],sink)
+                    if info is not None:
+                        info.mark("handle_done")
+                return uuid.uuid4().hex.upper(), cached
+        if sink is not None:
+            return await self._synthesize_into(ssml,sink,info)
+        ret = await implete(
+            ssml,
+            self._speech_config.speech_synthesis_output_format_string,
+            self._debug,
+            self._speech_config.method,
+            self._speech_config.retry_policy,
+            info
+            )
+        if self._cache is not None:
+            await self._cache.aput(self._cache_key(ssml),ret[1])
+        return ret
+
+    @staticmethod
+    async def _drain(chunks, sink: AudioSink):
+        '''
+            Write `chunks` (an async iterable, or a list) into `sink` and close it, aborting it on failure.
+        '''
+        try:
+            if isinstance(chunks, list):
+                for chunk in chunks:
+                    await sink.write(chunk)
+            else:
+                async for chunk in chunks:
+                    await sink.write(chunk)
+            await sink.close()
+        except BaseException:
+            await sink.abort()
+            raise
+
+    async def _synthesize_into(self, ssml: str, sink: AudioSink, info: Optional[_RequestInfo]) -> tuple[str,bytes]:
+        req_id = uuid.uuid4().hex.upper()
+        keep = self._cache is not None or sink.retain
+        data = bytearray()
+        async def chunks():
+            nonlocal data
+            async for chunk in implete_stream(
+                ssml,
+                self._speech_config.speech_synthesis_output_format_string,
+                self._debug,
+                self._speech_config.method,
+                req_id,
+                self._speech_config.retry_policy,
+                info
+            ):
+                if keep:
+                    data += chunk
+                yield chunk
+        await self._drain(chunks(),sink)
+        if info is not None:
+            info.mark("handle_done")
+        if not keep:
+            return req_id, sink.getvalue  # type: ignore
+        if self._cache is not None:
+            await self._cache.aput(self._cache_key(ssml),bytes(data))
+        return req_id, bytes(data)
+
+    def _build_ssml(self, text: str) -> str:
+        """
+        Copied from aspeak.ssml
+        Create SSML for text to be spoken.
+        """
+        voice = self._speech_config.speech_synthesis_voice_name
+        ssml = '<speak xmlns="http://www.w3.org/2001/10/synthesis" xmlns:mstts="http://www.w3.org/2001/mstts" ' \
+            'xmlns:emo="http://www.w3.org/2009/10/emotionml" version="1.0" xml:lang="en-US"> '
+        ssml += f'<voice name="{voice}">' if voice is not None else '<voice>'
+        ssml += escape(text, quote=False)
+        ssml += '</voice></speak>'
+        return ssml
+
+    async def _synthesize_long(self, text: str, max_chunk_chars: int, concurrency: int,
+                               info: Optional[_RequestInfo] = None) -> tuple[str,bytes]:
+        """
+        Synthesize the chunks of a long text concurrently and join their audio in order.
+
+        :param info: Where the retries and the timings of all the chunks are recorded.
+        """
+        chunks = split_text(text,max_chunk_chars)
+        if not chunks:
+            raise SSMLValidationError("The text is empty.")
+        semaphore = asyncio.Semaphore(concurrency)
+        async def run(chunk):
+            async with semaphore:
+                _, data = await self._synthesize(self._preflight(self._build_ssml(chunk)),info=info)
+                return data
+        tasks = [asyncio.ensure_future(run(chunk)) for chunk in chunks]
+        try:
+            audios = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        audio_data = await _concat(audios,self._speech_config.speech_synthesis_output_format_string,info)
+        return uuid.uuid4().hex.upper(), audio_data
+
+    def speak_batch(self, items: Iterable[str], concurrency: int = 4, ordered: bool = True,
+                    ssml: Optional[bool] = None) -> SpeechSynthesisBatch:
+        """
+        Performs synthesis on many texts or ssml documents, at most `concurrency` at a time.
+
+        The audio of every item is passed to the `AudioOutputConfig`, so you may want to
+        use `audio_config=None` and keep `SpeechSynthesisResult.audio_data` of each result.
+
+        :param items: Plain texts or ssml documents.
+        :param concurrency: Maximum number of syntheses running at the same time.
+        :param ordered: Yield the results in the order of `items`. If `False`, they are
+            yielded as soon as they are done.
+        :param ssml: `True` if every item is an ssml document, `False` if every item is plain text.
+            If `None`, they can be mixed: an item is taken for ssml if it is a whole `<speak>` element,
+            optionally after an XML declaration, see `ssml.is_ssml`.
+        :returns: A SpeechSynthesisBatch, iterate it with `for` or `async for` to get
+            `(index, SpeechSynthesisResult)` pairs.
+        """
+        return SpeechSynthesisBatch(self,items,concurrency,ordered,ssml)
+
+    def speak_text_stream(self, text: str) -> SpeechSynthesisStream:
+        """
+        Performs synthesis on plain text, handing out the audio chunk by chunk as soon as it arrives.
+
+        :returns: A SpeechSynthesisStream, iterate it with `for` or `async for`.
+        """
+        return self.speak_ssml_stream(self._build_ssml(text))
+
+    def speak_ssml_stream(self, ssml: str) -> SpeechSynthesisStream:
+        """
+        Performs synthesis on ssml, handing out the audio chunk by chunk as soon as it arrives.
+
+        :returns: A SpeechSynthesisStream, iterate it with `for` or `async for`.
+            An invalid `ssml` gives a stream without audio, whose result is cancelled with `CancellationErrorCode.BadRequest`.
+        """
+        exc = None
+        try:
+            ssml = self._preflight(ssml)
+        except SSMLValidationError as e:
+            exc = e
+        return SpeechSynthesisStream(
+            ssml,
+            self._speech_config.speech_synthesis_output_format_string,
+            self._speech_config.method,
+            self._status,self._debug,
+            self._cache,
+            self._cache_key(ssml) if self._cache is not None else None,
+            self._speech_config.retry_policy,
+            self._runtime,
+            exc
+        )
+
+
+class SpeechSynthesizer(_SynthesizerBase):
     """
     A speech synthesizer.
 
@@ -432,35 +1048,24 @@ class SpeechSynthesizer:
         Powered by `rich.status`, if you use any of `rich.status` or `rich.progress`, you should set
         this to `False`
     :param debug: Inside debug option, will show debug information when synthesising.
+    :param cache: A `SynthesisCache` to look up the audio in before synthesising, and to store
+        new audio in. A cache can be shared by several synthesizers.
+    :param runtime: The `SynthesisRuntime` running the syntheses, can be shared by several synthesizers.
+        If it is not provided, the default runtime of the process is used.
     """
 
     def __init__(self, speech_config: SpeechConfig,
                  audio_config: Optional[AudioOutputConfig] = AudioOutputConfig(
                      use_default_speaker=True),
                  auto_detect_source_language_config: Optional[AutoDetectSourceLanguageConfig] = None,
-                 status = True, debug = False):
+                 status = True, debug = False, cache: Optional[SynthesisCache] = None,
+                 runtime: Optional[SynthesisRuntime] = None):
 
-        self._speech_config = speech_config
-        self._audio_config:AudioOutputConfig = audio_config  # type: ignore
-        self._debug = debug
-        self._status = status
+        super().__init__(speech_config,audio_config,status,debug,cache,runtime)
         if auto_detect_source_language_config is not None:
             raise NotImplementedError(
                 'auto_detect_source_language_config is not supported')
 
-    def _build_ssml(self, text: str) -> str:
-        """
-        Copied from aspeak.ssml
-        Create SSML for text to be spoken.
-        """
-        voice = self._speech_config.speech_synthesis_voice_name
-        ssml = '<speak xmlns="http://www.w3.org/2001/10/synthesis" xmlns:mstts="http://www.w3.org/2001/mstts" ' \
-            'xmlns:emo="http://www.w3.org/2009/10/emotionml" version="1.0" xml:lang="en-US"> '
-        ssml += f'<voice name="{voice}">' if voice is not None else '<voice>'
-        ssml += escape(text)
-        ssml += '</voice></speak>'
-        return ssml
-
     def speak_text(self, text: str) -> SpeechSynthesisResult:
         """
         Performs synthesis on plain text in a blocking (synchronous) mode.
@@ -483,41 +1088,68 @@ class SpeechSynthesizer:
 
         :returns: A future with SpeechSynthesisResult.
         """
-        ssml = self._build_ssml(text)
-        task = event_loop.create_task(
-            implete(
-                ssml,
-                self._speech_config.speech_synthesis_output_format_string,
-                self._debug,
-                self._speech_config.method
-                )
-            )
-        if self._debug:
-            print("[dark_slate_gray2]Created task: {}[/dark_slate_gray2]".format(task))
-        return ResultFuture(
-            task,
-            self._audio_config.handle,
-            self._status,self._debug
-        )
+        return self.speak_ssml_async(self._build_ssml(text))
 
     def speak_ssml_async(self, ssml: str) -> ResultFuture:
         """
         Performs synthesis on ssml in a non-blocking (asynchronous) mode.
 
+        If `ssml` is invalid, the returned future is already done, with a result cancelled with
+        `CancellationErrorCode.BadRequest`, see `ssml.validate_ssml`.
+
         :returns: A future with SpeechSynthesisResult.
         """
-        task = event_loop.create_task(
-            implete(
-                ssml,
-                self._speech_config.speech_synthesis_output_format_string,
-                self._debug,
-                self._speech_config.method
-                )
-            )
+        try:
+            ssml = self._preflight(ssml)
+        except SSMLValidationError as e:
+            return ResultFuture._completed(None,self._handle,self._speech_config.speech_synthesis_output_format_string,e)
+        info = _RequestInfo()
+        sink = self._sink()
+        future = ResultFuture(
+            self._synthesize(ssml,info=info,sink=sink),
+            self._handle if sink is None else lambda b: None,
+            self._status,self._debug,
+            self._speech_config.speech_synthesis_output_format_string,
+            info,
+            self._runtime
+        )
+        if self._debug:
+            _print("[dark_slate_gray2]Created task: {}[/dark_slate_gray2]".format(future._task))
+        return future
+
+    def speak_long_text(self, text: str, max_chunk_chars: int = 500, concurrency: int = 4) -> SpeechSynthesisResult:
+        """
+        Performs synthesis on a long plain text in a blocking (synchronous) mode.
+        See `speak_long_text_async`.
+
+        :returns: A SpeechSynthesisResult.
+        """
+        return self.speak_long_text_async(text,max_chunk_chars,concurrency).get()
+
+    def speak_long_text_async(self, text: str, max_chunk_chars: int = 500, concurrency: int = 4) -> ResultFuture:
+        """
+        Performs synthesis on a long plain text in a non-blocking (asynchronous) mode.
+
+        The text is split at sentence or clause boundaries into chunks of at most `max_chunk_chars`
+        characters, which are synthesized `concurrency` at a time. Their audio is joined in order
+        into a single result. If any chunk fails, the whole synthesis is cancelled. So is the synthesis
+        of an empty text, with `CancellationErrorCode.BadRequest`.
+
+        :raises ValueError: If `max_chunk_chars` or `concurrency` is less than 1.
+        :returns: A future with SpeechSynthesisResult.
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        if max_chunk_chars < 1:
+            raise ValueError("max_chunk_chars must be at least 1")
+        info = _RequestInfo()
         return ResultFuture(
-            task,
-            self._audio_config.handle,
-            self._status,self._debug
+            self._synthesize_long(text,max_chunk_chars,concurrency,info),
+            self._handle,
+            self._status,self._debug,
+            self._speech_config.speech_synthesis_output_format_string,
+            info,
+            self._runtime
         )
 
     def start_speaking_text(self, text: str) -> SpeechSynthesisResult:
@@ -809,3 +1441,93 @@ class SpeechSynthesizer:
     #     if obj is not None:
     #         event = SpeechSynthesisBookmarkEventArgs(event_handle)
     #         obj.__bookmark_reached_signal.signal(event)
+
+
+class AsyncSpeechSynthesizer(_SynthesizerBase):
+    """
+    A speech synthesizer for asyncio code.
+
+    Its methods are coroutines running in the event loop of the caller, e.g. `await synthesizer.speak_text(...)`,
+    so unlike `SpeechSynthesizer` there is no background thread nor status.
+    Streams and batches are the same as those of `SpeechSynthesizer`, iterate them with `async for`.
+    Use it as `async with AsyncSpeechSynthesizer(...) as synthesizer:`, or call `aclose`, to close its
+    connections before the event loop is closed.
+
+    :param speech_config: The config for the speech synthesizer
+    :param audio_config: The config for the audio output.
+        If it is None (the default), the audio is only kept in the results.
+        Its handle runs in the blocking executor, see `runtime.blocking_executor`.
+    :param debug: Inside debug option, will show debug information when synthesising.
+    :param cache: A `SynthesisCache` to look up the audio in before synthesising, and to store
+        new audio in. A cache can be shared by several synthesizers.
+    """
+
+    def __init__(self, speech_config: SpeechConfig, audio_config: Optional[AudioOutputConfig] = None,
+                 debug = False, cache: Optional[SynthesisCache] = None):
+        super().__init__(speech_config,audio_config,False,debug,cache)
+
+    async def _result(self, coro, info: _RequestInfo, handle: bool) -> SpeechSynthesisResult:
+        """
+        Await `coro`, handle its audio if `handle`, and wrap it into a result.
+        A failed synthesis gives a cancelled result, but cancelling the caller still raises `CancelledError`.
+        """
+        opt_fmt = self._speech_config.speech_synthesis_output_format_string
+        try:
+            ret = await coro
+        except Exception as e:
+            return SpeechSynthesisResult(None,e,opt_fmt,info)
+        result = SpeechSynthesisResult(ret,None,opt_fmt,info)
+        if handle:
+            if self._audio_config is not None:
+                await _offload(self._handle,ret[1])
+            info.mark("handle_done")
+        return result
+
+    async def speak_text(self, text: str) -> SpeechSynthesisResult:
+        """
+        Performs synthesis on plain text.
+
+        :returns: A SpeechSynthesisResult.
+        """
+        return await self.speak_ssml(self._build_ssml(text))
+
+    async def speak_ssml(self, ssml: str) -> SpeechSynthesisResult:
+        """
+        Performs synthesis on ssml.
+        An invalid `ssml` gives a result cancelled with `CancellationErrorCode.BadRequest`, see `ssml.validate_ssml`.
+
+        :returns: A SpeechSynthesisResult.
+        """
+        try:
+            ssml = self._preflight(ssml)
+        except SSMLValidationError as e:
+            return SpeechSynthesisResult(None,e,self._speech_config.speech_synthesis_output_format_string)
+        info = _RequestInfo()
+        sink = self._sink()
+        return await self._result(self._synthesize(ssml,info=info,sink=sink),info,sink is None)
+
+    async def speak_long_text(self, text: str, max_chunk_chars: int = 500, concurrency: int = 4) -> SpeechSynthesisResult:
+        """
+        Performs synthesis on a long plain text, see `SpeechSynthesizer.speak_long_text_async`.
+
+        :returns: A SpeechSynthesisResult.
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        if max_chunk_chars < 1:
+            raise ValueError("max_chunk_chars must be at least 1")
+        info = _RequestInfo()
+        return await self._result(self._synthesize_long(text,max_chunk_chars,concurrency,info),info,True)
+
+    async def aclose(self):
+        """
+        Close the HTTP session and the WebSocket connections of the running event loop.
+        They are shared by every synthesizer of the loop, and are opened again if one is used later.
+        """
+        await _close_connections()
+
+    async def __aenter__(self) -> "AsyncSpeechSynthesizer":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
@@ -0,0 +1,199 @@
+import re
+import xml.etree.ElementTree as ElementTree
+
+from .enums import _SpeechSynthesisOutputFormat
+
+# A sentence ends at CJK or Latin terminal punctuation (a Latin period only when followed by
+# a space, so "3.14" isn't split) or at a line break, and takes closing quotes/brackets with it.
+_SENTENCE = re.compile(r'.*?(?:[。！？!?；;…]+|\.(?=\s|$)|\n+|$)[”’"\'」』）)\]]*\s*', re.S)
+_CLAUSE = re.compile(r'.*?(?:[，,、：:]+|$)\s*', re.S)
+# A period after a title or a common abbreviation doesn't end the sentence, e.g. "Mr. Smith".
+_ABBREVIATION = re.compile(r'(?:^|[\s(])(?:Mr|Mrs|Ms|Dr|Prof|Sr|Jr|St|Mt|No|vs|Fig|e\.g|i\.e)\.\s*$')
+# Nor does the period of an initial, but a capital letter alone may also end a sentence ("plan B."),
+# so it is only taken for an initial after a title or another initial, or before another initial.
+_INITIAL = re.compile(r'(?:^|[\s(])[A-Z]\.\s*$')
+_AFTER_INITIAL = re.compile(r'(?:^|[\s(])(?:[A-Z]|Mr|Mrs|Ms|Dr|Prof|Sr|Jr|St)\.\s*[A-Z]\.\s*$')
+_NEXT_INITIAL = re.compile(r'[A-Z]\.(?:\s|$)')
+
+
+def _pieces(pattern: re.Pattern, text: str) -> list[str]:
+    return [piece for piece in pattern.findall(text) if piece]
+
+
+def _continues(sentence: str, piece: str) -> bool:
+    '''
+        Whether `sentence` only ended at the period of an abbreviation or an initial, and goes on with `piece`.
+    '''
+    if _ABBREVIATION.search(sentence) or _AFTER_INITIAL.search(sentence):
+        return True
+    return _INITIAL.search(sentence) is not None and _NEXT_INITIAL.match(piece) is not None
+
+
+def _sentences(text: str) -> list[str]:
+    sentences: list[str] = []
+    for piece in _pieces(_SENTENCE, text):
+        if sentences and _continues(sentences[-1], piece):
+            sentences[-1] += piece
+        else:
+            sentences.append(piece)
+    return sentences
+
+
+def _hard_split(text: str, max_chars: int) -> list[str]:
+    '''
+        Split `text` into pieces of at most `max_chars` characters,
+        preferring whitespace as the boundary.
+    '''
+    pieces = []
+    while len(text) > max_chars:
+        cut = text.rfind(" ", 1, max_chars + 1)
+        if cut <= 0:
+            cut = max_chars
+        pieces.append(text[:cut])
+        text = text[cut:]
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+def split_text(text: str, max_chars: int = 500) -> list[str]:
+    """
+    Split plain text into chunks of at most `max_chars` characters.
+
+    Chunks end at sentence boundaries when possible, then at clause boundaries,
+    and only a single clause longer than `max_chars` is cut elsewhere.
+    CJK punctuation (`。！？；，、：`) is recognized as well as Latin punctuation, and the period
+    of a title or a common abbreviation (`Mr.`, `Dr.`, `e.g.`) doesn't end a sentence, nor does the period of
+    an initial next to a title or another initial (`Dr. J. Watson`, `J. R. R. Tolkien`).
+    Chunks which only contain whitespace are dropped.
+
+    :param text: The plain text.
+    :param max_chars: Maximum length of a chunk.
+    """
+    if max_chars < 1:
+        raise ValueError("max_chars must be at least 1")
+    units = []
+    for sentence in _sentences(text):
+        if len(sentence) <= max_chars:
+            units.append(sentence)
+            continue
+        for clause in _pieces(_CLAUSE, sentence):
+            if len(clause) <= max_chars:
+                units.append(clause)
+            else:
+                units.extend(_hard_split(clause, max_chars))
+
+    chunks = []
+    current = ""
+    for unit in units:
+        if len(current) + len(unit) > max_chars:
+            chunks.append(current)
+            current = ""
+        current += unit
+    chunks.append(current)
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+_SPEAK = re.compile(r'\s*(?:<\?xml[^>]*\?>\s*)?(<speak\b[^>]*>)(.*)</speak>\s*', re.S)
+_VOICE = re.compile(r'<voice\b[^>]*>.*?</voice>', re.S)
+_COMMENT = re.compile(r'<!--.*?-->', re.S)
+
+
+def is_ssml(text: str) -> bool:
+    """
+    Whether `text` is an SSML document rather than plain text: a whole `<speak>` element,
+    optionally after an XML declaration.
+    """
+    return _SPEAK.fullmatch(text) is not None
+
+
+def split_voices(ssml: str) -> list[str]:
+    """
+    Split an SSML document into documents of a single `<voice>` each, in document order.
+
+    Every document keeps the `<speak>` tag, so its attributes and namespaces still apply.
+    A document with at most one voice is returned as it is.
+
+    :param ssml: The SSML document.
+    :raises ValueError: If there is anything but whitespace and comments between the voices.
+    """
+    match = _SPEAK.fullmatch(ssml)
+    if match is None:
+        return [ssml]
+    speak, body = match.groups()
+    voices = _VOICE.findall(body)
+    if len(voices) < 2:
+        return [ssml]
+    if _COMMENT.sub("", _VOICE.sub("", body)).strip():
+        raise ValueError("Only <voice> elements are allowed in a multi-voice <speak>.")
+    return [f"{speak}{voice}</speak>" for voice in voices]
+
+
+MAX_SSML_BYTES = 64 * 1024
+"""
+Maximum size of an SSML document, in bytes once encoded in UTF-8.
+"""
+MAX_VOICES = 50
+"""
+Maximum number of `<voice>` elements in an SSML document.
+"""
+_METHOD_FORMATS = {2: ("audio-24khz-48kbitrate-mono-mp3",)}
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+class SSMLValidationError(ValueError):
+    """
+    An SSML document which can't be synthesized, found out before anything is sent.
+    Its synthesis is cancelled with `CancellationErrorCode.BadRequest`.
+    """
+
+
+def _local_name(tag: str) -> str:
+    return tag.rpartition("}")[2]
+
+
+def normalize_ssml(ssml: str) -> str:
+    """
+    Collapse every run of whitespace of an SSML document into a single space, and strip its ends.
+
+    The speech is the same, but documents only differing by their layout become equal,
+    e.g. their cache keys.
+    """
+    return _WHITESPACE.sub(" ", ssml).strip()
+
+
+def validate_ssml(ssml: str, opt_fmt: str, method: int) -> str:
+    """
+    Check that an SSML document can be synthesized with `opt_fmt` and `method`, without sending it.
+
+    The document must be well-formed XML whose root is `<speak>`, of at most `MAX_SSML_BYTES` bytes and
+    `MAX_VOICES` voices. `opt_fmt` must be a known output format, supported by `method`. Method 2 only
+    takes several voices if there is nothing else between them, see `split_voices`.
+
+    :returns: The normalized document, see `normalize_ssml`.
+    :raises SSMLValidationError: If it can't be synthesized.
+    """
+    if opt_fmt not in _SpeechSynthesisOutputFormat.values():
+        raise SSMLValidationError(f"Unknown output format {opt_fmt!r}.")
+    if opt_fmt not in _METHOD_FORMATS.get(method, (opt_fmt,)):
+        raise SSMLValidationError(f"Method {method} only supports the output formats {_METHOD_FORMATS[method]}.")
+    ssml = normalize_ssml(ssml)
+    size = len(ssml.encode("utf-8"))
+    if size > MAX_SSML_BYTES:
+        raise SSMLValidationError(f"The SSML is {size} bytes long, at most {MAX_SSML_BYTES} are allowed.")
+    try:
+        root = ElementTree.fromstring(ssml)
+    except ElementTree.ParseError as e:
+        raise SSMLValidationError(f"Malformed SSML: {e}") from None
+    if _local_name(root.tag) != "speak":
+        raise SSMLValidationError(f"The root of the SSML must be <speak>, not <{_local_name(root.tag)}>.")
+    voices = sum(_local_name(element.tag) == "voice" for element in root.iter())
+    if voices > MAX_VOICES:
+        raise SSMLValidationError(f"The SSML has {voices} voices, at most {MAX_VOICES} are allowed.")
+    if method == 2 and voices > 1:
+        try:
+            split_voices(ssml)
+        except ValueError as e:
+            raise SSMLValidationError(str(e)) from None
+    return ssml
@@ -1,20 +1,91 @@
 import asyncio
+import time
 import uuid
+from collections import deque
 from datetime import datetime
 import logging
+from typing import TYPE_CHECKING, AsyncIterator, NamedTuple, Optional, Union
 
-from requests import post
 from json import dumps
-from websockets.legacy import client
-try:
-    from rich import print
-    from rich.logging import RichHandler
-except ImportError:
-    print("Rich is not available, please install it for more friendly output.")
+
+from . import metrics
+from .formats import _concat_decodes, concat_audio
+from .runtime import _offload_decode
+from .ssml import split_voices
+from .policy import (BackendUnavailable, RetryPolicy, ServiceStatusError, backends, error_code, parse_retry_after,
+                     rate_limiters)
+
+if TYPE_CHECKING:
+    import aiohttp
 
 log = logging.Logger("TTS")
-log_handler = RichHandler(rich_tracebacks=True, tracebacks_show_locals=True)
-log.addHandler(log_handler)
+_log_handler: Optional[logging.Handler] = None
+
+def _get_log_handler() -> logging.Handler:
+    '''
+        Get the handler of `log`, creating it on first use since building a `RichHandler` is slow.
+    '''
+    global _log_handler
+    if _log_handler is None:
+        try:
+            from rich.logging import RichHandler
+            _log_handler = RichHandler(rich_tracebacks=True, tracebacks_show_locals=True)
+        except ImportError:
+            print("Rich is not available, please install it for more friendly output.")
+            _log_handler = logging.StreamHandler()
+        log.addHandler(_log_handler)
+    return _log_handler
+
+HTTP_POOL_SIZE = 100
+"""
+Maximum number of simultaneous connections kept by the shared HTTP session (method 1).
+"""
+HTTP_KEEPALIVE = 30
+"""
+Seconds an idle HTTP connection is kept alive for reuse (method 1).
+"""
+
+WS_POOL_SIZE = 8
+"""
+Maximum number of idle WebSocket connections kept for reuse (method 2).
+"""
+WS_IDLE_TIMEOUT = 120
+"""
+Seconds an idle WebSocket connection may stay in the pool before it is replaced (method 2).
+"""
+WS_PING_INTERVAL = 20
+"""
+Seconds between keep-alive pings on a pooled WebSocket connection (method 2).
+"""
+
+COALESCE_REQUESTS = True
+"""
+Whether identical requests (same SSML, format and method) made while one is in flight wait for its audio
+instead of being sent again.
+"""
+COALESCE_READ_AHEAD = 4
+"""
+Chunks a coalesced request may receive ahead of the slowest of its waiters, so that a slow sink
+slows down the download instead of piling the audio up in memory.
+"""
+
+HTTP_URL = "https://southeastasia.api.speech.microsoft.com/accfreetrial/texttospeech/acc/v3.0-beta1/vcg/speak"
+"""
+Endpoint of method 1.
+"""
+WS_URL = "wss://speech.platform.bing.com/consumer/speech/synthesize/readaloud/edge/v1?TrustedClientToken=6A5AA1D4EAFF4E9FB37E23D68491D6F4"
+WS_HEADERS = {
+    "Pragma": "no-cache",
+    "Cache-Control": "no-cache",
+    "Origin": "chrome-extension://jdiccldimpdaibmpdkjnbmckianbfold",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Accept-Language": "en-US,en;q=0.9",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.77 Safari/537.36 Edg/91.0.864.41"
+}
+
+_http_sessions: dict = {}
+_ws_pools: dict = {}
+_flights: dict = {}
 
 class InvalidRequest(RuntimeError):
     def __init__(self, msg, innerError):
@@ -28,6 +99,45 @@ class InvalidRequest(RuntimeError):
     def __str__(self) -> str:
         return self.__repr__()
 
+class _RequestInfo():
+    '''
+        What happened to a request on its way, filled in by `implete_stream`.
+
+        The phases are `time.monotonic()` timestamps, `None` until they are reached. When a request is
+        retried, or is made of several ones (several voices, long text), the connection phases are those
+        of the last attempt started, `first_byte` is the earliest and `last_byte` the latest.
+    '''
+    def __init__(self):
+        self.retries = 0
+        self.retry_delay = 0.0
+        self.queued = time.monotonic()
+        self.connect_start: Optional[float] = None
+        self.connect_done: Optional[float] = None
+        self.request_sent: Optional[float] = None
+        self.first_byte: Optional[float] = None
+        self.last_byte: Optional[float] = None
+        self.decode = 0.0
+        self.handle_done: Optional[float] = None
+        self.method: Optional[int] = None
+        self.fallbacks = 0
+
+    def mark(self, phase:str):
+        setattr(self, phase, time.monotonic())
+
+    def merge(self, other:"_RequestInfo"):
+        '''
+            Take in what happened to `other`, the request this one waited for.
+        '''
+        self.retries += other.retries
+        self.retry_delay += other.retry_delay
+        self.decode += other.decode
+        for phase in ("connect_start", "connect_done", "request_sent"):
+            if getattr(other, phase) is not None:
+                setattr(self, phase, getattr(other, phase))
+        if other.method is not None:
+            self.method = other.method
+        self.fallbacks = max(self.fallbacks, other.fallbacks)
+
 # Generate X-Timestamp all correctly formatted
 def _getXTime():
     hr_cr = lambda hr: str((hr - 1) % 24)
@@ -40,105 +150,565 @@ def _getXTime():
     ]
     return "{}-{}-{}T{}:{}:{}.{}Z".format(*n)
 
-async def implete(SSML_text:str,opt_fmt:str,debug:bool,method:int=1) -> tuple[bool,str,bytes]:
+class _Frame(NamedTuple):
     '''
-        Insider function.
+        A decoded WebSocket message of method 2.
+    '''
+    headers: dict
+    payload: Union[memoryview, str]
 
-        You should use `speech.SpeechSynthesizer` instead of this function
+    @property
+    def path(self) -> str:
+        return self.headers.get("Path", "")
+
+def _parse_headers(block:str) -> dict:
+    headers = {}
+    for line in block.split("\r\n"):
+        key, sep, value = line.partition(":")
+        if sep:
+            headers[key.strip()] = value.strip()
+    return headers
+
+def _decode_frame(message:Union[bytes,str]) -> _Frame:
     '''
-    log_handler.setLevel(logging.DEBUG if debug else logging.INFO)
-    req_id = uuid.uuid4().hex.upper()
-    log.debug("method=%d" % method)
-    if method == 1:
-        url = "https://southeastasia.api.speech.microsoft.com/accfreetrial/texttospeech/acc/v3.0-beta1/vcg/speak"
-        headers = {
-            "origin": "https://speech.microsoft.com",
-            "content-type": "application/json"
-        }
-        data = {
-            "ssml": SSML_text,
-            "ttsAudioFormat": opt_fmt,
-            # "offsetInPlainText": 2,
-            # "lengthInPlainText": 8
-        }
+        Decode a WebSocket message of method 2.
+
+        Text messages are headers and a body separated by an empty line.
+        Binary messages start with the header length as a 2-byte big-endian integer,
+        followed by the headers and the payload. The payload is a `memoryview`
+        into the message, so it is not copied.
+    '''
+    if isinstance(message, str):
+        head, _, body = message.partition("\r\n\r\n")
+        return _Frame(_parse_headers(head), body)
+    view = memoryview(message)
+    size = int.from_bytes(view[:2], "big")
+    head = str(view[2:2+size], "utf-8")
+    return _Frame(_parse_headers(head), view[2+size:])
+
+def _trace(phase:str):
+    async def callback(session, context, params):
+        if isinstance(context.trace_request_ctx, _RequestInfo):
+            context.trace_request_ctx.mark(phase)
+    return callback
+
+def _drop_http_session(session: "aiohttp.ClientSession"):
+    '''
+        Close the session of an event loop which isn't running anymore. `session.close()` can't be awaited
+        without that loop, so the transports are closed at once, which also marks the session closed.
+    '''
+    if session.connector is not None:
+        session.connector._close()
+
+def _get_http_session() -> "aiohttp.ClientSession":
+    '''
+        Get the HTTP session shared by every synthesizer in the running event loop.
+
+        The session owns a keep-alive connection pool, so concurrent requests of method 1
+        reuse connections instead of doing a new TLS handshake each time.
+    '''
+    loop = asyncio.get_running_loop()
+    session = _http_sessions.get(loop)
+    if session is None or session.closed:
+        import aiohttp
+        # Close the sessions of loops which are not running anymore.
+        for old in [l for l in _http_sessions if l is not loop and not l.is_running()]:
+            _drop_http_session(_http_sessions.pop(old))
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=HTTP_KEEPALIVE)
+        # Time the phases of the requests given a `_RequestInfo` as `trace_request_ctx`.
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(_trace("connect_done"))
+        trace.on_connection_reuseconn.append(_trace("connect_done"))
+        trace.on_request_headers_sent.append(_trace("request_sent"))
+        trace.on_request_chunk_sent.append(_trace("request_sent"))
+        session = aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+        _http_sessions[loop] = session
+    return session
+
+class _WebSocketPool:
+    '''
+        Long-lived WebSocket connections of method 2 for one event loop.
+
+        Every connection sends `speech.config` once when it is opened, then serves
+        requests one after another. Keep-alive pings are sent by `websockets` itself,
+        and connections which are closed or idle for too long are replaced.
+    '''
+    def __init__(self, url:str, headers:dict, size:int):
+        self._url = url
+        self._headers = headers
+        self._size = size
+        self._idle: list = []
+        self._closed = False
+
+    async def acquire(self):
+        '''
+            Get a ready-to-use connection.
+
+            :returns: `(websocket, reused)`, `reused` is `True` if the connection was taken from the pool.
+        '''
+        while self._idle:
+            websocket, last_used = self._idle.pop()
+            if websocket.open and time.monotonic() - last_used < WS_IDLE_TIMEOUT:
+                return websocket, True
+            self.discard(websocket)
+        from websockets.legacy import client
+        websocket = await client.connect(self._url, extra_headers=self._headers, ping_interval=WS_PING_INTERVAL)
         try:
-            log.debug(f"Connected ({req_id})")
-            ret = post(url,data=dumps(data),headers=headers)
+            message = \
+                f"X-Timestamp:{_getXTime()}\r\n"\
+                "Content-Type:application/json; charset=utf-8\r\n"\
+                "Path:speech.config\r\n"\
+                "\r\n"\
+                '{"context":{"synthesis":{"audio":{"metadataoptions":{"sentenceBoundaryEnabled":false,"wordBoundaryEnabled":false},"outputFormat":"audio-24khz-48kbitrate-mono-mp3"}}}}'
+            await websocket.send(message)
+        except BaseException:
+            self.discard(websocket)
+            raise
+        return websocket, False
+
+    def release(self, websocket):
+        '''
+            Give back a connection whose request has finished.
+        '''
+        if websocket.open and not self._closed and len(self._idle) < self._size:
+            self._idle.append((websocket, time.monotonic()))
+        else:
+            self.discard(websocket)
+
+    def discard(self, websocket):
+        '''
+            Close a connection which must not be used again.
+        '''
+        asyncio.ensure_future(websocket.close())
+
+    async def close(self):
+        '''
+            Close the idle connections, and those in use once their request has finished.
+        '''
+        self._closed = True
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(websocket.close() for websocket, _ in idle), return_exceptions=True)
+
+def _get_ws_pool() -> _WebSocketPool:
+    '''
+        Get the WebSocket pool shared by every synthesizer in the running event loop.
+    '''
+    loop = asyncio.get_running_loop()
+    pool = _ws_pools.get(loop)
+    if pool is None:
+        for old in [l for l in _ws_pools if l is not loop and not l.is_running()]:
+            del _ws_pools[old]
+        pool = _WebSocketPool(WS_URL, WS_HEADERS, WS_POOL_SIZE)
+        _ws_pools[loop] = pool
+    return pool
+
+async def _close_connections():
+    '''
+        Close the HTTP session and the WebSocket pool of the running event loop, before the loop is closed.
+    '''
+    loop = asyncio.get_running_loop()
+    session = _http_sessions.pop(loop, None)
+    if session is not None:
+        await session.close()
+    pool = _ws_pools.pop(loop, None)
+    if pool is not None:
+        await pool.close()
+
+async def _ws_stream(websocket, req_id:str, SSML_text:str, info:Optional[_RequestInfo]=None) -> AsyncIterator[memoryview]:
+    '''
+        Run one synthesis on an already configured connection of method 2,
+        yielding the audio of every `Path:audio` frame as soon as it arrives.
+
+        Frames of other requests (e.g. the tail of a cancelled one) are skipped by `X-RequestId`.
+    '''
+    message = \
+        f"X-RequestId:{req_id}\r\n"\
+        "Content-Type:application/ssml+xml\r\n"\
+        f"X-Timestamp:{_getXTime()}Z\r\n"\
+        "Path:ssml\r\n\r\n"\
+        f"{SSML_text}"
+    await websocket.send(message)
+    if info is not None:
+        info.mark("request_sent")
+
+    while(True):
+        frame = _decode_frame(await websocket.recv())
+        if frame.headers.get("X-RequestId", "").upper() != req_id:
+            continue
+        path = frame.path
+        if path == "audio":
+            if isinstance(frame.payload, str):
+                log.warning("A part of the audio parsed failed!")
+            elif len(frame.payload):
+                yield frame.payload
+        elif path == "turn.end":
+            break
+        elif path in ("turn.start", "response"):
+            log.debug("%s (%s)" % (path, req_id))
+
+async def _http_stream(req_id:str, SSML_text:str, opt_fmt:str, info:Optional[_RequestInfo]=None) -> AsyncIterator[bytes]:
+    '''
+        Run one synthesis of method 1, yielding the audio as the response body arrives.
+    '''
+    headers = {
+        "origin": "https://speech.microsoft.com",
+        "content-type": "application/json"
+    }
+    data = {
+        "ssml": SSML_text,
+        "ttsAudioFormat": opt_fmt,
+        # "offsetInPlainText": 2,
+        # "lengthInPlainText": 8
+    }
+    session = _get_http_session()
+    async with session.post(HTTP_URL,data=dumps(data),headers=headers,trace_request_ctx=info) as ret:
+        log.debug(f"Connected ({req_id})")
+        code = ret.status
+        if code == 200:
+            async for chunk in ret.content.iter_any():
+                yield chunk
             log.debug(f"End ({req_id})")
-            code = ret.status_code
-            if code == 200:
-                return req_id, ret.content
-            elif code == 400:
-                data = ret.json()
-                if "TtsAudioFormat" in data["message"]:
-                    raise ValueError(data["message"])
-                raise InvalidRequest(data["message"],data["innerError"])
-            else:
-                raise RuntimeError(data)
-        except Exception as e:
-            log.error("An unexpected exception occurred. If this error kept going, please make an Issue on github with code 1")
-            log.info("We will use the backup method.")
-            log.debug("RE",exc_info=e)
-            return await implete(SSML_text,opt_fmt,debug,2)
-    elif method == 2:
-        url = "wss://speech.platform.bing.com/consumer/speech/synthesize/readaloud/edge/v1?TrustedClientToken=6A5AA1D4EAFF4E9FB37E23D68491D6F4"
-        if opt_fmt != "audio-24khz-48kbitrate-mono-mp3":
-            log.warning("Only type `audio-24khz-48kbitrate-mono-mp3` is allowed.")
-        if SSML_text.count("</voice>")>=2:
-            raise ValueError("Mutiple <voice> tag is not supported.")
-        headers = {
-            "Pragma": "no-cache",
-            "Cache-Control": "no-cache",
-            "Origin": "chrome-extension://jdiccldimpdaibmpdkjnbmckianbfold",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Accept-Language": "en-US,en;q=0.9",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.77 Safari/537.36 Edg/91.0.864.41"
-        }
-        
-        log.debug("Prepare (%s)" % req_id)
+        elif code == 400:
+            data = await ret.json(content_type=None)
+            if "TtsAudioFormat" in data["message"]:
+                raise ValueError(data["message"])
+            raise InvalidRequest(data["message"],data["innerError"])
+        else:
+            raise ServiceStatusError(code, await ret.text(), parse_retry_after(ret.headers.get("Retry-After")))
+
+async def _ws_pool_stream(req_id:str, SSML_text:str, opt_fmt:str, info:Optional[_RequestInfo]=None) -> AsyncIterator[memoryview]:
+    '''
+        Run one synthesis of method 2 on a pooled connection, yielding the audio as it arrives.
+    '''
+    from websockets.exceptions import ConnectionClosed
+    if opt_fmt != "audio-24khz-48kbitrate-mono-mp3":
+        log.warning("Only type `audio-24khz-48kbitrate-mono-mp3` is allowed.")
+    if SSML_text.count("</voice>")>=2:
+        raise ValueError("Mutiple <voice> tag is not supported.")
+
+    log.debug("Prepare (%s)" % req_id)
+    pool = _get_ws_pool()
+    started = False
+    while True:
+        websocket, reused = await pool.acquire()
+        if info is not None:
+            info.mark("connect_done")
+        log.debug("Connect (%s, reused=%s)" % (req_id, reused))
+        try:
+            async for chunk in _ws_stream(websocket, req_id, SSML_text, info):
+                started = True
+                yield chunk
+        except ConnectionClosed:
+            pool.discard(websocket)
+            if reused and not started:
+                # The pooled connection died while idle, replace it.
+                log.debug("Reconnect (%s)" % req_id)
+                continue
+            raise
+        except BaseException:
+            pool.discard(websocket)
+            raise
+        pool.release(websocket)
+        log.debug("end ({})".format(req_id))
+        return
+
+_METHODS = {1: _http_stream, 2: _ws_pool_stream}
+
+async def _implete_voices(segments:list[str],opt_fmt:str,debug:bool,method:int,
+                          retry:Optional[RetryPolicy],info:Optional[_RequestInfo]) -> bytes:
+    '''
+        Synthesize the single-voice `segments` concurrently and join their audio in order.
+    '''
+    tasks = [asyncio.ensure_future(implete(segment,opt_fmt,debug,method,retry,info)) for segment in segments]
+    try:
+        rets = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return await _concat([data for _, data in rets],opt_fmt,info)
+
+async def _concat(chunks:list[bytes],opt_fmt:str,info:Optional[_RequestInfo]) -> bytes:
+    '''
+        Join the audio of several requests, in the decode executor if it has to be decoded, see `concat_audio`.
+    '''
+    begin = time.monotonic()
+    if _concat_decodes(opt_fmt) and len(chunks) > 1:
+        audio = await _offload_decode(concat_audio,chunks,opt_fmt)
+    else:
+        audio = concat_audio(chunks,opt_fmt)
+    if info is not None:
+        info.decode += time.monotonic() - begin
+    return audio
+
+class _Flight:
+    '''
+        A request in flight, whose audio is handed to every identical request made before its first chunk.
+
+        The request runs in a task of its own, reading at most `COALESCE_READ_AHEAD` chunks ahead of its
+        slowest waiter, and a chunk is dropped once every waiter has got it. It is cancelled when all the
+        waiters are gone.
+    '''
+    def __init__(self, flights:dict, key:tuple, req_id:str, retry:Optional[RetryPolicy], debug:bool):
+        self._flights = flights
+        self._key = key
+        self.info = _RequestInfo()
+        self._chunks: deque = deque()
+        # Index of `_chunks[0]` in the audio, and of the next chunk of every waiter.
+        self._first = 0
+        self._positions: dict = {}
+        self._done = False
+        self._exc: Optional[BaseException] = None
+        self._changed = asyncio.Event()
+        SSML_text, opt_fmt, method = key
+        self._task = asyncio.ensure_future(self._run(_implete_stream(SSML_text,opt_fmt,debug,method,req_id,retry,self.info)))
+
+    def _slowest(self) -> int:
+        return min(self._positions.values(), default=self._first)
+
+    async def _run(self, chunks):
+        try:
+            while True:
+                while self._first + len(self._chunks) - self._slowest() >= COALESCE_READ_AHEAD:
+                    await self._changed.wait()
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                # A request joining now would miss the chunks already dropped.
+                self._land()
+                self._chunks.append(chunk)
+                self._wake()
+        except BaseException as e:
+            self._exc = e
+        finally:
+            self._done = True
+            self._land()
+            self._wake()
+
+    def _wake(self):
+        event, self._changed = self._changed, asyncio.Event()
+        event.set()
+
+    def _trim(self):
+        '''
+            Drop the chunks every waiter has got, and let the request read on.
+        '''
+        slowest = self._slowest()
+        while self._first < slowest:
+            self._chunks.popleft()
+            self._first += 1
+        self._wake()
+
+    def _land(self):
+        '''
+            Stop handing this request to new identical ones.
+        '''
+        if self._flights.get(self._key) is self:
+            del self._flights[self._key]
 
+    async def wait(self, info:_RequestInfo) -> AsyncIterator[Union[bytes,memoryview]]:
+        '''
+            Yield the audio of the request as it arrives, then record what happened to it into `info`.
+        '''
+        token = object()
+        self._positions[token] = self._first
         try:
-            async with client.connect(url,extra_headers=headers) as websocket:
-                log.debug("Connect (%s)"% req_id)
-                message_1 = \
-                    f"X-Timestamp:{_getXTime()}\r\n"\
-                    "Content-Type:application/json; charset=utf-8\r\n"\
-                    "Path:speech.config\r\n"\
-                    "\r\n"\
-                    '{"context":{"synthesis":{"audio":{"metadataoptions":{"sentenceBoundaryEnabled":false,"wordBoundaryEnabled":false},"outputFormat":"audio-24khz-48kbitrate-mono-mp3"}}}}'
-                await websocket.send(message_1)
-
-                message_2 = \
-                    f"X-RequestId:{req_id}\r\n"\
-                    "Content-Type:application/ssml+xml\r\n"\
-                    f"X-Timestamp:{_getXTime()}Z\r\n"\
-                    "Path:ssml\r\n\r\n"\
-                    f"{SSML_text}"
-                await websocket.send(message_2)
-
-                audio_stream:bytes = b''
-                while(True):
-                    response = await websocket.recv()
-                    # print(str(response))
-                    if "Path:turn.end" not in str(response):
-                        if type(response) == type(bytes()):
-                            try:
-                                needle = b'Path:audio\r\n'
-                                start_ind = response.find(needle) + len(needle) # type: ignore
-                                audio_stream += response[start_ind:] # type: ignore
-                            except:
-                                log.warning("A part of the audio parsed failed!")
-                    else:
-                        break
-                log.debug("end ({})".format(req_id))
-                return req_id, audio_stream
-        except Exception as e:
-            log.error("An unexpected exception occurred. If this error kept going, please make an Issue on github with code %d"%method)
-            log.info("We will use the backup method.")
-            log.debug("Error",exc_info=e)
-            return await implete(SSML_text,opt_fmt,debug,method+1)
+            while True:
+                changed = self._changed
+                position = self._positions[token]
+                if position < self._first + len(self._chunks):
+                    info.mark("last_byte")
+                    if info.first_byte is None:
+                        info.first_byte = info.last_byte
+                    chunk = self._chunks[position - self._first]
+                    self._positions[token] = position + 1
+                    self._trim()
+                    yield chunk
+                elif self._done:
+                    break
+                else:
+                    await changed.wait()
+            info.merge(self.info)
+            if self._exc is not None:
+                raise self._exc
+        finally:
+            del self._positions[token]
+            if not self._positions and not self._done:
+                self._land()
+                self._task.cancel()
+            else:
+                self._trim()
+
+def _get_flights() -> dict:
+    '''
+        Get the requests in flight in the running event loop, by `(SSML, format, method)`.
+    '''
+    loop = asyncio.get_running_loop()
+    flights = _flights.get(loop)
+    if flights is None:
+        for old in [l for l in _flights if l is not loop and not l.is_running()]:
+            del _flights[old]
+        flights = _flights[loop] = {}
+    return flights
+
+async def implete_stream(SSML_text:str,opt_fmt:str,debug:bool,method:int=1,req_id:Optional[str]=None,
+                         retry:Optional[RetryPolicy]=None,info:Optional[_RequestInfo]=None) -> AsyncIterator[Union[bytes,memoryview]]:
+    '''
+        Insider function.
+
+        Yield the synthesized audio chunk by chunk, see `_implete_stream`.
+        If `COALESCE_REQUESTS`, an identical request (same SSML, format and method) in flight in the running
+        event loop, which hasn't received audio yet, is waited for instead of sending a new one; its retry
+        policy is used.
+        Cancelling the iteration only cancels that request if nobody else waits for it.
+
+        You should use `speech.SpeechSynthesizer` instead of this function
+    '''
+    if req_id is None:
+        req_id = uuid.uuid4().hex.upper()
+    if not COALESCE_REQUESTS:
+        async for chunk in _implete_stream(SSML_text,opt_fmt,debug,method,req_id,retry,info):
+            yield chunk
+        return
+    if info is None:
+        info = _RequestInfo()
+    flights = _get_flights()
+    key = (SSML_text, opt_fmt, method)
+    flight = flights.get(key)
+    if flight is None:
+        flight = flights[key] = _Flight(flights,key,req_id,retry,debug)
     else:
-        raise ValueError(f"Method must between 1 to 2, but '{method}' got. If you haven't specified 'method', this is because of all the methods failed. If so, please make an Issue.")
+        log.debug("Wait for the identical request in flight (%s)" % req_id)
+        metrics.coalesced.inc()
+    async for chunk in flight.wait(info):
+        yield chunk
+
+async def _implete_stream(SSML_text:str,opt_fmt:str,debug:bool,method:int=1,req_id:Optional[str]=None,
+                          retry:Optional[RetryPolicy]=None,info:Optional[_RequestInfo]=None) -> AsyncIterator[Union[bytes,memoryview]]:
+    '''
+        Send a request, yielding the synthesized audio chunk by chunk, as `bytes` or `memoryview`.
+        The methods from `method` on are tried in order, skipping those whose circuit is open in `policy.backends`, and paced by their
+        `policy.rate_limiters`. If a method fails before any audio is yielded, it is retried as `retry`
+        allows, then the next one is used; once audio has been yielded, errors are raised.
+        The retries, the timings and the method used are recorded in `info`, and every request is counted
+        in `metrics`. Method 2 synthesizes each voice of a multi-voice document concurrently, yielding the
+        joined audio once they are all done.
+    '''
+    _get_log_handler().setLevel(logging.DEBUG if debug else logging.INFO)
+    if req_id is None:
+        req_id = uuid.uuid4().hex.upper()
+    if info is None:
+        info = _RequestInfo()
+    last_exc: Optional[Exception] = None
+    waited = 0.0
+    candidates = backends.candidates(method)
+    for m in candidates:
+        if m == 2:
+            try:
+                segments = split_voices(SSML_text)
+            except ValueError as e:
+                if last_exc is None:
+                    raise
+                # The backup method can't speak this document, report why the previous one failed.
+                log.debug("Method %d can't speak the document (%s): %s" % (m, req_id, e))
+                continue
+            if len(segments) > 1:
+                # Method 2 only speaks one voice per request, so each voice is a request of its own.
+                log.debug("Split into %d voices (%s)" % (len(segments), req_id))
+                yield await _implete_voices(segments,opt_fmt,debug,m,retry,info)
+                info.method = m
+                info.fallbacks = max(info.fallbacks, candidates.index(m))
+                if m != candidates[0]:
+                    metrics.fallbacks.inc(str(m))
+                return
+        attempt = 0
+        while True:
+            if not backends.acquire(m):
+                log.debug("Skip method %d, its circuit is open (%s)" % (m, req_id))
+                break
+            attempt += 1
+            log.debug("method=%d" % m)
+            started = False
+            received = 0
+            label = str(m)
+            begin = time.monotonic()
+            try:
+                async with rate_limiters[m]:
+                    info.mark("connect_start")
+                    connected = info.connect_start
+                    metrics.in_flight.inc(label)
+                    try:
+                        async for chunk in _METHODS[m](req_id, SSML_text, opt_fmt, info):
+                            info.mark("last_byte")
+                            received += len(chunk)
+                            if not started:
+                                started = True
+                                metrics.time_to_first_byte.observe(info.last_byte-connected, label)  # type: ignore
+                                if info.first_byte is None:
+                                    info.first_byte = info.last_byte
+                            yield chunk
+                    finally:
+                        metrics.in_flight.dec(label)
+                        metrics.received_bytes.inc(label, amount=received)
+            except (ValueError, InvalidRequest) as e:
+                # The request itself is rejected, which says nothing about the health of the method.
+                metrics.requests.inc(label, error_code(e).name)
+                backends.release(m)
+                if started:
+                    raise
+                last_exc = e
+                log.debug("Rejected by method %d" % m, exc_info=e)
+                break
+            except Exception as e:
+                metrics.requests.inc(label, error_code(e).name)
+                backends.record_error(m, e)
+                if started:
+                    raise
+                last_exc = e
+                delay = retry.next_delay(attempt, e, waited) if retry is not None else None
+                if delay is not None:
+                    log.info("Method %d failed (%s), retry in %.2fs." % (m, e, delay))
+                    log.debug("Error",exc_info=e)
+                    await asyncio.sleep(delay)
+                    waited += delay
+                    info.retries += 1
+                    info.retry_delay += delay
+                    metrics.retries.inc(label)
+                    continue
+                log.error("An unexpected exception occurred. If this error kept going, please make an Issue on github with code %d"%m)
+                if m != candidates[-1]:
+                    log.info("We will use the backup method.")
+                log.debug("Error",exc_info=e)
+                break
+            except BaseException:
+                metrics.requests.inc(label, "cancelled")
+                backends.release(m)
+                raise
+            backends.record_success(m, time.monotonic()-begin)
+            metrics.requests.inc(label, "success")
+            metrics.request_duration.observe(time.monotonic()-connected, label)  # type: ignore
+            info.method = m
+            info.fallbacks = max(info.fallbacks, candidates.index(m))
+            if m != candidates[0]:
+                metrics.fallbacks.inc(label)
+            log.debug("Done by method %d, %.3fs after it was queued (%s)" % (m, time.monotonic()-info.queued, req_id))
+            return
+    if last_exc is not None:
+        raise last_exc
+    raise BackendUnavailable(f"The circuits of methods {candidates} are all open, try again later.")
+
+async def implete(SSML_text:str,opt_fmt:str,debug:bool,method:int=1,
+                  retry:Optional[RetryPolicy]=None,info:Optional[_RequestInfo]=None) -> tuple[str,bytes]:
+    '''
+        Insider function.
+
+        You should use `speech.SpeechSynthesizer` instead of this function
+    '''
+    req_id = uuid.uuid4().hex.upper()
+    audio_stream = bytearray()
+    async for chunk in implete_stream(SSML_text,opt_fmt,debug,method,req_id,retry,info):
+        audio_stream += chunk
+    return req_id, bytes(audio_stream)
 
 
 class Test:
@@ -3,7 +3,7 @@ from setuptools import setup
 setup(
     name="my-azure-tts",
     version="0.0.2",
-    install_requires=["pydub","websockets","requests","rich"],
+    install_requires=["pydub","websockets","aiohttp","rich"],
     # download_url="",
     packages=["mytts"]
 )
\ No newline at end of file
@@ -74,6 +74,1204 @@ class Test:
                     print(detail.exception)
                     raise RuntimeError(str(detail.exception))
 
+@pytest.fixture
+def fake_methods(monkeypatch):
+    # Replace the synthesis methods with fakes, async generators taking `(req_id, ssml, opt_fmt, info=None)`,
+    # behind a circuit breaker of their own. Without fakes, only the circuit breaker is replaced.
+    from mytts import tts
+    from mytts.policy import BackendManager
+
+    def install(method=None, method_2=None):
+        monkeypatch.setattr(tts, "backends", BackendManager())
+        if method is not None:
+            monkeypatch.setattr(tts, "_METHODS", {1: method, 2: method_2 or method})
+    return install
+
+
+def test_decode_frame():
+    from mytts.tts import _decode_frame
+    head = b"X-RequestId:ABC\r\nContent-Type:audio/mpeg\r\nPath:audio\r\n"
+    frame = _decode_frame(len(head).to_bytes(2,"big")+head+b"\xff\xf3audio")
+    assert frame.path == "audio"
+    assert frame.headers["X-RequestId"] == "ABC"
+    assert isinstance(frame.payload, memoryview)
+    assert bytes(frame.payload) == b"\xff\xf3audio"
+    frame = _decode_frame("X-RequestId:ABC\r\nPath:turn.end\r\n\r\n{}")
+    assert frame.path == "turn.end"
+    assert frame.payload == "{}"
+
+def test_synthesis_cache(tmp_path):
+    from mytts import SynthesisCache
+    key = SynthesisCache.key("<speak> a  b </speak>", "zh-CN-XiaoxiaoNeural", "audio-24khz-48kbitrate-mono-mp3")
+    assert key == SynthesisCache.key("<speak>\n a b\n</speak>", "zh-CN-XiaoxiaoNeural", "audio-24khz-48kbitrate-mono-mp3")
+    assert key != SynthesisCache.key("<speak> a b </speak>", "zh-CN-YunxiNeural", "audio-24khz-48kbitrate-mono-mp3")
+    cache = SynthesisCache(max_memory_bytes=10, directory=str(tmp_path), max_disk_bytes=10)
+    assert cache.get("a") is None
+    cache.put("a", b"123456")
+    cache.put("b", b"123456")
+    assert cache.stats().memory_bytes == 6
+    assert cache.get("b") == b"123456"
+    # "b" evicted "a" from both tiers
+    assert cache.get("a") is None
+    cache.put("c", b"1234")
+    stats = cache.stats()
+    assert (stats.memory_hits, stats.misses) == (1, 2)
+    assert SynthesisCache(directory=str(tmp_path)).get("b") == b"123456"
+    expired = SynthesisCache(directory=str(tmp_path), ttl=-1)
+    assert expired.get("b") is None
+    assert expired.stats().disk_bytes == 4
+
+def test_split_text():
+    from mytts.ssml import split_text
+    text = "你好，世界。今天天气很好！Hello world. Pi is 3.14, right?"
+    assert split_text(text, 500) == [text]
+    assert split_text(text, 14) == ["你好，世界。今天天气很好！", "Hello world.", "Pi is 3.14,", "right?"]
+    assert split_text("a" * 25, 10) == ["a" * 10, "a" * 10, "a" * 5]
+    assert split_text(" \n ", 10) == []
+    # Abbreviations and initials don't end a sentence.
+    text = "Mr. Smith met Dr. J. Watson, e.g. at noon. They talked."
+    assert split_text(text, 45) == ["Mr. Smith met Dr. J. Watson, e.g. at noon.", "They talked."]
+    assert split_text("J. R. R. Tolkien wrote it. Then he left.", 30) == ["J. R. R. Tolkien wrote it.", "Then he left."]
+    # But a capital letter alone may end one.
+    assert split_text("We took plan B. It failed. Call Dr. Who.", 20) == ["We took plan B.", "It failed.", "Call Dr. Who."]
+
+
+def test_long_text_arguments():
+    import asyncio
+    from mytts import AsyncSpeechSynthesizer
+    synthesizer = SpeechSynthesizer(SpeechConfig(), None, status=False)
+    with pytest.raises(ValueError):
+        synthesizer.speak_long_text_async("Hello.", max_chunk_chars=0)
+    with pytest.raises(ValueError):
+        asyncio.run(AsyncSpeechSynthesizer(SpeechConfig()).speak_long_text("Hello.", max_chunk_chars=0))
+
+def test_long_text(fake_methods):
+    import asyncio, re
+    from mytts import AsyncSpeechSynthesizer
+    from mytts.enums import CancellationErrorCode, ResultReason
+
+    async def method(req_id, ssml, opt_fmt, info=None):
+        text = re.search(r">\s*([^<>\s][^<>]*?)\s*<", ssml).group(1)
+        # The first chunks take longest, so they finish last.
+        await asyncio.sleep(0.05 if text.startswith("One") else 0)
+        yield text.encode()
+
+    fake_methods(method)
+    synthesizer = AsyncSpeechSynthesizer(SpeechConfig())
+    result = asyncio.run(synthesizer.speak_long_text("One. Two. Three.", max_chunk_chars=5))
+    assert result.reason == ResultReason.SynthesizingAudioCompleted
+    assert result.audio_data == b"One.Two.Three."
+    result = asyncio.run(synthesizer.speak_long_text(" \n "))
+    assert result.reason == ResultReason.Canceled
+    assert result.cancellation_details.error_code == CancellationErrorCode.BadRequest
+
+def test_audio_duration_in_event_loop(monkeypatch):
+    import asyncio, threading
+    from datetime import timedelta
+    from mytts import speech
+    threads = []
+    def decoded_duration(data):
+        threads.append(threading.current_thread())
+        return 2.0
+    monkeypatch.setattr(speech, "_decoded_duration", decoded_duration)
+    # The headers of Ogg don't tell the duration, the audio must be decoded.
+    def result():
+        return speech.SpeechSynthesisResult(("ID", b"audio"), None, "ogg-24khz-16bit-mono-opus")
+
+    async def main():
+        first, second = result(), result()
+        # Decoding doesn't block the event loop.
+        assert first.audio_duration is None and not threads
+        assert await first.probe_audio_duration() == timedelta(seconds=2)
+        assert first.audio_duration == timedelta(seconds=2)
+        return second, threading.current_thread()
+
+    second, loop_thread = asyncio.run(main())
+    assert threads and loop_thread not in threads
+    assert second.audio_duration == timedelta(seconds=2)
+
+def test_concat_riff():
+    import struct
+    from mytts.formats import concat_audio
+    def wav(samples):
+        fmt = struct.pack("<HHIIHH", 1, 1, 16000, 32000, 2, 16)
+        return b"RIFF" + struct.pack("<I", 36 + len(samples)) + b"WAVE" + b"fmt " + struct.pack("<I", 16) + fmt \
+            + b"data" + struct.pack("<I", len(samples)) + samples
+    assert concat_audio([wav(b"\x01\x00"), wav(b"\x02\x00\x03\x00")], "riff-16khz-16bit-mono-pcm") \
+        == wav(b"\x01\x00\x02\x00\x03\x00")
+    assert concat_audio([b"ab", b"cd"], "audio-24khz-48kbitrate-mono-mp3") == b"abcd"
+
+def test_probe_duration():
+    import struct
+    from mytts.formats import probe_duration, concat_audio
+    # MPEG 2 layer III, 48kbps, 24kHz, mono: 144 bytes and 576 samples per frame
+    frame = b"\xff\xf3\x64\xc4" + bytes(140)
+    assert probe_duration(frame * 50, "audio-24khz-48kbitrate-mono-mp3") == 50 * 576 / 24000
+    xing = bytearray(frame)
+    xing[4+9:4+9+12] = b"Xing" + struct.pack(">II", 1, 100)
+    assert probe_duration(bytes(xing) + frame * 2, "audio-24khz-48kbitrate-mono-mp3") == 100 * 576 / 24000
+    assert probe_duration(concat_audio([bytes(xing) + frame, frame], "audio-24khz-48kbitrate-mono-mp3"),
+                          "audio-24khz-48kbitrate-mono-mp3") == 2 * 576 / 24000
+    samples = bytes(32000)
+    wav = b"RIFF" + struct.pack("<I", 36 + len(samples)) + b"WAVE" + b"fmt " + struct.pack("<I", 16) \
+        + struct.pack("<HHIIHH", 1, 1, 16000, 32000, 2, 16) + b"data" + struct.pack("<I", len(samples)) + samples
+    assert probe_duration(wav, "riff-16khz-16bit-mono-pcm") == 1.0
+    assert probe_duration(samples, "raw-16khz-16bit-mono-pcm") == 1.0
+    assert probe_duration(bytes(8000), "raw-8khz-8bit-mono-mulaw") == 1.0
+
+def test_import_budget():
+    import subprocess, sys
+    code = "import sys, time; t = time.perf_counter(); import mytts; print(time.perf_counter() - t); " \
+        "print(','.join(m for m in ('pydub', 'rich', 'websockets', 'aiohttp') if m in sys.modules))"
+    elapsed, heavy = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                    check=True).stdout.splitlines()
+    assert heavy == ""
+    assert float(elapsed) < 0.5
+
+def test_circuit_breaker(monkeypatch):
+    from mytts import policy, CircuitState
+    clock = [0.0]
+    monkeypatch.setattr(policy.time, "monotonic", lambda: clock[0])
+    manager = policy.BackendManager(failure_threshold=2, cooldown=10)
+    assert manager.candidates(1) == [1, 2] and manager.candidates(2) == [2]
+    for _ in range(2):
+        assert manager.acquire(1)
+        manager.record_failure(1)
+    assert manager.status()[1].state == CircuitState.Open
+    assert not manager.acquire(1) and manager.acquire(2)
+    clock[0] = 10
+    assert manager.acquire(1)  # the half-open probe
+    assert not manager.acquire(1)
+    manager.record_failure(1)
+    assert manager.status()[1].state == CircuitState.Open
+    clock[0] = 20
+    assert manager.acquire(1)
+    manager.record_success(1, 0.5)
+    status = manager.status()[1]
+    assert status.state == CircuitState.Closed and status.latency == 0.5
+    assert manager.acquire(1) and manager.acquire(1)
+
+
+def test_retry_policy():
+    from mytts import RetryPolicy, ServiceStatusError
+    from mytts.policy import parse_retry_after
+    policy = RetryPolicy(max_attempts=3, backoff=1, multiplier=2, jitter=0, budget=5)
+    busy = ServiceStatusError(429)
+    assert policy.next_delay(1, busy) == 1
+    assert policy.next_delay(2, busy) == 2
+    assert policy.next_delay(3, busy) is None
+    assert policy.next_delay(2, busy, waited=4) is None
+    assert policy.next_delay(1, ServiceStatusError(403)) is None
+    assert policy.next_delay(1, ServiceStatusError(503, retry_after=3)) == 3
+    assert 0.5 <= RetryPolicy(backoff=1, jitter=0.5).next_delay(1, busy) <= 1
+    assert parse_retry_after("2") == 2 and parse_retry_after(None) is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+
+
+def test_rate_limiter():
+    import asyncio, time
+    from mytts import RateLimiter
+
+    async def main():
+        limiter = RateLimiter(requests_per_second=20, burst=1, max_concurrent=2)
+        peak = 0
+
+        async def request():
+            nonlocal peak
+            async with limiter:
+                peak = max(peak, limiter.active)
+                await asyncio.sleep(0.05)
+
+        begin = time.monotonic()
+        await asyncio.gather(*(request() for _ in range(6)))
+        assert peak == 2
+        assert time.monotonic() - begin >= 0.2  # 5 tokens refilled at 20/s
+        limiter.throttle()
+        limiter.throttle()  # the same burst of 429s counts once
+        assert limiter.rate == 10
+        limiter.recover()
+        assert limiter.rate == 11
+
+        # No limit by default, so existing users aren't slowed down.
+        limiter = RateLimiter()
+        begin = time.monotonic()
+        await asyncio.gather(*(request() for _ in range(50)))
+        assert limiter.rate is None and peak == 50
+        assert time.monotonic() - begin < 0.2
+
+    asyncio.run(main())
+
+
+def test_split_voices():
+    from mytts.ssml import split_voices
+    speak = '<speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xml:lang="en-US">'
+    ssml = speak + '<voice name="A">Hi!</voice>\n  <!-- reply --><voice name="B"><prosody rate="+10%">Hello.</prosody></voice></speak>'
+    assert split_voices(ssml) == [
+        speak + '<voice name="A">Hi!</voice></speak>',
+        speak + '<voice name="B"><prosody rate="+10%">Hello.</prosody></voice></speak>',
+    ]
+    single = speak + '<voice name="A">Hi!</voice></speak>'
+    assert split_voices(single) == [single]
+    with pytest.raises(ValueError):
+        split_voices(speak + '<voice name="A">Hi!</voice>stray<voice name="B">Hello.</voice></speak>')
+
+
+def test_async_synthesizer_cache_hit():
+    import asyncio, threading
+    from mytts import AsyncSpeechSynthesizer, SynthesisCache
+    cache = SynthesisCache()
+    synthesizer = AsyncSpeechSynthesizer(SpeechConfig(), cache=cache)
+    cache.put(synthesizer._cache_key(synthesizer._build_ssml("hello")), b"audio")
+
+    async def main():
+        threads = threading.active_count()
+        result = await synthesizer.speak_text("hello")
+        assert threading.active_count() == threads
+        return result
+
+    result = asyncio.run(main())
+    assert result.reason == ResultReason.SynthesizingAudioCompleted
+    assert result.audio_data == b"audio"
+    # No request was sent.
+    assert result.timings.method is None and result.timings.connect_start is None
+    assert result.timings.first_byte is None and result.timings.handle_done is not None
+
+
+def test_runtime():
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from mytts import SynthesisRuntime
+    runtime = SynthesisRuntime()
+
+    async def double(x):
+        await asyncio.sleep(0.001)
+        return x * 2
+
+    with ThreadPoolExecutor(16) as executor:
+        results = list(executor.map(lambda x: runtime.submit(double(x)).result(5), range(200)))
+    assert results == [x * 2 for x in range(200)]
+    slow = runtime.submit(asyncio.sleep(0.05, "done"))
+    runtime.shutdown()
+    assert slow.result() == "done"
+    assert runtime.loop.is_closed()
+    coro = double(1)
+    with pytest.raises(RuntimeError):
+        runtime.submit(coro)
+
+
+def test_file_sink(tmp_path):
+    import asyncio
+    from mytts import FileSink
+    target = tmp_path / "out.mp3"
+    target.write_bytes(b"old")
+
+    async def main():
+        sink = FileSink(str(target), buffer_size=4)
+        await sink.write(b"ab")
+        await sink.write(b"cdef")
+        assert target.read_bytes() == b"old"
+        await sink.close()
+        assert sink.getvalue() == b"abcdef"
+        sink = FileSink(str(target), fsync="always")
+        await sink.write(b"xy")
+        await sink.abort()
+
+    asyncio.run(main())
+    assert target.read_bytes() == b"abcdef"
+    assert [p.name for p in tmp_path.iterdir()] == ["out.mp3"]
+
+
+def test_pull_audio_output_stream():
+    from mytts import PullAudioOutputStream, SynthesisRuntime
+    stream = PullAudioOutputStream(buffer_size=8)
+    high_water = 0
+
+    async def produce():
+        nonlocal high_water
+        for i in range(10):
+            await stream.write(bytes([i]) * 5)
+            high_water = max(high_water, sum(len(s.buffer) for s in stream._syntheses))
+        await stream.close()
+
+    runtime = SynthesisRuntime()
+    future = runtime.submit(produce())
+    data = bytearray()
+    while chunk := stream.read(3):
+        data += chunk
+    future.result(5)
+    runtime.shutdown()
+    assert bytes(data) == b"".join(bytes([i]) * 5 for i in range(10))
+    assert high_water <= 8
+
+
+def test_speaker_sink(monkeypatch):
+    import asyncio
+    from mytts import playback
+    events = []
+
+    class FakePlayer:
+        async def start(self):
+            events.append("start")
+
+        async def feed(self, data):
+            events.append(bytes(data))
+
+        async def finish(self):
+            events.append("finish")
+
+        async def stop(self):
+            events.append("stop")
+
+    monkeypatch.setattr(playback, "_player", lambda fmt: FakePlayer())
+
+    async def main():
+        # 16000 bytes per second, so 0.001s of prebuffer is 16 bytes.
+        first = playback.SpeakerSink("raw-16khz-8bit-mono-pcm", prebuffer=0.001)
+        second = playback.SpeakerSink("raw-16khz-8bit-mono-pcm", prebuffer=0.001)
+        await first.write(b"a" * 10)
+        assert events == []
+        await first.write(b"b" * 10)
+        await second.write(b"c" * 20)  # the speaker is busy, keep buffering
+        await first.write(b"d")
+        await first.close()
+        await second.close()
+
+    asyncio.run(main())
+    assert events == ["start", b"a" * 10 + b"b" * 10, b"d", "finish", "start", b"c" * 20, "finish"]
+
+
+def test_pyaudio_player_stop():
+    import asyncio, threading
+    from mytts import playback
+    from mytts.formats import parse_format
+    threads = []
+
+    class FakeStream:
+        def stop_stream(self):
+            # Waits for the sound card to drain.
+            threads.append(threading.current_thread())
+
+        def close(self):
+            pass
+
+    player = playback._PyAudioPlayer(parse_format("raw-16khz-16bit-mono-pcm"))
+    player._stream = FakeStream()
+    player._pa = type("FakePyAudio", (), {"terminate": lambda self: None})()
+
+    async def main():
+        await player.stop()
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(main())
+    assert threads and loop_thread not in threads
+
+
+def test_synthesis_timings(fake_methods):
+    import asyncio
+    from mytts import AsyncSpeechSynthesizer, SynthesisTimings
+
+    async def broken(req_id, ssml, opt_fmt, info=None):
+        raise RuntimeError("down")
+        yield
+
+    async def working(req_id, ssml, opt_fmt, info=None):
+        info.mark("connect_done")
+        info.mark("request_sent")
+        for chunk in (b"au", b"dio"):
+            await asyncio.sleep(0.01)
+            yield chunk
+
+    fake_methods(broken, working)
+    config = SpeechConfig()
+    config.retry_policy = None
+    result = asyncio.run(AsyncSpeechSynthesizer(config).speak_text("hello"))
+    assert result.audio_data == b"audio"
+    timings = result.timings
+    assert timings.method == 2 and timings.fallbacks == 1
+    assert timings.queued <= timings.connect_start <= timings.request_sent < timings.first_byte < timings.last_byte
+    durations = timings.durations()
+    assert durations["download"] >= 0.005 and durations["decode"] == 0
+    assert timings.total == timings.handle_done - timings.queued
+    assert SynthesisTimings(1.0, None, None, None, None, None, 0.0, None, None, 0).durations()["connect"] is None
+
+
+def test_metrics_registry(tmp_path):
+    import threading
+    from mytts import MetricsRegistry
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "Requests.", ("method",))
+    latency = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1))
+    requests.inc("1")
+    assert registry.snapshot()["requests_total"]["samples"] == []  # disabled
+    registry.enable()
+
+    def work():
+        for _ in range(1000):
+            requests.inc("1")
+        latency.observe(0.5)
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latency.observe(2)
+    snapshot = registry.snapshot()
+    assert snapshot["requests_total"]["samples"] == [{"labels": {"method": "1"}, "value": 4000}]
+    histogram = snapshot["latency_seconds"]["samples"][0]["value"]
+    assert histogram["buckets"] == {0.1: 0, 1: 4, float("inf"): 5} and histogram["sum"] == 4
+    registry.write(str(tmp_path / "metrics.prom"))
+    text = (tmp_path / "metrics.prom").read_text()
+    assert '# TYPE latency_seconds histogram' in text and 'latency_seconds_bucket{le="+Inf"} 5' in text
+    assert 'requests_total{method="1"} 4000' in text
+    registry.reset()
+    assert registry.snapshot()["requests_total"]["samples"] == []
+
+
+def test_coalesce_requests(fake_methods):
+    import asyncio
+    from mytts import AsyncSpeechSynthesizer, tts
+    calls = []
+
+    async def method(req_id, ssml, opt_fmt, info=None):
+        calls.append(ssml)
+        for chunk in (b"au", b"dio"):
+            await asyncio.sleep(0.02)
+            yield chunk
+
+    fake_methods(method)
+    synthesizer = AsyncSpeechSynthesizer(SpeechConfig())
+
+    async def main():
+        results = await asyncio.gather(*(synthesizer.speak_text("hello") for _ in range(10)))
+        assert len(calls) == 1
+        assert all(result.audio_data == b"audio" for result in results)
+        assert len({result.result_id for result in results}) == 10
+
+        tasks = [asyncio.ensure_future(synthesizer.speak_text("bye")) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        tasks[0].cancel()
+        tasks[1].cancel()
+        assert (await tasks[2]).audio_data == b"audio"
+        assert len(calls) == 2
+
+        tasks = [asyncio.ensure_future(synthesizer.speak_text("again")) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert tts._get_flights() == {}
+
+    asyncio.run(main())
+
+
+def test_validate_ssml():
+    import asyncio
+    from mytts import AsyncSpeechSynthesizer
+    from mytts.ssml import SSMLValidationError, validate_ssml
+    fmt = "audio-24khz-48kbitrate-mono-mp3"
+    speak = '<speak xmlns="http://www.w3.org/2001/10/synthesis" version="1.0" xml:lang="en-US">{}</speak>'
+    ssml = speak.format('\n  <voice name="a">Hello,\n   world</voice>\n')
+    assert validate_ssml(ssml, fmt, 1) == speak.format(' <voice name="a">Hello, world</voice> ')
+    two = speak.format('<voice name="a">Hi</voice>text<voice name="b">Bye</voice>')
+    assert validate_ssml(two, fmt, 1)
+    for args in [(two, fmt, 2), ("<speak><voice>Hi</speak>", fmt, 1), ("<voice>Hi</voice>", fmt, 1),
+                 (ssml, "audio-16khz-32kbitrate-mono-mp3", 2), (ssml, "mp3", 1),
+                 (speak.format("<voice>" + "a" * 70000 + "</voice>"), fmt, 1)]:
+        with pytest.raises(SSMLValidationError):
+            validate_ssml(*args)
+
+    result = asyncio.run(AsyncSpeechSynthesizer(SpeechConfig()).speak_ssml("<speak>oops"))
+    assert result.reason == ResultReason.Canceled
+    assert result.cancellation_details.error_code == CancellationErrorCode.BadRequest
+    assert isinstance(result.cancellation_details.exception, SSMLValidationError)
+    future = SpeechSynthesizer(SpeechConfig(), None).speak_ssml_async("<speak>oops")
+    assert future.done() and future.get().cancellation_details.error_code == CancellationErrorCode.BadRequest
+
+
+def test_offload_handles(fake_methods, tmp_path):
+    import asyncio, threading, time
+    from mytts import AsyncSpeechSynthesizer
+
+    async def method(req_id, ssml, opt_fmt, info=None):
+        yield b"audio"
+
+    fake_methods(method)
+    audio_config = AudioOutputConfig(filename=str(tmp_path / "out.mp3"))
+    audio_config.sink = None
+    threads = set()
+
+    def slow_handle(data):
+        threads.add(threading.current_thread())
+        time.sleep(0.3)
+    audio_config.handle = slow_handle
+    synthesizer = AsyncSpeechSynthesizer(SpeechConfig(), audio_config)
+
+    async def main():
+        begin = time.monotonic()
+        results = await asyncio.gather(*(synthesizer.speak_text(f"text {i}") for i in range(4)))
+        assert time.monotonic() - begin < 0.9
+        return results
+
+    results = asyncio.run(main())
+    assert all(result.reason == ResultReason.SynthesizingAudioCompleted for result in results)
+    assert threading.main_thread() not in threads
+
+
+def test_pull_audio_output_stream_reuse(fake_methods):
+    import asyncio, threading
+    from mytts import AsyncSpeechSynthesizer, PullAudioOutputStream
+
+    async def method(req_id, ssml, opt_fmt, info=None):
+        tag = b"1" if "first" in ssml else b"2"
+        for _ in range(5):
+            await asyncio.sleep(0.001)
+            yield tag * 4
+
+    fake_methods(method)
+    stream = PullAudioOutputStream(buffer_size=6)
+    synthesizer = AsyncSpeechSynthesizer(SpeechConfig(), AudioOutputConfig(stream=stream))
+
+    def read_clip():
+        data = bytearray()
+        while chunk := stream.read(5):
+            data += chunk
+        return bytes(data)
+
+    async def one_after_the_other():
+        return [await synthesizer.speak_text("first"), await synthesizer.speak_text("second")]
+
+    async def at_the_same_time():
+        return await asyncio.gather(synthesizer.speak_text("first"), synthesizer.speak_text("second"))
+
+    for run in (one_after_the_other, at_the_same_time):
+        results = []
+        thread = threading.Thread(target=lambda: results.extend(asyncio.run(run())))
+        thread.start()
+        assert read_clip() == b"1" * 20
+        assert read_clip() == b"2" * 20
+        thread.join(5)
+        assert [result.reason for result in results] == [ResultReason.SynthesizingAudioCompleted] * 2
+
+    # Azure's shape: fill a buffer and return the number of bytes read.
+    stream._write_all(b"abcdef")
+    audio_buffer = bytearray(4)
+    assert stream.read(audio_buffer) == 4 and audio_buffer == b"abcd"
+    assert stream.read(audio_buffer) == 2 and audio_buffer[:2] == b"ef"
+    assert stream.read(audio_buffer) == 0
+
+
+def test_coalesce_back_pressure(fake_methods):
+    import asyncio
+    from mytts import AsyncSpeechSynthesizer, PullAudioOutputStream, tts
+    calls = []
+    sent = 0
+
+    async def method(req_id, ssml, opt_fmt, info=None):
+        nonlocal sent
+        calls.append(ssml)
+        for _ in range(1000):
+            await asyncio.sleep(0)
+            sent += 1
+            yield b"x" * 4096
+
+    fake_methods(method)
+    stream = PullAudioOutputStream(buffer_size=4096)
+    synthesizer = AsyncSpeechSynthesizer(SpeechConfig(), AudioOutputConfig(stream=stream))
+
+    async def main():
+        # Nobody reads the stream: the shared request must wait for it.
+        tasks = [asyncio.ensure_future(synthesizer.speak_text("hello")) for _ in range(2)]
+        await asyncio.sleep(0.2)
+        assert len(calls) == 1
+        assert sent <= 2 * tts.COALESCE_READ_AHEAD
+        flight = next(iter(tts._flights[asyncio.get_running_loop()].values()), None)
+        assert flight is None  # no more joins once audio has been received
+        stream.close_reader()
+        results = await asyncio.gather(*tasks)
+        assert [result.reason for result in results] == [ResultReason.SynthesizingAudioCompleted] * 2
+
+        # A request made once audio has been received is sent on its own.
+        second = AsyncSpeechSynthesizer(SpeechConfig())
+        first = second.speak_text_stream("bye").__aiter__()
+        await first.__anext__()
+        assert (await second.speak_text("bye")).audio_data == b"x" * 4096000
+        assert len(calls) == 3
+        await first.aclose()
+
+    asyncio.run(main())
+
+
+def test_file_sink_overwritten(fake_methods, tmp_path):
+    import asyncio, os
+    from mytts import AsyncSpeechSynthesizer
+
+    async def method(req_id, ssml, opt_fmt, info=None):
+        yield b"clip 1" if "first" in ssml else b"clip 2"
+
+    fake_methods(method)
+    target = tmp_path / "out.mp3"
+    synthesizer = AsyncSpeechSynthesizer(SpeechConfig(), AudioOutputConfig(filename=str(target)))
+
+    async def main():
+        return await synthesizer.speak_text("first"), await synthesizer.speak_text("second")
+
+    first, second = asyncio.run(main())
+    assert target.read_bytes() == b"clip 2"
+    # The first clip is gone, it isn't mistaken for the second one.
+    assert first.audio_data is None
+    assert second.audio_data == b"clip 2"
+
+    third = asyncio.run(main())[1]
+    os.rename(target, tmp_path / "moved.mp3")
+    assert third.audio_data is None
+
+
+def test_iterate_in_background_stops():
+    import asyncio, threading
+    from mytts import SynthesisRuntime
+    from mytts.speech import _iterate_in_background
+    produced = []
+    stopped = threading.Event()
+
+    async def produce():
+        try:
+            for i in range(1000):
+                produced.append(i)
+                yield i
+                await asyncio.sleep(0)
+        finally:
+            stopped.set()
+
+    runtime = SynthesisRuntime()
+    items = _iterate_in_background(produce(), False, runtime, maxsize=4)
+    for item in items:
+        if item == 2:
+            break
+    assert len(produced) <= 3 + 4 + 1
+    items.close()
+    assert stopped.wait(5)
+    assert len(produced) < 1000
+    runtime.shutdown()
+
+
+def test_cache_hit_off_caller_thread(tmp_path):
+    import asyncio, threading
+    from mytts import SynthesisCache, SynthesisRuntime
+    # Nothing fits in memory, every hit is read from the disk tier.
+    cache = SynthesisCache(max_memory_bytes=0, directory=str(tmp_path))
+    audio_config = AudioOutputConfig(filename=str(tmp_path / "out.mp3"))
+    audio_config.sink = None
+    threads = []
+    audio_config.handle = lambda data: threads.append(threading.current_thread())
+    runtime = SynthesisRuntime()
+    synthesizer = SpeechSynthesizer(SpeechConfig(), audio_config, status=False, cache=cache, runtime=runtime)
+    key = synthesizer._cache_key(synthesizer._build_ssml("hello"))
+    cache.put(key, b"audio")
+
+    get_disk = cache._get_disk
+    def _get_disk(key):
+        threads.append(threading.current_thread())
+        return get_disk(key)
+    cache._get_disk = _get_disk
+
+    result = synthesizer.speak_text_async("hello").get()
+    assert result.audio_data == b"audio"
+    assert len(threads) == 2 and threading.main_thread() not in threads
+
+    async def main():
+        await cache.aput("other", b"data")
+        return await cache.aget("other"), threading.current_thread()
+    data, loop_thread = asyncio.run(main())
+    assert data == b"data" and threads[-1] is not loop_thread
+    runtime.shutdown()
+
+
+def test_circuit_breaker_throttled():
+    from mytts import policy, CircuitState
+    manager = policy.BackendManager(failure_threshold=2, cooldown=10)
+    for _ in range(5):
+        assert manager.acquire(1)
+        manager.record_error(1, policy.ServiceStatusError(429, retry_after=1))
+    status = manager.status()[1]
+    assert status.state == CircuitState.Closed and status.failures == 0
+    for _ in range(2):
+        assert manager.acquire(1)
+        manager.record_error(1, policy.ServiceStatusError(503))
+    assert manager.status()[1].state == CircuitState.Open
+
+
+def test_mock_server(fake_methods, monkeypatch):
+    import asyncio
+    from benchmarks.mock_server import MockConfig, MockServer, _parse_args
+    from mytts import AsyncSpeechSynthesizer, tts
+    assert _parse_args([]) == (MockConfig(), 8765)
+    fake_methods()
+
+    async def main():
+        server = MockServer(MockConfig(latency=0, chunk_interval=0, audio_bytes=10000, seed=0))
+        await server.start()
+        monkeypatch.setattr(tts, "HTTP_URL", server.http_url)
+        monkeypatch.setattr(tts, "WS_URL", server.ws_url)
+        try:
+            for method in (1, 2):
+                config = SpeechConfig()
+                config.method = method
+                result = await AsyncSpeechSynthesizer(config).speak_text(f"method {method}")
+                assert result.reason == ResultReason.SynthesizingAudioCompleted
+                assert len(result.audio_data) == 10000
+                assert result.timings.method == method
+            assert server.requests == 2
+        finally:
+            await tts._close_connections()
+            await server.stop()
+
+    asyncio.run(main())
+
+
+def test_async_synthesizer_aclose(fake_methods, monkeypatch):
+    import asyncio
+    from benchmarks.mock_server import MockConfig, MockServer
+    from mytts import AsyncSpeechSynthesizer, tts
+    fake_methods()
+
+    async def main():
+        server = MockServer(MockConfig(latency=0, chunk_interval=0, audio_bytes=100))
+        await server.start()
+        monkeypatch.setattr(tts, "HTTP_URL", server.http_url)
+        monkeypatch.setattr(tts, "WS_URL", server.ws_url)
+        loop = asyncio.get_running_loop()
+        config = SpeechConfig()
+        async with AsyncSpeechSynthesizer(config) as synthesizer:
+            await synthesizer.speak_text("method 1")
+            config.method = 2
+            await synthesizer.speak_text("method 2")
+            session, pool = tts._http_sessions[loop], tts._ws_pools[loop]
+            (websocket, _), = pool._idle
+        assert session.closed and websocket.closed
+        assert loop not in tts._http_sessions and loop not in tts._ws_pools
+        await server.stop()
+
+    asyncio.run(main())
+
+
+def test_error_code(fake_methods, monkeypatch):
+    import asyncio
+    import socket
+    import aiohttp
+    from mytts import AsyncSpeechSynthesizer, tts
+    from mytts.policy import error_code
+    assert error_code(asyncio.TimeoutError()) == CancellationErrorCode.ServiceTimeout
+    assert error_code(aiohttp.ServerTimeoutError()) == CancellationErrorCode.ServiceTimeout
+    assert error_code(aiohttp.ServerDisconnectedError()) == CancellationErrorCode.ConnectionFailure
+    assert error_code(aiohttp.ClientPayloadError()) == CancellationErrorCode.ConnectionFailure
+    assert error_code(ConnectionResetError()) == CancellationErrorCode.ConnectionFailure
+    assert error_code(ConnectionRefusedError(111, "Connection refused")) == CancellationErrorCode.ConnectionFailure
+    assert error_code(socket.gaierror(-2, "Name or service not known")) == CancellationErrorCode.ConnectionFailure
+    assert error_code(OSError(101, "Network is unreachable")) == CancellationErrorCode.ConnectionFailure
+    assert error_code(aiohttp.ClientConnectionError()) == CancellationErrorCode.ConnectionFailure
+    assert error_code(FileNotFoundError(2, "No such file or directory", "out.mp3")) == CancellationErrorCode.RuntimeError
+    assert error_code(PermissionError(13, "Permission denied", "out.mp3")) == CancellationErrorCode.RuntimeError
+
+    # Nothing listens on port 9 of the loopback.
+    fake_methods()
+    monkeypatch.setattr(tts, "HTTP_URL", "http://127.0.0.1:9/vcg/speak")
+    monkeypatch.setattr(tts, "WS_URL", "ws://127.0.0.1:9/ws")
+    config = SpeechConfig()
+    config.retry_policy = None
+
+    async def main():
+        async with AsyncSpeechSynthesizer(config) as synthesizer:
+            return await synthesizer.speak_text("hello")
+
+    result = asyncio.run(main())
+    assert result.reason == ResultReason.Canceled
+    assert result.cancellation_details.error_code == CancellationErrorCode.ConnectionFailure
+
+
+def test_http_session_per_loop(fake_methods, monkeypatch):
+    import asyncio
+    from benchmarks.mock_server import MockConfig, MockServer
+    from mytts import AsyncSpeechSynthesizer, tts
+    fake_methods()
+
+    async def main():
+        server = MockServer(MockConfig(latency=0, chunk_interval=0, audio_bytes=100))
+        await server.start()
+        monkeypatch.setattr(tts, "HTTP_URL", server.http_url)
+        loop = asyncio.get_running_loop()
+        async with AsyncSpeechSynthesizer(SpeechConfig()) as synthesizer:
+            await synthesizer.speak_text("first")
+            session = tts._http_sessions[loop]
+            results = await asyncio.gather(*(synthesizer.speak_text(f"text {i}") for i in range(4)))
+            assert all(result.reason == ResultReason.SynthesizingAudioCompleted for result in results)
+            assert tts._get_http_session() is session
+            assert all(other is loop or other.is_running() for other in tts._http_sessions)
+        await server.stop()
+        return loop, session
+
+    first_loop, first = asyncio.run(main())
+    # A session left behind by a loop which has ended is forgotten, and never used by another loop.
+    tts._http_sessions[first_loop] = first
+    _, second = asyncio.run(main())
+    assert second is not first and first_loop not in tts._http_sessions
+
+
+def test_http_session_of_ended_loop(fake_methods, monkeypatch):
+    import asyncio, gc, warnings
+    from benchmarks.mock_server import MockConfig, MockServer
+    from mytts import AsyncSpeechSynthesizer, tts
+    fake_methods()
+
+    async def main(close):
+        server = MockServer(MockConfig(latency=0, chunk_interval=0, audio_bytes=100))
+        await server.start()
+        monkeypatch.setattr(tts, "HTTP_URL", server.http_url)
+        synthesizer = AsyncSpeechSynthesizer(SpeechConfig())
+        result = await synthesizer.speak_text("hello")
+        assert result.reason == ResultReason.SynthesizingAudioCompleted
+        session = tts._http_sessions[asyncio.get_running_loop()]
+        if close:
+            await synthesizer.aclose()
+        await server.stop()
+        return session
+
+    # The first loop ends without closing its session, which still holds a keep-alive connection.
+    first = asyncio.run(main(False))
+    assert not first.closed
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        asyncio.run(main(True))
+        assert first.closed
+        del first
+        gc.collect()
+    assert not [w for w in caught if "Unclosed" in str(w.message)]
+
+
+def test_websocket_pool(fake_methods, monkeypatch):
+    import asyncio, time
+    from websockets.exceptions import ConnectionClosedError
+    from benchmarks.mock_server import MockConfig, MockServer
+    from mytts import AsyncSpeechSynthesizer, tts
+    fake_methods()
+
+    class DeadWebSocket:
+        # Looks open, but died while idle in the pool.
+        open = True
+        closed = False
+        async def send(self, message):
+            raise ConnectionClosedError(None, None)
+        async def close(self):
+            self.closed = True
+
+    async def main():
+        server = MockServer(MockConfig(latency=0, chunk_interval=0, audio_bytes=100))
+        await server.start()
+        monkeypatch.setattr(tts, "WS_URL", server.ws_url)
+        config = SpeechConfig()
+        config.method = 2
+        config.retry_policy = None
+        async with AsyncSpeechSynthesizer(config) as synthesizer:
+            for i in range(3):
+                assert (await synthesizer.speak_text(f"text {i}")).audio_data == bytes(100)
+            assert server.requests == 1
+
+            pool = tts._get_ws_pool()
+            dead = DeadWebSocket()
+            pool._idle.append((dead, time.monotonic()))
+            result = await synthesizer.speak_text("again")
+            assert result.audio_data == bytes(100) and result.retries == 0
+            await asyncio.sleep(0)
+            assert dead.closed
+            assert server.requests == 1
+        await server.stop()
+
+    asyncio.run(main())
+
+
+def test_synthesis_stream(fake_methods):
+    import asyncio, threading
+    from mytts import AsyncSpeechSynthesizer, SynthesisRuntime
+    from mytts.policy import ServiceStatusError
+    got_first = threading.Event()
+
+    async def method(req_id, ssml, opt_fmt, info=None):
+        yield b"first "
+        if "fail" in ssml:
+            raise ServiceStatusError(500)
+        # The first chunk is handed out before the rest of the audio is received.
+        assert await asyncio.get_running_loop().run_in_executor(None, got_first.wait, 5)
+        yield b"second"
+
+    fake_methods(method)
+    config = SpeechConfig()
+    config.retry_policy = None
+    runtime = SynthesisRuntime()
+    synthesizer = SpeechSynthesizer(config, None, status=False, runtime=runtime)
+
+    stream = synthesizer.speak_text_stream("hello")
+    chunks = []
+    for chunk in stream:
+        if not got_first.is_set():
+            assert stream.result is None
+            got_first.set()
+        chunks.append(chunk)
+    assert chunks == [b"first ", b"second"]
+    assert stream.result.reason == ResultReason.SynthesizingAudioCompleted
+    assert stream.result.audio_data == b"first second"
+
+    # A failure ends the iteration early, the result tells why.
+    stream = synthesizer.speak_text_stream("fail")
+    assert list(stream) == [b"first "]
+    assert stream.result.reason == ResultReason.Canceled
+    assert stream.result.cancellation_details.error_code == CancellationErrorCode.ServiceError
+    runtime.shutdown()
+
+    async def main():
+        stream = AsyncSpeechSynthesizer(config).speak_text_stream("hello")
+        return [chunk async for chunk in stream], stream.result
+    chunks, result = asyncio.run(main())
+    assert chunks == [b"first ", b"second"] and result.audio_data == b"first second"
+
+
+def test_result_future(fake_methods):
+    import asyncio, concurrent.futures, threading
+    from mytts import SynthesisRuntime, as_completed, wait_all
+
+    async def method(req_id, ssml, opt_fmt, info=None):
+        if "slow" in ssml:
+            await asyncio.sleep(0.3)
+            yield b"slow"
+        else:
+            yield b"fast"
+
+    fake_methods(method)
+    runtime = SynthesisRuntime()
+    synthesizer = SpeechSynthesizer(SpeechConfig(), None, status=False, runtime=runtime)
+
+    slow = synthesizer.speak_text_async("slow")
+    fast = synthesizer.speak_text_async("fast")
+    with pytest.raises(concurrent.futures.TimeoutError):
+        slow.get(0.01)
+    assert not slow.done()
+    with pytest.raises(concurrent.futures.TimeoutError):
+        wait_all([slow, fast], timeout=0.01)
+    assert list(as_completed([slow, fast], timeout=5)) == [fast, slow]
+    assert slow.done() and fast.done()
+    assert [result.audio_data for result in wait_all([slow, fast])] == [b"slow", b"fast"]
+
+    # Called at once, in the calling thread, when the future is already done.
+    calls = []
+    fast.add_done_callback(calls.append)
+    calls.append("added")
+    assert calls == [fast, "added"]
+
+    called = threading.Event()
+    pending = synthesizer.speak_text_async("slow again")
+    pending.add_done_callback(lambda future: calls.append(1))
+    pending.add_done_callback(lambda future: calls.append(2) or called.set())
+    assert pending.get(5).audio_data == b"slow"
+    assert called.wait(5) and calls[2:] == [1, 2]
+    runtime.shutdown()
+
+
+def test_push_audio_output_stream_thread(fake_methods):
+    import asyncio, threading
+    from mytts import (AsyncSpeechSynthesizer, PushAudioOutputStream, PushAudioOutputStreamCallback,
+                       SynthesisCache, SynthesisRuntime)
+
+    async def method(req_id, ssml, opt_fmt, info=None):
+        yield b"audio"
+
+    fake_methods(method)
+    calls = []
+
+    class Callback(PushAudioOutputStreamCallback):
+        def write(self, audio_buffer):
+            calls.append((bytes(audio_buffer), threading.current_thread()))
+            return len(audio_buffer)
+
+    audio_config = AudioOutputConfig(stream=PushAudioOutputStream(Callback()))
+    cache = SynthesisCache()
+    # A miss then a cache hit, in an event loop and from a synchronous synthesizer.
+    synthesizer = AsyncSpeechSynthesizer(SpeechConfig(), audio_config, cache=cache)
+    async def main():
+        await synthesizer.speak_text("hello")
+        await synthesizer.speak_text("hello")
+    asyncio.run(main())
+    runtime = SynthesisRuntime()
+    SpeechSynthesizer(SpeechConfig(), audio_config, status=False, cache=cache, runtime=runtime).speak_text("hello")
+    runtime.shutdown()
+    assert [data for data, _ in calls] == [b"audio"] * 3
+    assert all(thread is not threading.main_thread() for _, thread in calls)
+
+
+def test_push_audio_output_stream_shared(fake_methods):
+    import asyncio, re
+    from mytts import AsyncSpeechSynthesizer, PushAudioOutputStream, PushAudioOutputStreamCallback
+
+    async def method(req_id, ssml, opt_fmt, info=None):
+        name = re.search(r">\s*(\w+)\s*<", ssml).group(1)
+        for i in range(3):
+            await asyncio.sleep(0.01)
+            yield f"{name}{i}".encode()
+
+    fake_methods(method)
+    chunks = []
+    closed = []
+
+    class Callback(PushAudioOutputStreamCallback):
+        def write(self, audio_buffer):
+            chunks.append(bytes(audio_buffer))
+            return len(audio_buffer)
+
+        def close(self):
+            closed.append(len(chunks))
+
+    stream = PushAudioOutputStream(Callback())
+    synthesizer = AsyncSpeechSynthesizer(SpeechConfig(), AudioOutputConfig(stream=stream))
+    async def main():
+        await synthesizer.speak_text("a")
+        # Synthesized at the same time, but pushed one after the other.
+        await asyncio.gather(synthesizer.speak_text("b"), synthesizer.speak_text("c"))
+    asyncio.run(main())
+    assert chunks[:3] == [b"a0", b"a1", b"a2"]
+    assert sorted([chunks[3:6], chunks[6:]]) == [[b"b0", b"b1", b"b2"], [b"c0", b"c1", b"c2"]]
+    # The callback is only closed with the stream, once.
+    assert closed == []
+    stream.close()
+    stream.close()
+    assert closed == [9]
+    asyncio.run(synthesizer.speak_text("d"))
+    assert len(chunks) == 9
+
+
+def test_fallback_keeps_error(fake_methods):
+    import asyncio
+    from mytts import AsyncSpeechSynthesizer
+    from mytts.policy import ServiceStatusError
+    sent = []
+
+    async def unavailable(req_id, ssml, opt_fmt, info=None):
+        sent.append(1)
+        raise ServiceStatusError(503)
+        yield b""
+
+    async def method_2(req_id, ssml, opt_fmt, info=None):
+        sent.append(2)
+        yield b"audio"
+
+    fake_methods(unavailable, method_2)
+    config = SpeechConfig()
+    config.retry_policy = None
+    # Several voices with text between them: method 1 takes it, method 2 can't split it.
+    ssml = '<speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xml:lang="en-US">' \
+           '<voice name="A">Hi!</voice>stray<voice name="B">Hello.</voice></speak>'
+    result = asyncio.run(AsyncSpeechSynthesizer(config).speak_ssml(ssml))
+    assert sent == [1]
+    assert result.cancellation_details.error_code == CancellationErrorCode.ServiceUnavailable
+
+
+def test_batch(fake_methods):
+    import asyncio, re
+    from mytts import AsyncSpeechSynthesizer
+    from mytts.policy import ServiceStatusError
+    running = peak = 0
+
+    async def method(req_id, ssml, opt_fmt, info=None):
+        nonlocal running, peak
+        name, delay = re.search(r"item (\w+) (\d+)", ssml).groups()
+        running += 1
+        peak = max(peak, running)
+        try:
+            await asyncio.sleep(int(delay) / 100)
+            if name == "fail":
+                raise ServiceStatusError(500)
+            yield name.encode()
+        finally:
+            running -= 1
+
+    fake_methods(method)
+    config = SpeechConfig()
+    config.retry_policy = None
+    synthesizer = AsyncSpeechSynthesizer(config)
+    delays = [5, 1, 3, 0, 4, 2]
+    items = [f"item n{i} {delay}" for i, delay in enumerate(delays)]
+
+    async def run(items, **kwargs):
+        return [(index, result) async for index, result in synthesizer.speak_batch(items, **kwargs)]
+
+    # In the order of the items, at most `concurrency` at a time.
+    results = asyncio.run(run(items, concurrency=2))
+    assert [index for index, _ in results] == list(range(6))
+    assert [result.audio_data for _, result in results] == [f"n{i}".encode() for i in range(6)]
+    assert peak == 2
+
+    # As soon as they are done.
+    results = asyncio.run(run(items, concurrency=6, ordered=False))
+    assert [index for index, _ in results] == sorted(range(6), key=delays.__getitem__)
+    assert peak == 6
+
+    # A failed item doesn't stop the others.
+    results = dict(asyncio.run(run(items[:2] + ["item fail 1"] + items[3:], concurrency=3)))
+    assert results[2].cancellation_details.error_code == CancellationErrorCode.ServiceError
+    assert all(results[i].reason == ResultReason.SynthesizingAudioCompleted for i in (0, 1, 3, 4, 5))
+
+
+def test_batch_ssml_items(fake_methods):
+    import asyncio
+    from mytts import AsyncSpeechSynthesizer
+    from mytts.ssml import is_ssml
+    received = []
+
+    async def method(req_id, ssml, opt_fmt, info=None):
+        received.append(ssml)
+        yield b"audio"
+
+    fake_methods(method)
+    document = '<?xml version="1.0"?><speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" ' \
+               'xml:lang="en-US"><voice name="A">Hi!</voice></speak>'
+    assert is_ssml(document) and not is_ssml("<speak up> please")
+    synthesizer = AsyncSpeechSynthesizer(SpeechConfig())
+
+    async def run(items, **kwargs):
+        return [result async for _, result in synthesizer.speak_batch(items, **kwargs)]
+
+    asyncio.run(run([document, "<speak up> please"]))
+    assert received[0] == document and "&lt;speak up&gt; please" in received[1]
+    received.clear()
+    asyncio.run(run([document], ssml=False))
+    assert received[0] != document and "&lt;?xml" in received[0]
+
+
+def test_multi_voice_method_2(fake_methods):
+    import asyncio, re
+    from mytts import AsyncSpeechSynthesizer
+    running = peak = 0
+
+    async def method(req_id, ssml, opt_fmt, info=None):
+        nonlocal running, peak
+        assert ssml.count("<voice") == 1
+        name, delay = re.search(r'<voice name="(\w)">(\d+)</voice>', ssml).groups()
+        running += 1
+        peak = max(peak, running)
+        try:
+            await asyncio.sleep(int(delay) / 100)
+            yield name.encode() * 3
+        finally:
+            running -= 1
+
+    fake_methods(method)
+    config = SpeechConfig()
+    config.method = 2
+    ssml = '<speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xml:lang="en-US">' \
+           '<voice name="A">10</voice><voice name="B">0</voice><voice name="C">5</voice></speak>'
+    result = asyncio.run(AsyncSpeechSynthesizer(config).speak_ssml(ssml))
+    # One request per voice, all at once, joined in document order whatever order they finished in.
+    assert result.audio_data == b"AAABBBCCC"
+    assert peak == 3
+    assert result.timings.method == 2
+
+
 @pytest.fixture
 def cleanup():
     def rm():